@@ -0,0 +1,178 @@
+"""
+admission.py - Admission control for bulk ingest
+
+When a fleet comes back after an outage every agent drains its outbox at
+once. Bulk uploads (POST /tests/results, POST /monitor/summaries) go
+through two gates so they can't starve heartbeats, command polls and
+dashboard reads:
+
+- a token bucket per device: SNUTZ_INGEST_RATE uploads per second with
+  bursts of SNUTZ_INGEST_BURST (0 = no per-device limit). A bucket that
+  sat idle for burst/rate seconds is full again and gets dropped, so ids
+  that stop uploading (or never were real devices) don't pile up
+- a bounded queue: at most SNUTZ_INGEST_CONCURRENCY uploads run at once,
+  SNUTZ_INGEST_QUEUE more wait up to INGEST_WAIT seconds for a slot
+
+Everything else skips both gates and always has the rest of the worker
+threads and the database to itself. Results of commands a user is
+waiting for (triggered_by=command with the command_id of a command the
+device is running) skip the per-device bucket, but still queue. Rejected
+uploads get 429 with a Retry-After header, agents keep them in their
+outbox and retry later.
+"""
+
+import asyncio
+import math
+import os
+import time
+
+from fastapi.responses import JSONResponse
+
+import storage
+
+INGEST_RATE = float(os.environ.get("SNUTZ_INGEST_RATE", "1"))
+INGEST_BURST = float(os.environ.get("SNUTZ_INGEST_BURST", "30"))
+INGEST_CONCURRENCY = int(os.environ.get("SNUTZ_INGEST_CONCURRENCY", "8"))
+INGEST_QUEUE = int(os.environ.get("SNUTZ_INGEST_QUEUE", "64"))
+INGEST_WAIT = 2.0  # seconds an upload waits in the queue before it gets a 429
+
+BULK_PATHS = {
+    ("POST", "/tests/results"),
+    ("POST", "/monitor/summaries"),
+}
+
+class TokenBucket:
+    """ rate tokens per second, at most burst saved up """
+
+    def __init__(self, rate: float, burst: float):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+
+    def take(self):
+        """
+        Takes a token if there is one
+
+        Returns: 0 if it got one, otherwise the seconds until there is one
+        """
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return 0
+        return (1 - self.tokens) / self.rate
+
+class IngestQueue:
+    """ A semaphore with a bounded number of waiters """
+
+    def __init__(self, concurrency: int, size: int):
+        self.concurrency = concurrency
+        self.size = size
+        self.slots = None  # created on the server's event loop
+        self.running = 0
+        self.waiting = 0
+
+    async def enter(self, timeout: float):
+        """ Returns: True when it got a slot, False if the queue is full or the wait too long """
+        if self.slots is None:
+            self.slots = asyncio.Semaphore(self.concurrency)
+
+        if self.slots.locked() and self.waiting >= self.size:
+            return False
+
+        self.waiting += 1
+        try:
+            await asyncio.wait_for(self.slots.acquire(), timeout)
+        except asyncio.TimeoutError:
+            return False
+        finally:
+            self.waiting -= 1
+
+        self.running += 1
+        return True
+
+    def leave(self):
+        self.running -= 1
+        self.slots.release()
+
+buckets = {}  # device_id -> TokenBucket
+buckets_swept = time.monotonic()
+queue = IngestQueue(INGEST_CONCURRENCY, INGEST_QUEUE)
+counters = {"admitted": 0, "rate_limited": 0, "queue_full": 0}
+
+def drop_idle_buckets(now: float):
+    """ Forgets the buckets that have been full for a while (a new one would start out the same) """
+    global buckets_swept
+
+    idle_after = INGEST_BURST / INGEST_RATE
+    if now - buckets_swept < idle_after:
+        return
+    buckets_swept = now
+
+    for device_id, bucket in list(buckets.items()):
+        if now - bucket.updated >= idle_after:
+            del buckets[device_id]
+
+def running_command(device_id: str, command_id: str):
+    """ True if command_id is a command the device is running (its result is awaited) """
+    try:
+        command = storage.db.get_command(int(command_id))
+    except ValueError:
+        return False
+    return command is not None and command["device_id"] == device_id and command["status"] == "running"
+
+def too_many_requests(reason: str, retry_after: float):
+    return JSONResponse(
+        status_code=429,
+        content={"error": f"Too many uploads ({reason}), retry later"},
+        headers={"Retry-After": str(max(1, math.ceil(retry_after)))}
+    )
+
+async def admit_request(request, call_next):
+    """ HTTP middleware: the admission gates for bulk uploads """
+    if (request.method, request.url.path) not in BULK_PATHS:
+        return await call_next(request)
+
+    device_id = request.query_params.get("device_id", "")
+
+    # A user is waiting for this one: no per-device limit, but it still queues
+    awaited = request.query_params.get("triggered_by") == "command" and await asyncio.to_thread(
+        running_command, device_id, request.query_params.get("command_id", "")
+    )
+
+    if INGEST_RATE > 0 and not awaited:
+        drop_idle_buckets(time.monotonic())
+        bucket = buckets.get(device_id)
+        if bucket is None:
+            bucket = buckets[device_id] = TokenBucket(INGEST_RATE, INGEST_BURST)
+
+        wait = bucket.take()
+        if wait:
+            counters["rate_limited"] += 1
+            return too_many_requests("device rate limit", wait)
+
+    if not await queue.enter(INGEST_WAIT):
+        counters["queue_full"] += 1
+        return too_many_requests("server busy", INGEST_WAIT)
+
+    counters["admitted"] += 1
+    try:
+        return await call_next(request)
+    finally:
+        queue.leave()
+
+def status():
+    """ Current state of the gates (GET /admission) """
+    return {
+        **counters,
+        "running": queue.running,
+        "waiting": queue.waiting,
+        "concurrency": INGEST_CONCURRENCY,
+        "queue_size": INGEST_QUEUE,
+        "rate": INGEST_RATE,
+        "burst": INGEST_BURST,
+        "devices": len(buckets)
+    }
@@ -1,259 +1,710 @@
+"""
+agent.py - sNutz probe agent
+
+One process can run many devices (probes). Every device is an Agent, they
+all share one AgentRunner: one asyncio event loop for every timer, one HTTP
+connection pool and one pool of test workers, so an extra device only costs
+a few kilobytes instead of a whole Python process.
+
+    python agent.py                # one device, see the defaults below
+    python agent.py agent.json     # devices from a config file
+
+Config file (JSON, everything but "devices" is optional):
+{
+    "server_url": "http://0.0.0.0:8000",
+    "test_workers": 4,
+    "http_workers": 8,
+    "cache_dir": ".",
+    "devices": [
+        {"device_id": "office-pi", "name": "Office Pi"},
+        {"device_id": "load-{n}", "name": "Load test {n}", "count": 500}
+    ]
+}
+"count" repeats an entry, {n} is replaced by 1..count.
+"""
+
 import requests
 import time
 import json
-from tests import ping_test, speedtest_test, traceroute_test
+import asyncio
+import heapq
+import itertools
+import os
+import random
+import sys
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from urllib.parse import urlparse
+from requests.adapters import HTTPAdapter
+from tests import ping_test, speedtest_test, traceroute_test, monitor_test, throughput_test
+from throughput_server import THROUGHPUT_PORT
 
-# Configuration
+# Configuration (defaults when there is no config file)
 DEVICE_ID = "test-1"
 DEVICE_NAME = "Test Device"
 SERVER_URL = "http://0.0.0.0:8000"
 HEARTBEAT_INTERVAL = 30
 CHECK_COMMANDS_INTERVAL = 10  # Check for commands every 10 seconds
+MONITOR_UPLOAD_BUFFER = 360  # Monitor summaries kept while the server can't be reached
+MONITOR_FINAL_ATTEMPTS = 3  # tries for the last summaries before they go into the command result
+TEST_WORKERS = 4  # tests run in a worker pool so the timers stay on time
+HTTP_WORKERS = 8  # threads (and pooled connections) for the server calls of all devices
+OUTBOX_SIZE = 1000  # results kept per device while the server can't be reached
+REQUEST_TIMEOUT = 10
+
+class AgentRunner:
+    """
+    Runs many Agents in one process
+
+    All devices share the event loop (heartbeat / poll / schedule timers),
+    the HTTP connection pool and the test worker pool.
+    """
+
+    def __init__(self, server_url: str = SERVER_URL, test_workers: int = TEST_WORKERS,
+                 http_workers: int = HTTP_WORKERS, cache_dir: str = "."):
+        self.server_url = server_url
+        self.throughput_host = urlparse(server_url).hostname  # throughput_server.py runs next to the server
+        self.cache_dir = cache_dir
+        self.test_workers = test_workers
+        self.agents = {}
+
+        # One keep-alive connection pool for every device
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=http_workers)
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+
+        self.http_pool = ThreadPoolExecutor(max_workers=http_workers, thread_name_prefix="http")
+        self.test_pool = ThreadPoolExecutor(max_workers=test_workers, thread_name_prefix="test")
+
+        # Min-heap of (next run, device_id, schedule_id) for the schedules of all devices
+        self.run_queue = []
+        self.wakeup = asyncio.Event()
+
+        # Commands / schedules whose test is still running
+        self.running = set()
+        self.running_lock = threading.Lock()
+
+    def add_agent(self, device_id: str, name: str):
+        """ Adds a device to this process """
+        agent = Agent(self, device_id, name)
+        self.agents[device_id] = agent
+        return agent
+
+    def post(self, path: str, **kwargs):
+        return self.session.post(f"{self.server_url}{path}", timeout=REQUEST_TIMEOUT, **kwargs)
+
+    def get(self, path: str, **kwargs):
+        return self.session.get(f"{self.server_url}{path}", timeout=REQUEST_TIMEOUT, **kwargs)
+
+    async def call(self, function, *args):
+        """ Runs a blocking server call in the HTTP pool """
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self.http_pool, function, *args)
+
+    def submit_test(self, key: tuple, function, *args):
+        """
+        Runs a command / schedule in the test pool
+
+        Returns: False if the same one is still running
+        """
+        with self.running_lock:
+            if key in self.running:
+                return False
+            self.running.add(key)
+
+        self.test_pool.submit(self.run_in_pool, key, function, *args)
+        return True
+
+    def run_in_pool(self, key: tuple, function, *args):
+        """ Runs a test in the worker pool and clears its running flag """
+        try:
+            function(*args)
+        except Exception as e:
+            print(f"[{key[0]}] {key[1]} #{key[2]} crashed: {e}")
+        finally:
+            with self.running_lock:
+                self.running.discard(key)
+
+    def plan(self, device_id: str, schedule_id: int, run_at: float):
+        """ Puts the next run of a schedule on the heap """
+        heapq.heappush(self.run_queue, (run_at, device_id, schedule_id))
+
+        # It's the first one now, the scheduler has to wake up earlier
+        if self.run_queue[0][0] == run_at:
+            self.wakeup.set()
+
+    async def run_schedules(self):
+        """ Starts every schedule (of every device) when its time has come """
+        while True:
+            now = time.time()
+            due_agents = set()
+
+            while self.run_queue and self.run_queue[0][0] <= now:
+                due, device_id, schedule_id = heapq.heappop(self.run_queue)
+                agent = self.agents[device_id]
+                if agent.run_schedule(schedule_id, due, now):
+                    due_agents.add(agent)
+
+            for agent in due_agents:
+                agent.save_schedule_cache()
+
+            # Sleep until the first schedule is due or an earlier one is added
+            wait = self.run_queue[0][0] - time.time() if self.run_queue else None
+            self.wakeup.clear()
+            try:
+                await asyncio.wait_for(self.wakeup.wait(), timeout=wait)
+            except asyncio.TimeoutError:
+                pass
+
+    async def run(self):
+        print(f"Server: {self.server_url}")
+        print(f"Running {len(self.agents)} device(s), {self.test_workers} test workers")
+        print(f"Heartbeat every {HEARTBEAT_INTERVAL}s")
+        print(f"Checking for commands and schedule changes every {CHECK_COMMANDS_INTERVAL}s")
+        print("Press CTRL+C to stop.\n")
+
+        tasks = [agent.run() for agent in self.agents.values()]
+        await asyncio.gather(self.run_schedules(), *tasks)
+
+    def start(self):
+        try:
+            asyncio.run(self.run())
+        except KeyboardInterrupt:
+            print("\n\nAgent stopped")
+        finally:
+            self.test_pool.shutdown(wait=False, cancel_futures=True)
+            self.http_pool.shutdown(wait=False, cancel_futures=True)
+
+class Agent:
+    """
+    One device
+
+    Only keeps its own state (schedules, outbox), the loop and the pools
+    belong to the AgentRunner.
+    """
+
+    def __init__(self, runner: AgentRunner, device_id: str, name: str):
+        self.runner = runner
+        self.device_id = device_id
+        self.name = name
+        self.registered = False
+
+        # Local schedule state, cached on disk so schedules keep running offline
+        self.cache_file = os.path.join(runner.cache_dir, f"schedules_{device_id}.json")
+        self.schedule_version = 0  # last version synced from the server
+        self.schedules = {}        # schedule_id -> schedule
+        self.next_runs = {}        # schedule_id -> next run (unix time)
+
+        # Results that couldn't be uploaded yet, sent again once the server is back
+        self.outbox = deque(maxlen=OUTBOX_SIZE)
+        self.retry_at = 0.0  # no uploads before this (monotonic), set by 429 Retry-After
+
+    def log(self, message: str):
+        print(f"[{self.device_id}] {message}")
+
+    async def run(self):
+        self.load_schedule_cache()
+
+        # Spread the devices out so they don't all hit the server at once
+        await asyncio.sleep(random.uniform(0, CHECK_COMMANDS_INTERVAL))
+        self.registered = await self.runner.call(self.register)
+
+        await asyncio.gather(self.heartbeat_loop(), self.check_loop())
+
+    async def heartbeat_loop(self):
+        while True:
+            await asyncio.sleep(HEARTBEAT_INTERVAL)
+            if not self.registered:
+                self.registered = await self.runner.call(self.register)
+            await self.runner.call(self.send_heartbeat)
+
+    async def check_loop(self):
+        """ Checks for commands AND schedule changes """
+        while True:
+            if await self.runner.call(self.check_commands):
+                await self.runner.call(self.flush_outbox)
+                changes = await self.runner.call(self.fetch_schedule_changes)
+                if changes:
+                    self.apply_schedule_changes(changes)
+            await asyncio.sleep(CHECK_COMMANDS_INTERVAL)
+
+    def register(self):
+        """ Registers with the server, returns False if it can't be reached """
+        try:
+            response = self.runner.post(
+                "/devices/register",
+                params={"device_id": self.device_id, "name": self.name}
+            )
+        except requests.RequestException as e:
+            self.log(f"Could not register: {e}")
+            return False
+
+        self.log(f"Registered: {response.json()}")
+        return True
+
+    def send_heartbeat(self):
+        """ Tells the server we're still here """
+        try:
+            response = self.runner.post(f"/devices/{self.device_id}/heartbeat")
+        except requests.RequestException:
+            self.log("Heartbeat failed, server unreachable")
+            return False
+
+        if response.status_code == 200:
+            self.log("Heartbeat sent")
+        return True
+
+    def check_commands(self):
+        """
+        Fetches pending commands and hands them to the test pool
+
+        Returns: False if the server can't be reached
+        """
+        try:
+            response = self.runner.get(f"/commands/pending/{self.device_id}")
+        except requests.RequestException:
+            return False
 
-print(f"Starting agent: {DEVICE_ID} ({DEVICE_NAME})")
-print(f"Server: {SERVER_URL}")
-
-# Register with server
-print("\nRegistering with server...")
-response = requests.post(
-    f"{SERVER_URL}/devices/register",
-    params={"device_id": DEVICE_ID, "name": DEVICE_NAME}
-)
-print(f"Registered: {response.json()}")
-
-# Main loop
-print(f"\nHeartbeat every {HEARTBEAT_INTERVAL}s")
-print(f"Checking for commands every {CHECK_COMMANDS_INTERVAL}s")
-print("Press CTRL+C to stop.\n")
-
-heartbeat_counter = 0
-command_check_counter = 0
-
-def execute_command(command):
-    """Executes a command and returns the result"""
-    command_id = command["id"]
-    command_type = command["command_type"]
-    parameters = command.get("parameters")
-    
-    print(f"\nExecuting command #{command_id}: {command_type}")
-    
-    # Parse parameters if they exist
-    if parameters:
-        params = json.loads(parameters)
-    else:
-        params = {}
-    
-    # Execute based on command type
-    if command_type == "ping":
-        target = params.get("target", "google.com")
-        count = params.get("count", 4)
-        
-        print(f"   Pinging {target} ({count} packets)...")
-        result = ping_test(target, count)
-        
-        # Save result to server
-        response = requests.post(
-            f"{SERVER_URL}/tests/results",
-            params={
-                "device_id": DEVICE_ID,
-                "test_type": "ping",
-                "target": target,
-                "result_data": json.dumps(result),
-                "triggered_by": "command"
-            }
-        )
-        
         if response.status_code == 200:
-            result_id = response.json()["result"]["id"]
-            
-            # Mark command as completed
-            requests.post(
-                f"{SERVER_URL}/commands/{command_id}/complete",
-                params={"result_id": result_id, "status": "completed"}
+            waiting = {entry[3] for entry in list(self.outbox)}  # commands whose result is in the outbox
+            for command in response.json()["commands"]:
+                if command["id"] in waiting:
+                    continue
+                # Still pending on the server while we run it, don't start it twice
+                key = (self.device_id, "command", command["id"])
+                if self.runner.submit_test(key, self.execute_command, command):
+                    self.log(f"Found pending command #{command['id']}")
+
+        return True
+
+    def run_test(self, test_type: str, params: dict):
+        """
+        Runs one test
+
+        Returns: (target, result) or None for an unknown test type
+        """
+        if test_type == "ping":
+            target = params.get("target", "google.com")
+            count = params.get("count", 4)
+            self.log(f"Pinging {target} ({count} packets)...")
+            return target, ping_test(target, count)
+
+        elif test_type == "speedtest":
+            self.log("Running speedtest (30-60 seconds)...")
+            result = speedtest_test()
+            return result.get("server_location", "N/A"), result
+
+        elif test_type == "traceroute":
+            target = params.get("target", "google.com")
+            max_hops = params.get("max_hops", 30)
+            self.log(f"Tracing route to {target} (max {max_hops} hops)...")
+            return target, traceroute_test(target, max_hops)
+
+        elif test_type == "throughput":
+            host = params.get("host", self.runner.throughput_host)
+            port = params.get("port", THROUGHPUT_PORT)
+            streams = params.get("streams", 4)
+            self.log(f"Running throughput test against {host}:{port} ({streams} streams)...")
+            result = throughput_test(
+                host, port, streams, params.get("duration", 10), params.get("direction", "both")
             )
-            
-            if result["success"]:
-                print(f"   Command completed! Result ID: {result_id}")
-            else:
-                print(f"   Ping failed but result saved")
-        else:
-            print(f"   Failed to save result")
-    
-    elif command_type == "speedtest":
-      print("Running speedtest (This takes 30-60 secs)")
-      result = speedtest_test()
-      
-      #Save result to server
-      response = requests.post(
-          f"{SERVER_URL}/tests/results",
-          params={
-              "device_id": DEVICE_ID,
-              "test_type": "speedtest",
-              "target": result.get("server_location", "N.A"),
-              "result_data": json.dumps(result),
-              "triggered_by": "command"
-          }
-      )
-      
-      if response.status_code == 200:
-        result_id = response.json()["result"]["id"]
-          
-        requests.post(f"{SERVER_URL}/commands/{command_id}/complete",
-                    params={"result_id": result_id, "status": "completed"}
-        )
-        
-        if result["success"]:
-            print(f"Speedtest Completed!")
-            print(f"Download: {result['download_mbps']} Mbps")
-            print(f"Upload: {result['upload_mbps']} Mbps")
-            print(f"Ping: {result['ping_ms']} ms")
+            return result["target"], result
+
+        return None
+
+    def execute_command(self, command):
+        """Executes a command and saves the result"""
+        command_id = command["id"]
+        command_type = command["command_type"]
+        parameters = command.get("parameters")
+
+        self.log(f"Executing command #{command_id}: {command_type}")
+
+        # Parse parameters if they exist
+        if parameters:
+            params = json.loads(parameters)
         else:
-            print(f"Speedtest FAILED: {result.get('error')}")
-    
-    elif command_type == "traceroute":
-        target = params.get("target", "google.com")
-        max_hops = params.get("max_hops", 30)
-        
-        print(f"Tracing route to {target} (max {max_hops} hops)...")
-        result = traceroute_test(target, max_hops)
-        
-        #Save result to server
-        response = requests.post(f"{SERVER_URL}/tests/results",
-            params={
-                "device_id": DEVICE_ID,
-                "test_type": "traceroute",
-                "target": target,
-                "result_data": json.dumps(result),
-                "triggered_by": "command"
-            }
-        )
-        
-        if response.status_code == 200:
-            result_id = response.json()["result"]["id"]
-            
-            requests.post(
-                f"{SERVER_URL}/commands/{command_id}/complete",
-                params={"result_id": result_id, "status": "completed"}
+            params = {}
+
+        if command_type == "monitor":
+            # Runs in the background, the command is completed when the monitor ends.
+            # Mark it as running so the next poll doesn't start it again
+            self.runner.post(f"/commands/{command_id}/complete", params={"status": "running"})
+
+            target = params.get("target", "google.com")
+            thread = threading.Thread(
+                target=self.run_monitor,
+                args=(command_id, target, params),
+                daemon=True
             )
-            
-            if result["success"]:
-                print(f"Traceroute completed")
-                print(f"hops: {result['hop_count']}")
-                print(f"Reuslt ID: {result_id}")
-            else:
-                print(f"Traceroute FAILED: {result.get('error')}")
+            thread.start()
+            self.log(f"Monitor started for {target}")
+            return
+
+        test = self.run_test(command_type, params)
+
+        if test is None:
+            self.log(f"Unknown command type: {command_type}")
+            # Mark as failed
+            self.runner.post(f"/commands/{command_id}/complete", params={"status": "failed"})
+            return
+
+        target, result = test
+        self.save_command_result(command_id, command_type, target, result)
+
+    def save_command_result(self, command_id: int, test_type: str, target: str, result: dict):
+        """ Saves a command's result and marks the command as completed (or keeps both in the outbox) """
+        result_id = self.upload_result({
+            "device_id": self.device_id,
+            "test_type": test_type,
+            "target": target,
+            "result_data": json.dumps(result),
+            "triggered_by": "command",
+            "command_id": command_id  # lets admission control check it
+        }, command_id=command_id)
+
+        if result_id is None:
+            self.log(f"Could not save the result of command #{command_id}, kept in outbox")
+            return
+
+        if not result.get("success"):
+            self.log(f"{test_type} FAILED: {result.get('error')} (Result ID: {result_id})")
+        elif test_type == "speedtest":
+            self.log(f"Speedtest completed! Download: {result['download_mbps']} Mbps, "
+                     f"Upload: {result['upload_mbps']} Mbps, Ping: {result['ping_ms']} ms")
+        elif test_type == "traceroute":
+            self.log(f"Traceroute completed, hops: {result['hop_count']} (Result ID: {result_id})")
+        elif test_type == "throughput":
+            self.log(f"Throughput test completed! Download: {result.get('download_mbps')} Mbps, "
+                     f"Upload: {result.get('upload_mbps')} Mbps")
+        elif test_type == "monitor":
+            self.log(f"Monitor for {target} completed, loss {result['loss_pct']}%")
         else:
-            print("Failed to save result")
-    
-    else:
-        print(f"   Unknown command type: {command_type}")
-        # Mark as failed
-        requests.post(
-            f"{SERVER_URL}/commands/{command_id}/complete",
-            params={"status": "failed"}
-        )
-
-def execute_schedule(schedule):
-    """Executes a scheduled test"""
-    schedule_id = schedule["id"]
-    test_type = schedule["test_type"]
-    target = schedule.get("target")
-    parameters = schedule.get("parameters")
-    
-    print(f"Running scheduled test #{schedule_id}: {test_type}")
-    
-    # Parse parameters if they exist
-    if parameters:
-        params = json.loads(parameters)
-    else:
-        params = {}
-    
-    # Add target to params if it exists
-    if target:
-        params["target"] = target
-    
-    # Run the test (reuse the logic from execute_command)
-    if test_type == "ping":
-        target = params.get("target", "google.com")
-        count = params.get("count", 4)
-        print(f"Pinging {target} ({count} packets)...")
-        result = ping_test(target, count)
-        
-    elif test_type == "speedtest":
-        print(f"Running speedtest (30-60 seconds)...")
-        result = speedtest_test()
-        target = result.get("server_location", "N/A")
-        
-    elif test_type == "traceroute":
-        target = params.get("target", "google.com")
-        max_hops = params.get("max_hops", 30)
-        print(f"Tracing route to {target}...")
-        result = traceroute_test(target, max_hops)
-        
-    else:
-        print(f"Unknown test type: {test_type}")
-        return
-    
-    # Save result to server
-    response = requests.post(
-        f"{SERVER_URL}/tests/results",
-        params={
-            "device_id": DEVICE_ID,
+            self.log(f"Command completed! Result ID: {result_id}")
+
+    def run_monitor(self, command_id: int, target: str, params: dict):
+        """
+        Runs a monitor and streams its summaries to the server in batches
+
+        Summaries are buffered, if an upload fails they go out with the next one.
+        What still can't be uploaded at the end goes into the command result
+        ("unsent_summaries").
+        """
+        duration = params.get("duration", 300)
+        interval = params.get("interval", 0.2)
+        report_every = params.get("report_every", 10)
+
+        # (sequence number, summary): a full buffer drops the oldest while an
+        # upload is in flight, so an upload only removes what it really sent
+        pending = deque(maxlen=MONITOR_UPLOAD_BUFFER)
+        pending_lock = threading.Lock()
+        sequence = itertools.count(1)
+        upload_lock = threading.Lock()
+
+        def flush(wait: bool = False):
+            # Only one upload at a time, whatever is left goes with the next one
+            if not upload_lock.acquire(blocking=wait):
+                return
+            try:
+                with pending_lock:
+                    batch = list(pending)
+                if not batch:
+                    return
+                response = self.runner.post(
+                    "/monitor/summaries",
+                    params={"device_id": self.device_id, "target": target},
+                    json=[summary for _, summary in batch]
+                )
+                if response.status_code == 200:
+                    sent = batch[-1][0]
+                    with pending_lock:
+                        while pending and pending[0][0] <= sent:
+                            pending.popleft()
+                else:
+                    self.log(f"Monitor upload failed ({response.status_code}), {len(pending)} summaries buffered")
+            except requests.RequestException as e:
+                self.log(f"Monitor upload failed ({len(pending)} summaries buffered): {e}")
+            finally:
+                upload_lock.release()
+
+        def on_summary(summary):
+            with pending_lock:
+                pending.append((next(sequence), summary))
+            # Upload in the shared HTTP pool without holding up the probes
+            self.runner.http_pool.submit(flush)
+
+        result = monitor_test(target, duration, interval, report_every, on_summary=on_summary)
+
+        #Send whatever is left (after an upload still in flight), with a few retries
+        for attempt in range(MONITOR_FINAL_ATTEMPTS):
+            if attempt:
+                time.sleep(2 ** attempt)
+            flush(wait=True)
+            if not pending:
+                break
+        else:
+            self.log(f"Could not upload {len(pending)} monitor summaries, keeping them in the result")
+            result["unsent_summaries"] = [summary for _, summary in pending]
+
+        #Save the summary over the whole run as a normal test result
+        self.save_command_result(command_id, "monitor", target, result)
+
+    def execute_schedule(self, schedule, ran_at: str):
+        """Executes a scheduled test"""
+        schedule_id = schedule["id"]
+        test_type = schedule["test_type"]
+        target = schedule.get("target")
+        parameters = schedule.get("parameters")
+
+        self.log(f"Running scheduled test #{schedule_id}: {test_type}")
+
+        # Parse parameters if they exist
+        if parameters:
+            params = json.loads(parameters)
+        else:
+            params = {}
+
+        # Add target to params if it exists
+        if target:
+            params["target"] = target
+
+        test = self.run_test(test_type, params)
+
+        if test is None:
+            self.log(f"Unknown test type: {test_type}")
+            return
+
+        target, result = test
+
+        # Save result to server (or keep it in the outbox if it can't be reached)
+        result_id = self.upload_result({
+            "device_id": self.device_id,
             "test_type": test_type,
             "target": target,
             "result_data": json.dumps(result),
             "triggered_by": "schedule"  # ← Mark as scheduled!
-        }
-    )
-    
-    if response.status_code == 200:
+        }, schedule_id, ran_at)
+
+        if result_id is None:
+            self.log(f"Server unreachable, result for schedule #{schedule_id} kept in outbox")
+        elif result.get("success"):
+            self.log(f"Scheduled test completed! Result ID: {result_id}")
+        else:
+            self.log("Test failed but result saved")
+
+    def upload_result(self, params: dict, schedule_id: int = None, ran_at: str = None, command_id: int = None):
+        """
+        Saves a result on the server and marks its schedule as ran / its
+        command as completed
+
+        Returns: the result id, or None if it went to the outbox
+        """
+        # The server asked us to slow down, keep it for later
+        if time.monotonic() < self.retry_at:
+            self.outbox.append((params, schedule_id, ran_at, command_id))
+            return None
+
+        try:
+            response = self.runner.post("/tests/results", params=params)
+        except requests.RequestException:
+            response = None
+
+        if response is not None and response.status_code == 429:
+            self.retry_at = time.monotonic() + float(response.headers.get("Retry-After", 1))
+
+        if response is None or response.status_code != 200:
+            self.outbox.append((params, schedule_id, ran_at, command_id))
+            return None
+
         result_id = response.json()["result"]["id"]
-        
+
         # Update the schedule's last_run time
-        requests.post(f"{SERVER_URL}/schedules/{schedule_id}/ran")
-        
-        if result.get("success"):
-            print(f"Scheduled test completed! Result ID: {result_id}")
-        else:
-            print(f"Test failed but result saved")
+        if schedule_id is not None:
+            try:
+                self.runner.post(f"/schedules/{schedule_id}/ran", params={"ran_at": ran_at})
+            except requests.RequestException:
+                pass
+
+        # Mark command as completed
+        if command_id is not None:
+            try:
+                self.runner.post(
+                    f"/commands/{command_id}/complete",
+                    params={"result_id": result_id, "status": "completed"}
+                )
+            except requests.RequestException:
+                self.log(f"Result of command #{command_id} saved, but it couldn't be marked completed")
+
+        return result_id
+
+    def flush_outbox(self):
+        """ Uploads results that were kept while the server was unreachable """
+        if not self.outbox or time.monotonic() < self.retry_at:
+            return
+
+        self.log(f"Uploading {len(self.outbox)} result(s) from the outbox")
+        for _ in range(len(self.outbox)):
+            params, schedule_id, ran_at, command_id = self.outbox.popleft()
+            if self.upload_result(params, schedule_id, ran_at, command_id) is None:
+                # Still down, it went back into the outbox
+                break
+
+    def load_schedule_cache(self):
+        """ Loads the schedules we had last time, so they run even if the server is down """
+        if not os.path.exists(self.cache_file):
+            return
+
+        try:
+            with open(self.cache_file) as f:
+                cache = json.load(f)
+        except (OSError, ValueError) as e:
+            self.log(f"Ignoring schedule cache: {e}")
+            return
+
+        self.schedule_version = cache["version"]
+        for schedule in cache["schedules"]:
+            self.schedules[schedule["id"]] = schedule
+            self.plan_schedule(schedule["id"], cache["next_runs"].get(str(schedule["id"])))
+
+        self.log(f"Loaded {len(self.schedules)} schedule(s) from cache (version {self.schedule_version})")
+
+    def save_schedule_cache(self):
+        """ Writes the schedules and their next run times to disk """
+        cache = {
+            "version": self.schedule_version,
+            "schedules": list(self.schedules.values()),
+            "next_runs": self.next_runs
+        }
+
+        # Write + rename so a crash never leaves half a file
+        temp_file = self.cache_file + ".tmp"
+        with open(temp_file, "w") as f:
+            json.dump(cache, f)
+        os.replace(temp_file, self.cache_file)
+
+    def fetch_schedule_changes(self):
+        """ Fetches the schedules that changed since our version (delta sync) """
+        try:
+            response = self.runner.get(
+                f"/schedules/sync/{self.device_id}",
+                params={"since": self.schedule_version}
+            )
+        except requests.RequestException:
+            return None
+
+        if response.status_code != 200:
+            return None
+
+        return response.json()
+
+    def apply_schedule_changes(self, data: dict):
+        """ Applies a schedule delta to the local cache (runs on the event loop) """
+        if data["version"] == self.schedule_version and not data["full"]:
+            return
+
+        if data["full"]:
+            # The server wants us to start over
+            for schedule_id in list(self.schedules):
+                self.remove_schedule(schedule_id)
+
+        for schedule in data["schedules"]:
+            if schedule["enabled"]:
+                self.update_schedule(schedule)
+            else:
+                self.remove_schedule(schedule["id"])
+
+        for schedule_id in data["deleted"]:
+            self.remove_schedule(schedule_id)
+
+        self.log(f"Schedules synced: version {self.schedule_version} -> {data['version']}, "
+                 f"{len(self.schedules)} active")
+        self.schedule_version = data["version"]
+        self.save_schedule_cache()
+
+    def update_schedule(self, schedule):
+        """ Adds or changes a schedule in the local cache """
+        old = self.schedules.get(schedule["id"])
+        self.schedules[schedule["id"]] = schedule
+
+        # Keep the timer unless the interval changed
+        if old and old["interval_seconds"] == schedule["interval_seconds"] and schedule["id"] in self.next_runs:
+            return
+
+        first_run = time.time()
+        if schedule.get("last_run"):
+            first_run = datetime.fromisoformat(schedule["last_run"]).timestamp() + schedule["interval_seconds"]
+        self.plan_schedule(schedule["id"], first_run)
+
+    def remove_schedule(self, schedule_id: int):
+        """ Drops a schedule, its heap entry is skipped when it comes up """
+        self.schedules.pop(schedule_id, None)
+        self.next_runs.pop(schedule_id, None)
+
+    def plan_schedule(self, schedule_id: int, run_at: float = None):
+        """ Plans the next run of a schedule """
+        run_at = run_at if run_at is not None else time.time()
+        self.next_runs[schedule_id] = run_at
+        self.runner.plan(self.device_id, schedule_id, run_at)
+
+    def run_schedule(self, schedule_id: int, due: float, now: float):
+        """
+        Starts a schedule that came up on the heap
+
+        Returns: True if the schedule was still planned for this time
+        """
+        # Removed or rescheduled since this entry was pushed
+        if self.next_runs.get(schedule_id) != due:
+            return False
+
+        schedule = self.schedules[schedule_id]
+
+        # Stay on the interval grid, skip runs we missed (e.g. while the agent was off)
+        next_run = due + schedule["interval_seconds"]
+        while next_run <= now:
+            next_run += schedule["interval_seconds"]
+        self.plan_schedule(schedule_id, next_run)
+
+        ran_at = datetime.fromtimestamp(due).isoformat()
+        key = (self.device_id, "schedule", schedule_id)
+        if not self.runner.submit_test(key, self.execute_schedule, schedule, ran_at):
+            self.log(f"Schedule #{schedule_id} is still running, skipping this run")
+
+        return True
+
+def load_config(path: str):
+    """ Builds an AgentRunner from a JSON config file (see the top of this file) """
+    with open(path) as f:
+        config = json.load(f)
+
+    runner = AgentRunner(
+        server_url=config.get("server_url", SERVER_URL),
+        test_workers=config.get("test_workers", TEST_WORKERS),
+        http_workers=config.get("http_workers", HTTP_WORKERS),
+        cache_dir=config.get("cache_dir", ".")
+    )
+
+    for device in config["devices"]:
+        count = device.get("count")
+        if count is None:
+            runner.add_agent(device["device_id"], device.get("name", device["device_id"]))
+            continue
+
+        for n in range(1, count + 1):
+            device_id = device["device_id"].replace("{n}", str(n))
+            name = device.get("name", device["device_id"]).replace("{n}", str(n))
+            runner.add_agent(device_id, name)
+
+    return runner
+
+if __name__ == "__main__":
+    if len(sys.argv) > 1:
+        runner = load_config(sys.argv[1])
     else:
-        print(f"Failed to save result")
-
-
-try:
-    while True:
-        # Send heartbeat
-        if heartbeat_counter >= HEARTBEAT_INTERVAL:
-            response = requests.post(f"{SERVER_URL}/devices/{DEVICE_ID}/heartbeat")
-            if response.status_code == 200:
-                print(f"Heartbeat sent")
-            heartbeat_counter = 0
-        
-        # Check for commands AND schedules
-        if command_check_counter >= CHECK_COMMANDS_INTERVAL:
-            response = requests.get(f"{SERVER_URL}/commands/pending/{DEVICE_ID}")
-            
-            if response.status_code == 200:
-                data = response.json()
-                if data["count"] > 0:
-                    print(f"\nFound {data['count']} pending command(s)")
-                    for command in data["commands"]:
-                        execute_command(command)
-                        
-            response = requests.get(f"{SERVER_URL}/schedules/due/{DEVICE_ID}")
-            if response.status_code == 200:
-                data = response.json()
-                if data["count"] > 0:
-                    print(f"\nFound scheduled test(s) due to run")
-                    for schedule in data["schedules"]:
-                        execute_schedule(schedule)
-            
-            command_check_counter = 0
-        
-        # Wait 1 second
-        time.sleep(1)
-        heartbeat_counter += 1
-        command_check_counter += 1
-        
-except KeyboardInterrupt:
-    print("\n\nAgent stopped")
\ No newline at end of file
+        runner = AgentRunner()
+        runner.add_agent(DEVICE_ID, DEVICE_NAME)
+
+    print(f"Starting agent with {len(runner.agents)} device(s)")
+    runner.start()
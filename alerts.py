@@ -0,0 +1,246 @@
+"""
+alerts.py - Anomaly detection and threshold alerts on ingest
+
+Every result is checked against the streaming baseline of its
+(device, target, test_type) in stats.py, before the result updates it:
+
+- latency_high: RTT far above the EWMA (LATENCY_STD_FACTOR standard
+  deviations and LATENCY_MIN_RATIO times the mean)
+- loss_spike: loss of LOSS_SPIKE_PCT or more where there usually is none
+- hop_change: a traceroute with a different hop count than the last one
+- rule:<id>: user thresholds from the alert_rules table (kept in memory)
+
+Baseline checks wait for WARMUP_RESULTS results. An alert is emitted once,
+when its condition starts, and resolved when a later result is fine again.
+Alerts go to the alerts table (storage.db), the dashboard (GET /alerts) and, if
+SNUTZ_ALERT_WEBHOOK_URL is set, are POSTed there from a background thread.
+
+Checking a result is O(1): one baseline lookup and the rules of its metrics.
+"""
+
+import json
+import os
+import queue
+import threading
+import urllib.request
+
+import stats
+import storage
+
+WEBHOOK_URL = os.environ.get("SNUTZ_ALERT_WEBHOOK_URL", "")
+WEBHOOK_TIMEOUT = 5
+WEBHOOK_QUEUE_SIZE = 1000
+
+WARMUP_RESULTS = 20
+LATENCY_STD_FACTOR = 4
+LATENCY_MIN_RATIO = 1.5
+LOSS_SPIKE_PCT = 20.0
+
+OPERATORS = {
+    ">": lambda value, threshold: value > threshold,
+    ">=": lambda value, threshold: value >= threshold,
+    "<": lambda value, threshold: value < threshold,
+    "<=": lambda value, threshold: value <= threshold,
+}
+
+rules_by_metric = {}  # metric -> list of rule dicts
+active = {}           # (device_id, target, test_type) -> {kind: {"id", "metric"}}
+alerts_lock = threading.Lock()
+
+webhook_queue = queue.Queue(maxsize=WEBHOOK_QUEUE_SIZE)
+webhook_thread = None
+
+def load_rules(rules: list):
+    """ Caches the enabled alert rules (call again after every change) """
+    by_metric = {}
+    for rule in rules:
+        if rule["enabled"]:
+            by_metric.setdefault(rule["metric"], []).append(rule)
+
+    global rules_by_metric
+    rules_by_metric = by_metric
+
+def load_active(alerts: list):
+    """ Restores the unresolved alerts at startup, so they aren't emitted again """
+    with alerts_lock:
+        for alert in alerts:
+            key = (alert["device_id"], alert["target"], alert["test_type"])
+            active.setdefault(key, {})[alert["kind"]] = {"id": alert["id"], "metric": alert["metric"]}
+
+def detect_anomalies(test_type: str, metrics: dict, baseline: dict):
+    """
+    Compares a result with its baseline
+
+    Returns: {kind: {"metric", "value", "baseline", "message"}} of the
+    conditions this result is in
+    """
+    conditions = {}
+    if baseline is None or baseline["results"] < WARMUP_RESULTS:
+        return conditions
+
+    rtt = metrics.get("rtt_ms")
+    base = baseline["metrics"].get("rtt_ms")
+    if rtt is not None and base and base["mean"] is not None:
+        limit = max(base["mean"] + LATENCY_STD_FACTOR * base["std"], base["mean"] * LATENCY_MIN_RATIO)
+        if rtt > limit:
+            conditions["latency_high"] = {
+                "metric": "rtt_ms",
+                "value": rtt,
+                "baseline": base["mean"],
+                "message": f"RTT {rtt:.1f} ms, baseline {base['mean']:.1f} ms (±{base['std']:.1f})"
+            }
+
+    loss = metrics.get("loss_pct")
+    base = baseline["metrics"].get("loss_pct")
+    if loss is not None and base and base["mean"] is not None:
+        if loss >= LOSS_SPIKE_PCT and base["mean"] < LOSS_SPIKE_PCT / 2:
+            conditions["loss_spike"] = {
+                "metric": "loss_pct",
+                "value": loss,
+                "baseline": base["mean"],
+                "message": f"{loss:.0f}% loss, baseline {base['mean']:.1f}%"
+            }
+
+    hops = metrics.get("hop_count")
+    base = baseline["metrics"].get("hop_count")
+    if test_type == "traceroute" and hops is not None and base and base["last"] is not None:
+        if hops != base["last"]:
+            conditions["hop_change"] = {
+                "metric": "hop_count",
+                "value": hops,
+                "baseline": base["last"],
+                "message": f"Path changed from {base['last']:.0f} to {hops:.0f} hops"
+            }
+
+    return conditions
+
+def match_rules(device_id: str, target: str, test_type: str, metrics: dict):
+    """ Returns: {"rule:<id>": condition} of the user thresholds this result crosses """
+    conditions = {}
+
+    for metric, value in metrics.items():
+        if value is None or metric == "success":
+            continue
+
+        for rule in rules_by_metric.get(metric, ()):
+            if rule["device_id"] and rule["device_id"] != device_id:
+                continue
+            if rule["target"] and rule["target"] != target:
+                continue
+            if rule["test_type"] and rule["test_type"] != test_type:
+                continue
+
+            if OPERATORS[rule["operator"]](value, rule["threshold"]):
+                conditions[f"rule:{rule['id']}"] = {
+                    "metric": metric,
+                    "value": value,
+                    "baseline": rule["threshold"],
+                    "rule_id": rule["id"],
+                    "message": f"{metric} {value:g} {rule['operator']} {rule['threshold']:g} (rule {rule['id']})"
+                }
+
+    return conditions
+
+def check_result(device_id: str, target: str, test_type: str, metrics: dict, timestamp: str):
+    """
+    Alerting stage of ingest, call before stats.record_result
+
+    Returns: list of the alerts this result started
+    """
+    key = (device_id, target or "", test_type)
+    baseline = stats.get_baseline(*key)
+
+    conditions = detect_anomalies(test_type, metrics, baseline)
+    conditions.update(match_rules(device_id, key[1], test_type, metrics))
+
+    started = []
+    resolved = []
+    entries = {}  # kind -> active entry of the alerts this result starts
+
+    with alerts_lock:
+        current = active.get(key, {})
+
+        for kind, condition in conditions.items():
+            if kind not in current:
+                current[kind] = entries[kind] = {"id": None, "metric": condition["metric"]}
+                started.append((kind, condition))
+
+        # Conditions we could check with this result and that are over now
+        for kind, alert in list(current.items()):
+            if kind not in conditions and metrics.get(alert["metric"]) is not None:
+                del current[kind]
+                if alert["id"] is None:
+                    # Still being saved, the saver resolves it (below)
+                    alert["resolved_at"] = timestamp
+                else:
+                    resolved.append(alert["id"])
+
+        if current:
+            active[key] = current
+        else:
+            active.pop(key, None)
+
+    for alert_id in resolved:
+        storage.db.resolve_alert(alert_id, timestamp)
+
+    new_alerts = []
+    for kind, condition in started:
+        alert = storage.db.save_alert(
+            device_id,
+            key[1],
+            test_type,
+            kind,
+            condition["metric"],
+            condition["value"],
+            condition["baseline"],
+            condition["message"],
+            condition.get("rule_id"),
+            timestamp
+        )
+
+        with alerts_lock:
+            entry = entries[kind]
+            entry["id"] = alert["id"]
+            resolved_at = entry.get("resolved_at")
+
+        # A later result ended it while we were saving
+        if resolved_at is not None:
+            storage.db.resolve_alert(alert["id"], resolved_at)
+
+        print(f"ALERT {device_id} -> {key[1]} ({test_type}): {condition['message']}")
+        send_webhook(alert)
+        new_alerts.append(alert)
+
+    return new_alerts
+
+def send_webhook(alert: dict):
+    """ Queues an alert for the webhook (never blocks ingest) """
+    if not WEBHOOK_URL:
+        return
+
+    global webhook_thread
+    with alerts_lock:
+        if webhook_thread is None:
+            webhook_thread = threading.Thread(target=webhook_worker, daemon=True)
+            webhook_thread.start()
+
+    try:
+        webhook_queue.put_nowait(alert)
+    except queue.Full:
+        print(f"Webhook queue full, dropped alert {alert['id']}")
+
+def webhook_worker():
+    """ POSTs the queued alerts to the webhook one by one """
+    while True:
+        alert = webhook_queue.get()
+        request = urllib.request.Request(
+            WEBHOOK_URL,
+            data=json.dumps(alert).encode(),
+            headers={"Content-Type": "application/json"},
+            method="POST"
+        )
+
+        try:
+            urllib.request.urlopen(request, timeout=WEBHOOK_TIMEOUT).close()
+        except OSError as e:
+            print(f"Webhook failed for alert {alert['id']}: {e}")
@@ -0,0 +1,395 @@
+"""
+bench_database.py - Micro-benchmarks for the database.py hot paths
+
+Seeds a fresh database of a given size, times every database.py function
+and compares the medians with the baselines in bench_baseline.json.
+Exits with 1 if a function got slower than the threshold allows.
+
+    python bench_database.py                              # 10k results, 10 devices
+    python bench_database.py --results 1000000 --devices 1000
+    python bench_database.py --save-baseline              # record new baselines
+    python bench_database.py --ingest --shards 1,2,4,8    # write scaling with SNUTZ_SHARDS
+
+Baselines are stored per size ("10000 results / 10 devices"), so sizes
+don't mix. Every run also times a fixed calibration workload in the same
+process, between the benchmarked functions (SQLite reads with a
+connection each like database.py, and small committed writes to a file);
+its medians are saved with the baseline. The baseline times are scaled by how
+much slower or faster the calibration ran: reads by the read part, writes
+by the commit part. So a uniformly slower machine doesn't show up as a
+regression, but the calibration can't even out everything (other disks,
+cache sizes). For a strict comparison, record the baseline on the same
+host from the base commit:
+
+    git stash / git checkout <base>
+    python bench_database.py --save-baseline --baseline /tmp/base.json
+    git checkout - / git stash pop
+    python bench_database.py --baseline /tmp/base.json
+"""
+
+import argparse
+import contextlib
+import gc
+import json
+import multiprocessing
+import os
+import random
+import sqlite3
+import statistics
+import sys
+import tempfile
+import time
+from datetime import datetime, timedelta
+
+import database
+
+BASELINE_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "bench_baseline.json")
+TEST_TYPES = ["ping", "traceroute", "speedtest", "throughput"]
+SEED_BATCH = 50_000
+ROUNDS = 5  # the calls of a function are split in rounds, the best round counts
+NOISE_FLOOR_MS = 0.25  # differences below this are noise (fsync, scheduler), never a regression
+
+# Functions that commit a write, their baselines scale with the commit calibration
+WRITES = {"register_device", "update_heartbeat", "save_test_result", "create_command",
+          "update_command_status", "update_schedule_last_run", "sweep_offline_devices"}
+
+RESULT_DATA = json.dumps({
+    "success": True,
+    "target": "8.8.8.8",
+    "packets_sent": 4,
+    "summary": ["4 packets transmitted, 4 received, 0% packet loss",
+                "rtt min/avg/max/mdev = 9.1/10.2/12.3/1.1 ms"]
+})
+
+def seed_database(path: str, results: int, devices: int, rng: random.Random):
+    """ Bulk-loads a database of the given size (much faster than the real functions) """
+    database.DB_FILE = path
+    with contextlib.redirect_stdout(open(os.devnull, "w")):
+        database.init_database()
+
+    conn = sqlite3.connect(path)
+    conn.execute("PRAGMA synchronous = OFF")
+    shards = [conn]
+    if database.SHARDS > 1:
+        shards = [sqlite3.connect(database.shard_path(shard)) for shard in range(database.SHARDS)]
+        for shard in shards:
+            shard.execute("PRAGMA synchronous = OFF")
+
+    now = datetime.now()
+    device_ids = [f"bench-{i}" for i in range(devices)]
+
+    conn.executemany(
+        "INSERT INTO devices (device_id, name, status, last_seen, registered_at) VALUES (?, ?, 'online', ?, ?)",
+        [(device_id, device_id, now.isoformat(), now.isoformat()) for device_id in device_ids]
+    )
+
+    # Three schedules per device, about a third of them due
+    schedules = []
+    for device_id in device_ids:
+        for test_type in TEST_TYPES[:3]:
+            last_run = now - timedelta(seconds=rng.choice([30, 600, 7200]))
+            schedules.append((device_id, test_type, "8.8.8.8", 3600, last_run.isoformat(), now.isoformat()))
+    conn.executemany("""
+        INSERT INTO schedules (device_id, test_type, target, interval_seconds, last_run, created_at)
+        VALUES (?, ?, ?, ?, ?, ?)
+    """, schedules)
+
+    # Results spread over the last 30 days, each on its device's shard
+    start = now - timedelta(days=30)
+    step = timedelta(days=30) / max(results, 1)
+    for offset in range(0, results, SEED_BATCH):
+        rows = [[] for _ in shards]
+        for i in range(offset, min(offset + SEED_BATCH, results)):
+            device_id = rng.choice(device_ids)
+            rows[database.shard_of(device_id)].append(
+                (device_id, rng.choice(TEST_TYPES), (start + step * i).isoformat(), "8.8.8.8", RESULT_DATA)
+            )
+        for shard, shard_rows in zip(shards, rows):
+            shard.executemany("""
+                INSERT INTO test_results (device_id, test_type, timestamp, target, result_data, triggered_by)
+                VALUES (?, ?, ?, ?, ?, 'schedule')
+            """, shard_rows)
+    
+    # A command history with a few pending ones per device
+    for i in range(min(results, devices * 20)):
+        device_id = rng.choice(device_ids)
+        shards[database.shard_of(device_id)].execute("""
+            INSERT INTO commands (device_id, command_type, parameters, status, created_at)
+            VALUES (?, 'ping', '{}', ?, ?)
+        """, (device_id, "pending" if i % 10 == 0 else "completed", (start + step * i).isoformat()))
+    
+    for shard in shards:
+        if shard is not conn:
+            shard.commit()
+            shard.close()
+    conn.commit()
+    conn.close()
+    return device_ids
+
+def calibration_workload(workdir: str):
+    """
+    Fixed reference work, timed between the benchmarks (see run_benchmarks)
+
+    Returns: {"read_ms": connection per query + SQLite reads + JSON, like database.py,
+              "commit_ms": small committed writes to a file in workdir} of functions
+    """
+    path = os.path.join(workdir, "calibrate.db")
+    disk = sqlite3.connect(path)
+    disk.execute("CREATE TABLE IF NOT EXISTS t (id INTEGER PRIMARY KEY, k TEXT, v TEXT)")
+    disk.execute("CREATE INDEX IF NOT EXISTS idx_t_k ON t (k)")
+    disk.executemany("INSERT INTO t (k, v) VALUES (?, ?)", [(f"k{i % 50}", RESULT_DATA) for i in range(2000)])
+    disk.commit()
+
+    def read():
+        for i in range(20):
+            conn = sqlite3.connect(path)
+            conn.row_factory = sqlite3.Row
+            rows = conn.execute("SELECT * FROM t WHERE k = ?", (f"k{i}",)).fetchall()
+            json.loads(json.dumps([dict(row) for row in rows]))
+            conn.close()
+
+    def commit():
+        for i in range(10):
+            disk.execute("INSERT INTO t (k, v) VALUES (?, ?)", (f"k{i}", RESULT_DATA))
+            disk.commit()
+
+    return {"read_ms": read, "commit_ms": commit}
+
+def scale_factors(calibration: dict, base_calibration: dict):
+    """ Returns: {"read": x, "commit": y}, how much slower this run is than the baseline's (1.0 if not calibrated) """
+    if not base_calibration:
+        return {"read": 1.0, "commit": 1.0}
+    return {
+        "read": calibration["read_ms"] / base_calibration["read_ms"],
+        "commit": calibration["commit_ms"] / base_calibration["commit_ms"]
+    }
+
+def scale_of(name: str, factors: dict):
+    return factors["commit" if name in WRITES else "read"]
+
+def benchmarks(device_ids: list, rng: random.Random):
+    """ The calls we time, each one is a function without arguments """
+    def device():
+        return rng.choice(device_ids)
+
+    return {
+        "register_device": lambda: database.register_device(device(), "Bench"),
+        "update_heartbeat": lambda: database.update_heartbeat(device()),
+        "get_device": lambda: database.get_device(device()),
+        "get_all_devices": lambda: database.get_all_devices(),
+        "save_test_result": lambda: database.save_test_result(device(), "ping", "8.8.8.8", RESULT_DATA, "schedule"),
+        "get_test_results": lambda: database.get_test_results(None, 50),
+        "get_test_results_device": lambda: database.get_test_results(device(), 50),
+        "create_command": lambda: database.create_command(device(), "ping", "{}"),
+        "get_pending_commands": lambda: database.get_pending_commands(device()),
+        "update_command_status": lambda: database.update_command_status(database.global_id(1, 0), "completed", 1),
+        "get_all_commands": lambda: database.get_all_commands(None, 50),
+        "get_schedules": lambda: database.get_schedules(device()),
+        "get_schedules_due_to_run": lambda: database.get_schedules_due_to_run(device()),
+        "get_schedule_changes": lambda: database.get_schedule_changes(device(), 0),
+        "update_schedule_last_run": lambda: database.update_schedule_last_run(1),
+        "sweep_offline_devices": lambda: database.sweep_offline_devices(90),
+        "get_device_status_counts": lambda: database.get_device_status_counts(),
+        "get_down_devices": lambda: database.get_down_devices(100),
+    }
+
+def run_benchmarks(device_ids: list, repeat: int, workload: dict, only: list = None):
+    """
+    Returns: ({name: {"median_ms", "p95_ms"}}, calibration)
+
+    The calibration workload runs between the functions, so it sees the
+    machine the way they did: calibration = {key: median ms}.
+    """
+    rng = random.Random(42)
+    report = {}
+    samples = {key: [] for key in workload}
+
+    def sample():
+        for key, work in workload.items():
+            started = time.perf_counter()
+            work()
+            samples[key].append((time.perf_counter() - started) * 1000)
+
+    # database.py prints on every connection, keep that out of the output
+    with contextlib.redirect_stdout(open(os.devnull, "w")):
+        for name, call in benchmarks(device_ids, rng).items():
+            if only and name not in only:
+                continue
+
+            call()  # warm up (page cache, statement cache)
+            sample()
+
+            # Best median of a few rounds, so one noisy moment doesn't count as a regression.
+            # No garbage collection while timing (like timeit), its pauses depend on the heap
+            rounds = []
+            for _ in range(ROUNDS):
+                timings = []
+                gc.disable()
+                for _ in range(max(1, repeat // ROUNDS)):
+                    started = time.perf_counter()
+                    call()
+                    timings.append((time.perf_counter() - started) * 1000)
+                gc.enable()
+                timings.sort()
+                rounds.append(timings)
+
+            best = min(rounds, key=statistics.median)
+            report[name] = {
+                "median_ms": round(statistics.median(best), 4),
+                "p95_ms": round(best[max(0, int(len(best) * 0.95) - 1)], 4)
+            }
+        sample()
+
+    return report, {key: round(statistics.median(times), 4) for key, times in samples.items()}
+
+def compare(report: dict, baseline: dict, threshold: float, factors: dict):
+    """
+    Returns: the names of the functions that regressed
+
+    The baseline column is the baseline scaled to this machine (scale_factors).
+    """
+    regressions = []
+
+    print(f"\n{'function':28} {'median ms':>10} {'p95 ms':>10} {'baseline':>10} {'change':>8}")
+    for name, timing in report.items():
+        base = baseline.get(name)
+        if base is None:
+            print(f"{name:28} {timing['median_ms']:>10} {timing['p95_ms']:>10} {'-':>10} {'':>8}")
+            continue
+
+        expected = round(base["median_ms"] * scale_of(name, factors), 4)
+        change = timing["median_ms"] / expected - 1 if expected else 0.0
+        regressed = change > threshold and timing["median_ms"] - expected > NOISE_FLOOR_MS
+        if regressed:
+            regressions.append(name)
+
+        print(f"{name:28} {timing['median_ms']:>10} {timing['p95_ms']:>10} {expected:>10} "
+              f"{change:>+7.0%}{' REGRESSION' if regressed else ''}")
+
+    return regressions
+
+def ingest_writer(path: str, shards: int, device_ids: list, deadline: float, counts):
+    """ One writer process: saves results as fast as it can until the deadline """
+    database.DB_FILE = path
+    database.SHARDS = shards
+    rng = random.Random(os.getpid())
+    saved = errors = 0
+    
+    with contextlib.redirect_stdout(open(os.devnull, "w")):
+        while time.time() < deadline:
+            try:
+                database.save_test_result(rng.choice(device_ids), "ping", "8.8.8.8", RESULT_DATA, "schedule")
+                saved += 1
+            except sqlite3.OperationalError:
+                errors += 1  # "database is locked" after the busy timeout
+    
+    counts.put((saved, errors))
+
+def run_ingest(shard_counts: list, writers: int, devices: int, duration: float):
+    """
+    Ingest scaling: writers processes save results for duration seconds,
+    once per shard count (like server workers sharing one database)
+    
+    Returns: list of {"shards", "rows_per_s", "errors"}
+    """
+    report = []
+    
+    for shards in shard_counts:
+        with tempfile.TemporaryDirectory() as workdir:
+            database.SHARDS = shards
+            device_ids = seed_database(os.path.join(workdir, "bench.db"), 0, devices, random.Random(1))
+            
+            counts = multiprocessing.Queue()
+            deadline = time.time() + duration
+            processes = [
+                multiprocessing.Process(target=ingest_writer,
+                                        args=(database.DB_FILE, shards, device_ids, deadline, counts))
+                for _ in range(writers)
+            ]
+            for process in processes:
+                process.start()
+            results = [counts.get() for _ in processes]
+            for process in processes:
+                process.join()
+        
+        saved = sum(r[0] for r in results)
+        errors = sum(r[1] for r in results)
+        report.append({"shards": shards, "rows_per_s": round(saved / duration), "errors": errors})
+        print(f"{shards:>3} shard(s): {saved / duration:>8.0f} rows/s, {errors} lock errors")
+    
+    return report
+
+def main():
+    parser = argparse.ArgumentParser(description="Micro-benchmarks for database.py")
+    parser.add_argument("--results", type=int, default=10_000, help="test results to seed")
+    parser.add_argument("--devices", type=int, default=10, help="devices to seed")
+    parser.add_argument("--repeat", type=int, default=200, help="timed calls per function")
+    parser.add_argument("--only", help="comma separated functions to run")
+    parser.add_argument("--threshold", type=float, default=0.5, help="allowed slowdown (0.5 = 50%%)")
+    parser.add_argument("--baseline", default=BASELINE_FILE, help="baseline file")
+    parser.add_argument("--save-baseline", action="store_true", help="store this run as the baseline")
+    parser.add_argument("--shards", default=str(database.SHARDS),
+                        help="SNUTZ_SHARDS to run with (comma separated list with --ingest)")
+    parser.add_argument("--ingest", action="store_true", help="measure write throughput per shard count")
+    parser.add_argument("--writers", type=int, default=8, help="writer processes for --ingest")
+    parser.add_argument("--duration", type=float, default=5, help="seconds per shard count for --ingest")
+    args = parser.parse_args()
+
+    if args.ingest:
+        shard_counts = [int(k) for k in args.shards.split(",")]
+        print(f"Ingest: {args.writers} writers, {args.devices} devices, {args.duration}s per shard count")
+        run_ingest(shard_counts, args.writers, args.devices, args.duration)
+        return
+
+    database.SHARDS = int(args.shards)
+    size = f"{args.results} results / {args.devices} devices"
+    if database.SHARDS > 1:
+        size += f" / {database.SHARDS} shards"
+    only = args.only.split(",") if args.only else None
+
+    with tempfile.TemporaryDirectory() as workdir:
+        print(f"Seeding {size}...")
+        started = time.perf_counter()
+        device_ids = seed_database(os.path.join(workdir, "bench.db"), args.results, args.devices, random.Random(1))
+        print(f"Seeded in {time.perf_counter() - started:.1f}s, running {args.repeat} calls per function")
+
+        report, calibration = run_benchmarks(device_ids, args.repeat, calibration_workload(workdir), only)
+
+    baselines = {}
+    if os.path.exists(args.baseline):
+        with open(args.baseline) as f:
+            baselines = json.load(f)
+
+    baseline = dict(baselines.get(size, {}))
+    base_calibration = baseline.pop("_calibration", None)
+    factors = scale_factors(calibration, base_calibration)
+
+    print(f"Calibration: reads {calibration['read_ms']} ms, commits {calibration['commit_ms']} ms")
+    if base_calibration:
+        print(f"Baseline scaled to this run: reads x{factors['read']:.2f}, writes x{factors['commit']:.2f}")
+    elif baseline:
+        print("The baseline has no calibration, comparing absolute times (record it again with --save-baseline)")
+
+    regressions = compare(report, baseline, args.threshold, factors)
+
+    if args.save_baseline:
+        # Functions this run didn't time (--only) are kept, moved to this run's calibration
+        kept = {
+            name: {key: round(value * scale_of(name, factors), 4) for key, value in timing.items()}
+            for name, timing in baseline.items() if name not in report
+        }
+        baselines[size] = {**kept, **report, "_calibration": calibration}
+        with open(args.baseline, "w") as f:
+            json.dump(baselines, f, indent=2, sort_keys=True)
+            f.write("\n")
+        print(f"\nBaseline for {size} saved to {args.baseline}")
+        return
+
+    if regressions:
+        print(f"\n{len(regressions)} regression(s) over {args.threshold:.0%}: {', '.join(regressions)}")
+        sys.exit(1)
+
+    print("\nNo regressions")
+
+if __name__ == "__main__":
+    main()
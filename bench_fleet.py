@@ -0,0 +1,394 @@
+"""
+bench_fleet.py - Fleet load simulation for server.py / database.py
+
+Starts the server locally (uvicorn, fresh database) and simulates N virtual
+agents with asyncio: every agent has its own keep-alive connection and
+heartbeats, polls commands + schedule changes and uploads results at the
+same ratio as agent.py (time is sped up by --speedup).
+
+Reports throughput and p50/p95/p99 latency per endpoint plus SQLite lock
+errors (503s), for every storage configuration x fleet size, so you can
+see where one instance saturates.
+
+    python bench_fleet.py --fleet 10,100,500 --duration 20
+    python bench_fleet.py --storage sqlite --fleet 50 --json results.json
+    python bench_fleet.py --backlog 200        # reconnect storm: every agent drains 200 results
+    python bench_fleet.py --storage sqlite --workers 0,1,2,4   # cluster.py worker sweep (0 = plain uvicorn)
+
+With --backlog, 429 answers (admission control) are counted as throttled,
+not as errors, and the agents wait for Retry-After like agent.py does.
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import random
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+import urllib.request
+from urllib.parse import urlencode
+
+# Same timing as agent.py, one result upload per RESULT_INTERVAL
+HEARTBEAT_INTERVAL = 30
+CHECK_COMMANDS_INTERVAL = 10
+RESULT_INTERVAL = 60
+
+# Environment for the server process, per storage configuration
+STORAGE_CONFIGS = {
+    "sqlite": {},
+    "sqlite-4-shards": {"SNUTZ_SHARDS": "4"},
+    "memory": {"SNUTZ_STORAGE": "memory"},
+}
+
+# A realistic result payload (structured traceroute, ~1.5 KB)
+RESULT_DATA = json.dumps({
+    "success": True,
+    "target": "8.8.8.8",
+    "address": "8.8.8.8",
+    "max_hops": 30,
+    "hops": [
+        {"ttl": ttl, "address": f"10.0.{ttl}.1", "rtts": [1.1 * ttl, 1.2 * ttl, 1.3 * ttl], "loss_pct": 0.0}
+        for ttl in range(1, 13)
+    ],
+    "hop_count": 12,
+    "duration_ms": 35.2
+})
+
+class HttpConnection:
+    """
+    Minimal HTTP/1.1 keep-alive client on asyncio streams
+
+    Enough for our JSON endpoints and cheap enough that the benchmark
+    measures the server, not the client.
+    """
+
+    def __init__(self, host: str, port: int):
+        self.host = host
+        self.port = port
+        self.reader = None
+        self.writer = None
+
+    async def request(self, method: str, path: str, params: dict = None, with_retry_after: bool = False):
+        """ Returns: (status, body), plus the Retry-After seconds if with_retry_after """
+        if self.writer is None:
+            self.reader, self.writer = await asyncio.open_connection(self.host, self.port)
+
+        if params:
+            path += "?" + urlencode(params)
+
+        self.writer.write(
+            f"{method} {path} HTTP/1.1\r\nHost: {self.host}\r\nContent-Length: 0\r\n\r\n".encode()
+        )
+
+        try:
+            await self.writer.drain()
+            status_line = await self.reader.readline()
+            if not status_line:
+                raise ConnectionError("server closed the connection")
+
+            length = 0
+            retry_after = 1.0
+            keep_alive = True
+            while True:
+                line = await self.reader.readline()
+                if line in (b"\r\n", b""):
+                    break
+                name, _, value = line.decode().partition(":")
+                name = name.strip().lower()
+                if name == "content-length":
+                    length = int(value)
+                elif name == "connection" and value.strip().lower() == "close":
+                    keep_alive = False
+                elif name == "retry-after":
+                    retry_after = float(value)
+
+            body = await self.reader.readexactly(length)
+        except (ConnectionError, asyncio.IncompleteReadError):
+            self.close()
+            raise
+
+        if not keep_alive:
+            self.close()
+
+        if with_retry_after:
+            return int(status_line.split()[1]), body, retry_after
+        return int(status_line.split()[1]), body
+
+    def close(self):
+        if self.writer:
+            self.writer.close()
+        self.reader = self.writer = None
+
+class Stats:
+    """ Latencies and errors per endpoint """
+
+    def __init__(self):
+        self.latencies = {}
+        self.errors = {}
+        self.throttled = {}
+        self.lock_errors = 0
+
+    def record(self, endpoint: str, latency: float, status: int, body: bytes):
+        if status == 200:
+            self.latencies.setdefault(endpoint, []).append(latency)
+            return
+
+        if status == 429:
+            self.throttled[endpoint] = self.throttled.get(endpoint, 0) + 1
+            return
+
+        self.errors[endpoint] = self.errors.get(endpoint, 0) + 1
+        if status == 503 and b"locked" in body:
+            self.lock_errors += 1
+
+    def record_failure(self, endpoint: str):
+        self.errors[endpoint] = self.errors.get(endpoint, 0) + 1
+
+    def report(self, duration: float):
+        endpoints = {}
+        for endpoint in sorted(set(self.latencies) | set(self.errors) | set(self.throttled)):
+            latencies = sorted(self.latencies.get(endpoint, []))
+            endpoints[endpoint] = {
+                "requests": len(latencies),
+                "rps": round(len(latencies) / duration, 1),
+                "p50_ms": percentile(latencies, 50),
+                "p95_ms": percentile(latencies, 95),
+                "p99_ms": percentile(latencies, 99),
+                "errors": self.errors.get(endpoint, 0),
+                "throttled": self.throttled.get(endpoint, 0)
+            }
+
+        total = sum(e["requests"] for e in endpoints.values())
+        return {
+            "requests": total,
+            "rps": round(total / duration, 1),
+            "errors": sum(self.errors.values()),
+            "throttled": sum(self.throttled.values()),
+            "lock_errors": self.lock_errors,
+            "endpoints": endpoints
+        }
+
+def percentile(values: list, pct: float):
+    """ pct-th percentile of a sorted list, in ms """
+    if not values:
+        return None
+    return round(values[min(len(values) - 1, int(len(values) * pct / 100))] * 1000, 2)
+
+async def virtual_agent(host: str, port: int, device_id: str, stats: Stats,
+                        deadline: float, speedup: float):
+    """ One simulated agent: heartbeats, polls and uploads on agent.py's timing """
+    connection = HttpConnection(host, port)
+
+    async def call(endpoint, method, path, params=None):
+        """ Returns: the body of a 200, None otherwise """
+        started = time.perf_counter()
+        try:
+            status, body = await connection.request(method, path, params)
+        except (OSError, ConnectionError, asyncio.IncompleteReadError):
+            stats.record_failure(endpoint)
+            return None
+        stats.record(endpoint, time.perf_counter() - started, status, body)
+        return body if status == 200 else None
+
+    # Every task starts at a random point of its interval, like a real fleet
+    now = time.monotonic()
+    next_heartbeat = now + random.uniform(0, HEARTBEAT_INTERVAL / speedup)
+    next_check = now + random.uniform(0, CHECK_COMMANDS_INTERVAL / speedup)
+    next_result = now + random.uniform(0, RESULT_INTERVAL / speedup)
+    schedule_version = 0
+
+    while True:
+        now = time.monotonic()
+        if now >= deadline:
+            break
+
+        if now >= next_heartbeat:
+            await call("POST /devices/{id}/heartbeat", "POST", f"/devices/{device_id}/heartbeat")
+            next_heartbeat += HEARTBEAT_INTERVAL / speedup
+
+        if now >= next_check:
+            await call("GET /commands/pending/{id}", "GET", f"/commands/pending/{device_id}")
+            # Delta sync like agent.py: send back the version we got last time
+            body = await call("GET /schedules/sync/{id}", "GET", f"/schedules/sync/{device_id}",
+                              {"since": schedule_version})
+            if body is not None:
+                schedule_version = json.loads(body)["version"]
+            next_check += CHECK_COMMANDS_INTERVAL / speedup
+
+        if now >= next_result:
+            await call("POST /tests/results", "POST", "/tests/results", {
+                "device_id": device_id,
+                "test_type": "traceroute",
+                "target": "8.8.8.8",
+                "result_data": RESULT_DATA,
+                "triggered_by": "schedule"
+            })
+            next_result += RESULT_INTERVAL / speedup
+
+        wait = min(next_heartbeat, next_check, next_result) - time.monotonic()
+        await asyncio.sleep(max(0, wait))
+
+    connection.close()
+
+async def drain_backlog(host: str, port: int, device_id: str, stats: Stats, deadline: float, backlog: int):
+    """ Uploads an outbox of backlog results as fast as the server lets us (honours Retry-After) """
+    connection = HttpConnection(host, port)
+    endpoint = "POST /tests/results (backlog)"
+    params = {
+        "device_id": device_id,
+        "test_type": "traceroute",
+        "target": "8.8.8.8",
+        "result_data": RESULT_DATA,
+        "triggered_by": "schedule"
+    }
+
+    while backlog and time.monotonic() < deadline:
+        started = time.perf_counter()
+        try:
+            status, body, retry_after = await connection.request("POST", "/tests/results", params, True)
+        except (OSError, ConnectionError, asyncio.IncompleteReadError):
+            stats.record_failure(endpoint)
+            await asyncio.sleep(1)
+            continue
+
+        stats.record(endpoint, time.perf_counter() - started, status, body)
+        if status == 200:
+            backlog -= 1
+        elif status == 429:
+            await asyncio.sleep(min(retry_after, max(0, deadline - time.monotonic())))
+
+    connection.close()
+
+async def run_fleet(host: str, port: int, fleet: int, duration: float, speedup: float, backlog: int = 0):
+    """ Registers the fleet and runs it for duration seconds """
+    connection = HttpConnection(host, port)
+    for i in range(fleet):
+        await connection.request("POST", "/devices/register", {"device_id": f"bench-{i}", "name": f"Bench {i}"})
+    connection.close()
+
+    stats = Stats()
+    started = time.monotonic()
+    await asyncio.gather(*[
+        virtual_agent(host, port, f"bench-{i}", stats, started + duration, speedup)
+        for i in range(fleet)
+    ], *[
+        drain_backlog(host, port, f"bench-{i}", stats, started + duration, backlog)
+        for i in range(fleet) if backlog
+    ])
+
+    report = stats.report(time.monotonic() - started)
+
+    # What the fleet should have sent if the server kept up
+    report["offered_rps"] = round(fleet * speedup * (
+        1 / HEARTBEAT_INTERVAL + 2 / CHECK_COMMANDS_INTERVAL + 1 / RESULT_INTERVAL
+    ), 1)
+    return report
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+def start_server(storage: str, workdir: str, extra_env: dict = None, workers: int = 0):
+    """ Starts server.py with a fresh database in workdir (with cluster.py if workers) """
+    port = free_port()
+    env = dict(os.environ)
+    env.update(STORAGE_CONFIGS[storage])
+    env.update(extra_env or {})
+    env["SNUTZ_DB"] = os.path.join(workdir, "snutz.db")
+    env["SNUTZ_THROUGHPUT_PORT"] = "0"
+
+    if workers:
+        command = [sys.executable, "cluster.py", "--workers", str(workers), "--port", str(port),
+                   "--socket", os.path.join(workdir, "hub.sock"), "--log-level", "warning"]
+    else:
+        command = [sys.executable, "-m", "uvicorn", "server:app", "--port", str(port), "--log-level", "warning"]
+
+    process = subprocess.Popen(
+        command,
+        cwd=os.path.dirname(os.path.abspath(__file__)),
+        env=env,
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.DEVNULL
+    )
+
+    # Wait until it answers
+    for _ in range(300):
+        try:
+            urllib.request.urlopen(f"http://127.0.0.1:{port}/", timeout=1)
+            return process, port
+        except OSError:
+            time.sleep(0.1)
+
+    process.kill()
+    raise RuntimeError(f"server ({storage}) did not start")
+
+def print_report(storage: str, fleet: int, report: dict):
+    print(f"\n== {storage}, {fleet} agents: {report['rps']} req/s "
+          f"(offered {report['offered_rps']}), errors {report['errors']}, "
+          f"lock errors {report['lock_errors']}, throttled {report['throttled']}")
+    print(f"   {'endpoint':34} {'req/s':>8} {'p50 ms':>8} {'p95 ms':>8} {'p99 ms':>8} {'errors':>7} {'429s':>7}")
+    for endpoint, e in report["endpoints"].items():
+        print(f"   {endpoint:34} {e['rps']:>8} {str(e['p50_ms']):>8} "
+              f"{str(e['p95_ms']):>8} {str(e['p99_ms']):>8} {e['errors']:>7} {e['throttled']:>7}")
+
+def main():
+    parser = argparse.ArgumentParser(description="Simulate a fleet of agents against a local server")
+    parser.add_argument("--fleet", default="10,50,100", help="comma separated fleet sizes to sweep")
+    parser.add_argument("--storage", default=",".join(STORAGE_CONFIGS),
+                        help=f"comma separated storage configs ({', '.join(STORAGE_CONFIGS)})")
+    parser.add_argument("--duration", type=float, default=20, help="seconds per run")
+    parser.add_argument("--speedup", type=float, default=10, help="run agent timers this much faster")
+    parser.add_argument("--backlog", type=int, default=0, help="results every agent drains at the start")
+    parser.add_argument("--env", action="append", default=[], metavar="NAME=VALUE",
+                        help="extra server environment, e.g. SNUTZ_INGEST_RATE=0")
+    parser.add_argument("--workers", default="0",
+                        help="comma separated cluster.py worker counts to sweep (0 = one uvicorn process)")
+    parser.add_argument("--json", help="also write the results to this file")
+    args = parser.parse_args()
+
+    results = []
+    setups = []
+
+    for storage in args.storage.split(","):
+        for workers in [int(count) for count in args.workers.split(",")]:
+            if workers and storage not in ("sqlite", "sqlite-4-shards"):
+                print(f"Skipping {storage} with {workers} workers, cluster mode needs SQLite")
+                continue
+
+            setup = f"{storage}, {workers} workers" if workers else storage
+            setups.append(setup)
+
+            for fleet in [int(size) for size in args.fleet.split(",")]:
+                with tempfile.TemporaryDirectory() as workdir:
+                    process, port = start_server(storage, workdir, dict(e.split("=", 1) for e in args.env), workers)
+                    try:
+                        report = asyncio.run(run_fleet("127.0.0.1", port, fleet, args.duration, args.speedup,
+                                                       args.backlog))
+                    finally:
+                        process.terminate()
+                        process.wait()
+
+                print_report(setup, fleet, report)
+                results.append({"storage": setup, "fleet": fleet, "workers": workers, **report})
+
+    # Saturation: the first fleet size where the server no longer keeps up
+    print()
+    for storage in setups:
+        runs = [r for r in results if r["storage"] == storage]
+        saturated = [r for r in runs if r["rps"] < 0.9 * r["offered_rps"] or r["errors"]]
+        if saturated:
+            print(f"{storage}: saturates at ~{saturated[0]['fleet']} agents ({saturated[0]['rps']} req/s)")
+        else:
+            print(f"{storage}: kept up with every fleet size (max {runs[-1]['rps']} req/s)")
+
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(results, f, indent=2)
+
+if __name__ == "__main__":
+    main()
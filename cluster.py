@@ -0,0 +1,465 @@
+"""
+cluster.py - Multi-process server mode
+
+    python cluster.py --workers 4 --port 8000
+
+Starts a hub (this process) and a uvicorn server with --workers HTTP
+worker processes. They talk over a Unix socket (SNUTZ_CLUSTER_SOCKET):
+
+- Write funneling: endpoints decorated with @funnel (every write but
+  heartbeats, and the /stats reads) don't run in the workers, the worker
+  sends the call to the hub and returns the hub's answer. So one process
+  owns the writes, the streaming stats, alerts, the sweeper and the stats
+  checkpoints, exactly like the single-process server.
+- Heartbeats, the bulk of the traffic, are answered by the workers: each
+  one collects them for BATCH_INTERVAL (Batcher) and sends the hub one
+  notify() per batch, without waiting for it. The hub writes the batches
+  that arrive together in one transaction (GroupCommit), so the database
+  still has a single writer.
+- Reads run in the workers, straight from the SQLite files (the hub
+  switches them to WAL, so readers and the writer don't block each other).
+- Cache invalidation: workers cache what agents poll (pending commands,
+  see cached()). The hub broadcasts invalidate(key) to every worker after
+  a write changed it.
+- Agent notification: an invalidation also wakes the requests waiting for
+  that key (GET /commands/pending/{id}?wait=...), on whichever worker the
+  agent's long poll landed.
+
+Without SNUTZ_CLUSTER_SOCKET (plain "uvicorn server:app") the same calls
+work in-process: funnel is a no-op, invalidate() clears the local cache
+and wakes local waiters.
+
+A funneled call the hub doesn't answer within CALL_TIMEOUT fails with
+HubTimeout (504 from server.py), but the hub still runs it. Funneled
+writes aren't idempotent: a client that retries after a 504 can store a
+result twice.
+
+Cluster mode needs the sqlite engine (SNUTZ_STORAGE=sqlite): memory
+engines would be one per process. Admission control (admission.py) and
+request profiling are per worker.
+"""
+
+import argparse
+import asyncio
+import functools
+import json
+import os
+import signal
+import socket
+import sqlite3
+import struct
+import subprocess
+import sys
+import tempfile
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor
+from concurrent.futures import TimeoutError as FutureTimeout
+
+from fastapi.responses import Response
+
+import database
+
+SOCKET_PATH = os.environ.get("SNUTZ_CLUSTER_SOCKET", "")
+WORKER = bool(SOCKET_PATH)   # set in the HTTP workers by the hub
+HUB_THREADS = 32             # funneled calls the hub runs at once
+CALL_TIMEOUT = 30            # seconds a worker waits for the hub
+MAX_POLL_WAIT = 60           # longest long poll
+BATCH_INTERVAL = 0.02        # seconds a worker collects heartbeats before sending them
+
+HEADER = struct.Struct(">I")  # every message: length, then JSON
+
+funneled = {}       # name -> endpoint function (the hub runs these)
+cache = {}          # key -> value
+generations = {}    # key -> times invalidated
+waiters = {}        # key -> list of (loop, asyncio.Event)
+cache_lock = threading.Lock()
+
+hub = None          # the Hub, in the hub process
+client = None       # the HubClient, in a worker
+
+class HubTimeout(Exception):
+    """ The hub didn't answer a funneled call in time (it may still run it) """
+
+# Funneling
+
+def funnel(function):
+    """
+    Endpoint decorator: in a worker the call runs in the hub
+
+    The arguments and the return value must be JSON (or a Response).
+    """
+    funneled[function.__name__] = function
+    if not WORKER:
+        return function
+
+    @functools.wraps(function)
+    def forward(**kwargs):
+        return client.call(function.__name__, kwargs)
+
+    return forward
+
+def in_hub(function):
+    """ Registers a function notify() can run in the hub """
+    funneled[function.__name__] = function
+    return function
+
+def notify(function, **kwargs):
+    """ Runs an @in_hub function in the hub without waiting for it (in-process without a hub) """
+    if not WORKER:
+        function(**kwargs)
+        return
+    client.send(function.__name__, kwargs)
+
+def run_funneled(name: str, kwargs: dict):
+    """ Runs a funneled endpoint (in the hub) and makes its result sendable """
+    try:
+        result = funneled[name](**kwargs)
+    except Exception as e:
+        if database.is_busy(e):
+            return {"error": str(e), "type": "OperationalError"}
+        print(f"Funneled call {name} failed: {e!r}")
+        return {"error": repr(e), "type": "Exception"}
+
+    if isinstance(result, Response):
+        return {"response": {
+            "status_code": result.status_code,
+            "content": result.body.decode(),
+            "media_type": result.media_type,
+            "headers": {k: v for k, v in result.headers.items() if k.lower() == "retry-after"}
+        }}
+    return {"result": result}
+
+class GroupCommit:
+    """
+    Batches concurrent calls: the first caller runs function(items) for
+    everyone who arrived meanwhile, the others wait for their result
+
+    function gets a list of items and returns {item: result}.
+    """
+
+    def __init__(self, function):
+        self.function = function
+        self.lock = threading.Lock()
+        self.pending = []
+        self.running = False
+
+    def submit(self, item):
+        future = Future()
+        with self.lock:
+            self.pending.append((item, future))
+            leader = not self.running
+            self.running = True
+
+        if leader:
+            self.drain()
+        return future.result()
+
+    def submit_many(self, items: list):
+        """ Returns: {item: result} """
+        futures = []
+        with self.lock:
+            for item in items:
+                future = Future()
+                self.pending.append((item, future))
+                futures.append((item, future))
+            leader = not self.running
+            self.running = True
+
+        if leader:
+            self.drain()
+        return {item: future.result() for item, future in futures}
+
+    def drain(self):
+        while True:
+            with self.lock:
+                batch, self.pending = self.pending, []
+                if not batch:
+                    self.running = False
+                    return
+
+            try:
+                results = self.function([item for item, _ in batch])
+            except Exception as e:
+                for _, future in batch:
+                    future.set_exception(e)
+                continue
+
+            for item, future in batch:
+                future.set_result(results.get(item))
+
+class Batcher:
+    """
+    Collects items in a worker and hands them to an @in_hub function,
+    function(items=[...]), at most once per interval without waiting for it
+    """
+
+    def __init__(self, function, interval: float = BATCH_INTERVAL):
+        self.function = function
+        self.interval = interval
+        self.lock = threading.Lock()
+        self.pending = []
+        self.timer = None
+
+    def add(self, item):
+        with self.lock:
+            self.pending.append(item)
+            if self.timer is None:
+                self.timer = threading.Timer(self.interval, self.flush)
+                self.timer.daemon = True
+                self.timer.start()
+
+    def flush(self):
+        with self.lock:
+            batch, self.pending = self.pending, []
+            self.timer = None
+
+        if batch:
+            notify(self.function, items=batch)
+
+# Cache and notifications
+
+def cached(key: str, loader, *args):
+    """ loader(*args), cached until invalidate(key) """
+    with cache_lock:
+        if key in cache:
+            return cache[key]
+        generation = generations.get(key, 0)
+
+    value = loader(*args)
+
+    # Don't keep what was read before an invalidation that came in meanwhile
+    with cache_lock:
+        if generations.get(key, 0) == generation:
+            cache[key] = value
+    return value
+
+def generation(key: str):
+    with cache_lock:
+        return generations.get(key, 0)
+
+def invalidate(key: str):
+    """ Drops a cached key and wakes its waiters, in every process of the cluster """
+    with cache_lock:
+        generations[key] = generations.get(key, 0) + 1
+        cache.pop(key, None)
+        woken = waiters.pop(key, [])
+
+    for loop, event in woken:
+        loop.call_soon_threadsafe(event.set)
+
+    if hub is not None:
+        hub.broadcast({"invalidate": key})
+
+async def wait_for(key: str, timeout: float, since: int):
+    """ Waits up to timeout seconds for invalidate(key), returns at once if it came after since """
+    event = asyncio.Event()
+    with cache_lock:
+        if generations.get(key, 0) != since:
+            return
+        waiters.setdefault(key, []).append((asyncio.get_running_loop(), event))
+
+    try:
+        await asyncio.wait_for(event.wait(), min(timeout, MAX_POLL_WAIT))
+    except asyncio.TimeoutError:
+        with cache_lock:
+            entries = waiters.get(key, [])
+            entries[:] = [entry for entry in entries if entry[1] is not event]
+            if not entries:
+                waiters.pop(key, None)
+
+# Messages
+
+def encode(message: dict):
+    data = json.dumps(message).encode()
+    return HEADER.pack(len(data)) + data
+
+def read_message(stream):
+    """ Reads one message from a blocking file object, None at EOF """
+    header = stream.read(HEADER.size)
+    if len(header) < HEADER.size:
+        return None
+    return json.loads(stream.read(HEADER.unpack(header)[0]))
+
+# Worker side
+
+class HubClient:
+    """ A worker's connection to the hub, safe to call from any thread """
+
+    def __init__(self, path: str):
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.connect(path)
+        self.stream = self.sock.makefile("rb")
+        self.send_lock = threading.Lock()
+        self.calls = {}  # id -> Future
+        self.next_id = 0
+        self.reader = threading.Thread(target=self.read_loop, daemon=True)
+        self.reader.start()
+
+    def call(self, name: str, kwargs: dict):
+        future = Future()
+        with self.send_lock:
+            self.next_id += 1
+            call_id = self.next_id
+            self.calls[call_id] = future
+            self.sock.sendall(encode({"id": call_id, "call": name, "kwargs": kwargs}))
+
+        try:
+            reply = future.result(CALL_TIMEOUT)
+        except FutureTimeout:
+            with self.send_lock:
+                self.calls.pop(call_id, None)
+            raise HubTimeout(f"No answer from the hub for {name} in {CALL_TIMEOUT} s")
+
+        if "response" in reply:
+            return Response(**reply["response"])
+        if reply.get("type") == "OperationalError":
+            raise sqlite3.OperationalError(reply["error"])
+        if "error" in reply:
+            raise RuntimeError(f"Hub: {reply['error']}")
+        return reply["result"]
+
+    def send(self, name: str, kwargs: dict):
+        """ A call the hub doesn't answer (notify) """
+        with self.send_lock:
+            self.sock.sendall(encode({"id": None, "call": name, "kwargs": kwargs}))
+
+    def read_loop(self):
+        while True:
+            try:
+                message = read_message(self.stream)
+            except (OSError, ValueError):
+                message = None
+
+            if message is None:
+                print("Lost the connection to the hub, exiting")
+                os._exit(1)  # uvicorn starts a fresh worker
+
+            if "invalidate" in message:
+                invalidate(message["invalidate"])
+            else:
+                with self.send_lock:
+                    future = self.calls.pop(message["id"], None)
+                if future is not None:  # None: the call timed out
+                    future.set_result(message)
+
+    def close(self):
+        self.sock.close()
+
+def connect():
+    """ Connects a worker to the hub (server.py lifespan) """
+    global client
+    client = HubClient(SOCKET_PATH)
+    print(f"Worker {os.getpid()} connected to the hub")
+
+# Hub side
+
+class Hub:
+    """ Runs the funneled calls of every worker and broadcasts invalidations """
+
+    def __init__(self, loop):
+        self.loop = loop
+        self.pool = ThreadPoolExecutor(max_workers=HUB_THREADS, thread_name_prefix="hub")
+        self.writers = set()
+
+    async def handle_worker(self, reader, writer):
+        self.writers.add(writer)
+        try:
+            while True:
+                try:
+                    header = await reader.readexactly(HEADER.size)
+                    message = json.loads(await reader.readexactly(HEADER.unpack(header)[0]))
+                except asyncio.IncompleteReadError:
+                    break
+
+                asyncio.create_task(self.run_call(writer, message))
+        finally:
+            self.writers.discard(writer)
+            writer.close()
+
+    async def run_call(self, writer, message: dict):
+        reply = await self.loop.run_in_executor(self.pool, run_funneled, message["call"], message["kwargs"])
+        if message["id"] is None:
+            return  # notify()
+        reply["id"] = message["id"]
+        try:
+            data = encode(reply)
+        except (TypeError, ValueError) as e:
+            data = encode({"id": message["id"], "error": repr(e), "type": "Exception"})
+
+        if not writer.is_closing():
+            writer.write(data)
+
+    def broadcast(self, message: dict):
+        """ Sends a message to every worker (from any thread) """
+        data = encode(message)
+
+        def send():
+            for writer in list(self.writers):
+                if not writer.is_closing():
+                    writer.write(data)
+
+        self.loop.call_soon_threadsafe(send)
+
+def enable_wal():
+    """ WAL lets the workers read while the hub writes """
+    paths = {database.DB_FILE} | {database.shard_path(shard) for shard in range(database.SHARDS)}
+    for path in sorted(paths):
+        conn = sqlite3.connect(path)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.close()
+
+async def run_hub(args):
+    global hub
+    import server
+    import storage
+
+    if storage.STORAGE != "sqlite":
+        sys.exit(f"Cluster mode needs SNUTZ_STORAGE=sqlite, not {storage.STORAGE}")
+
+    path = args.socket or os.path.join(tempfile.gettempdir(), f"snutz-{os.getpid()}.sock")
+    if os.path.exists(path):
+        os.unlink(path)
+
+    loop = asyncio.get_running_loop()
+    stop = asyncio.Event()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(sig, stop.set)
+
+    async with server.lifespan(server.app):
+        enable_wal()
+        hub = Hub(loop)
+        unix_server = await asyncio.start_unix_server(hub.handle_worker, path)
+
+        env = dict(os.environ, SNUTZ_CLUSTER_SOCKET=path)
+        workers = subprocess.Popen(
+            [sys.executable, "-m", "uvicorn", "server:app", "--host", args.host, "--port", str(args.port),
+             "--workers", str(args.workers), "--log-level", args.log_level],
+            cwd=os.path.dirname(os.path.abspath(__file__)),
+            env=env
+        )
+        print(f"Hub on {path}, {args.workers} workers on {args.host}:{args.port}")
+
+        exited = loop.run_in_executor(None, workers.wait)
+        await asyncio.wait([exited, asyncio.ensure_future(stop.wait())], return_when=asyncio.FIRST_COMPLETED)
+
+        if workers.poll() is None:
+            workers.terminate()
+            await exited
+
+        unix_server.close()  # removes the socket file too
+
+def main():
+    parser = argparse.ArgumentParser(description="Run the server with several worker processes")
+    parser.add_argument("--workers", type=int, default=os.cpu_count(), help="HTTP worker processes")
+    parser.add_argument("--host", default="0.0.0.0")
+    parser.add_argument("--port", type=int, default=8000)
+    parser.add_argument("--socket", default=SOCKET_PATH, help="Unix socket of the hub (default: a temp file)")
+    parser.add_argument("--log-level", default="info")
+    args = parser.parse_args()
+
+    asyncio.run(run_hub(args))
+
+if __name__ == "__main__":
+    # Run the module server.py imports, not this __main__ copy of it
+    import cluster
+    cluster.main()
@@ -1,69 +1,70 @@
 const API_URL = "http://localhost:8000";
 
 /**
- * Loads devices from the server and displays them
+ * Loads the dashboard summary from the server (devices, latest results and
+ * success rates, one call) and displays it
  */
-async function loadDevices(){
-    // Get data from server
+async function loadSummary(){
     try {
-        //fetch data from the /devices endpoint
-        const response = await fetch(`${API_URL}/devices`);
+        //fetch data from the /dashboard/summary endpoint
+        const response = await fetch(`${API_URL}/dashboard/summary`);
 
         //convert response to JSON
         const data = await response.json();
 
         //log the data
-        console.log('Devices: ', data);
-
-        //build html table
-        let tableHTML = `
-            <table>
-                <tr>
-                    <th>Device ID</th>
-                    <th>Name</th>
-                    <th>Status</th>
-                    <th>Last Seen</th>
-                </tr>`
-
-        //Loop through each deviec and add a row
-        data.devices.forEach(device =>{
-            //Check if device is online (seen in last 60 seconds)
-            const lastSeenDate = new Date(device.last_seen);
-            const now = new Date();
-            const secondsAgo = (now - lastSeenDate) / 1000;
-            const isOnline = secondsAgo < 60;
-
-            //Choose status color and text
-            const statusClass = isOnline ? 'status-online' : 'status-offline'
-            const statusText = isOnline ? 'ONLINE' : 'OFFLINE'
-
-            //format timestamp
-            const lastSeenText = secondsAgo < 60 ? Math.floor(secondsAgo) + 'seconds ago' : Math.floor(secondsAgo / 60) + ' minutes ago';
-
-            //Add a row for this device
-            tableHTML += `
-            <tr>
-                <td><strong>${device.device_id}</strong></td>
-                <td>${device.name}</td>
-                <td class="${statusClass}">${statusText}</td>
-                <td>${lastSeenText}</td>
-            </tr>`
-        })
-
-        tableHTML += '</table>';
+        console.log('Summary: ', data);
 
-        //Find the devices card and update its content
-        const devicesCard = document.querySelector('.card');
-        devicesCard.innerHTML = '<h2>Registered Devices</h2>' + tableHTML
+        showDevices(data.devices)
+        showLatestResults(data.devices)
+        showSuccessRates(data.success_rates)
 
         //Update dropdown select in command center
         updateDeviceDropdown(data.devices);
     } catch (error) {
-        console.error("Error loading devices: ", error)
+        console.error("Error loading summary: ", error)
         alert('Error: Could not connect to server. Is it running?')
     }
+}
+
+/**
+ * Displays the devices table
+ */
+function showDevices(devices){
+    //build html table
+    let tableHTML = `
+        <table>
+            <tr>
+                <th>Device ID</th>
+                <th>Name</th>
+                <th>Status</th>
+                <th>Last Seen</th>
+            </tr>`
+
+    //Loop through each deviec and add a row
+    devices.forEach(device =>{
+        //The server sets devices offline when they stop sending heartbeats
+        const isOnline = device.status === 'online';
+
+        //Choose status color and text
+        const statusClass = isOnline ? 'status-online' : 'status-offline'
+        const statusText = isOnline ? 'ONLINE' : 'OFFLINE'
+
+        //Add a row for this device
+        tableHTML += `
+        <tr>
+            <td><strong>${device.device_id}</strong></td>
+            <td>${device.name}</td>
+            <td class="${statusClass}">${statusText}</td>
+            <td>${getTimeAgo(new Date(device.last_seen))}</td>
+        </tr>`
+    })
 
+    tableHTML += '</table>';
 
+    //Find the devices card and update its content
+    const devicesCard = document.querySelector('.card');
+    devicesCard.innerHTML = '<h2>Registered Devices</h2>' + tableHTML
 }
 
 /**
@@ -97,18 +98,19 @@ async function runCommand() {
         alert("Please select a device!")
         return
     }
-    if((testType === 'ping' || testType == 'traceroute') && !target){
+    if((testType === 'ping' || testType == 'traceroute' || testType == 'monitor') && !target){
         alert("Please enter a target!")
         return
     }
     
     try {
         //Create the parameters object
+        let parameters
         if(testType === 'ping'){
-        const parameters = JSON.stringify({
-            target: target,
-            count: 4
-        })
+            parameters = JSON.stringify({
+                target: target,
+                count: 4
+            })
         }
         else if (testType === 'speedtest') {
             parameters = JSON.stringify({})
@@ -119,6 +121,20 @@ async function runCommand() {
                 max_hops: 30
             })
         }
+        else if (testType === 'throughput'){
+            parameters = JSON.stringify({
+                streams: 4,
+                duration: 10
+            })
+        }
+        else if (testType === 'monitor'){
+            parameters = JSON.stringify({
+                target: target,
+                duration: 300,
+                interval: 0.2,
+                report_every: 10
+            })
+        }
 
         //Build the URL with query parameters
         const url = `${API_URL}/commands/create?device_id=${deviceId}&command_type=${testType}&parameters=${encodeURIComponent(parameters)}`
@@ -145,67 +161,133 @@ async function runCommand() {
 }
 
 /**
- * Get test results
+ * Displays the latest result of every device and test type, newest first
  */
-async function loadTestResults() {
+function showLatestResults(devices) {
+    const results = [];
+    devices.forEach(device => {
+        Object.entries(device.latest).forEach(([testType, result]) => {
+            results.push({...result, device_id: device.device_id, test_type: testType});
+        });
+    });
+    results.sort((a, b) => b.timestamp.localeCompare(a.timestamp));
+
+    // Build table
+    let htmlTable = `
+    <table>
+        <tr>
+            <th>Test ID</th>
+            <th>Device ID</th>
+            <th>Test Type</th>
+            <th>Timestamp</th>
+            <th>Target</th>
+            <th>Result</th>
+        </tr>`;
+
+    results.forEach(result => {
+        // Choose color based on success
+        const resultClass = result.success ? 'status-online' : 'status-offline';
+        const resultText = result.success ? 'Success' : 'Failed';
+
+        // Monitor windows have no result of their own
+        const idCell = result.id === null ? '-' : `<a href="${API_URL}/tests/results/${result.id}" target="_blank">${result.id}</a>`;
+
+        // Add row for each result
+        htmlTable += `
+        <tr>
+            <td><strong>${idCell}</strong></td>
+            <td>${result.device_id}</td>
+            <td>${result.test_type}</td>
+            <td>${getTimeAgo(new Date(result.timestamp))}</td>
+            <td>${result.target}</td>
+            <td class="${resultClass}">${resultText}</td>
+        </tr>`;
+    });
+
+    htmlTable += "</table>";
+
+    // Inject to correct card
+    const resultCard = document.getElementById("test-results");
+    resultCard.innerHTML = "<h2>📊 Latest Test Results</h2>" + htmlTable;
+}
+
+/**
+ * Displays the fleet success rates per test type
+ */
+function showSuccessRates(rates) {
+    let htmlTable = `
+    <table>
+        <tr>
+            <th>Test Type</th>
+            <th>Devices Passing</th>
+            <th>Last Hour</th>
+        </tr>`;
+
+    Object.entries(rates).forEach(([testType, rate]) => {
+        const lastHour = rate.last_hour.success_rate === null
+            ? '-'
+            : `${(rate.last_hour.success_rate * 100).toFixed(1)}% of ${rate.last_hour.results}`;
+
+        htmlTable += `
+        <tr>
+            <td>${testType}</td>
+            <td>${rate.passing} / ${rate.devices}</td>
+            <td>${lastHour}</td>
+        </tr>`;
+    });
+
+    htmlTable += "</table>";
+    document.getElementById("success-rates").innerHTML = "<h2>✅ Success Rates</h2>" + htmlTable;
+}
+
+/**
+ * Get the latest alerts, unresolved ones in red
+ */
+async function loadAlerts() {
     try {
-        // Fetch data from server
-        const response = await fetch(`${API_URL}/tests/results`);
-        
-        // Convert response to JSON
+        const response = await fetch(`${API_URL}/alerts?limit=20`);
         const data = await response.json();
-        
-        const results = data.results;
-        const resultCount = data.count;
-        
-        // Log data
-        console.log('test-results:', data);
-        
-        // Build table
+
+        console.log('alerts:', data);
+
+        const alertCard = document.getElementById("alerts");
+        if (data.count === 0) {
+            alertCard.innerHTML = "<h2>🔔 Alerts</h2><p>No alerts...</p>";
+            return;
+        }
+
         let htmlTable = `
         <table>
             <tr>
-                <th>Test ID</th>
+                <th>When</th>
                 <th>Device ID</th>
-                <th>Test Type</th>
-                <th>Timestamp</th>
                 <th>Target</th>
-                <th>Result</th>
+                <th>Test Type</th>
+                <th>Alert</th>
+                <th>Status</th>
             </tr>`;
-        
-        results.forEach(result => {
-            // Parse the result_data JSON string
-            const resultData = JSON.parse(result.result_data);
-            const success = resultData.success;
-            
-            // Choose color based on success
-            const resultClass = success ? 'status-online' : 'status-offline';
-            const resultText = success ? 'Success' : 'Failed';
-            
-            // Format timestamp to be more readable
-            const date = new Date(result.timestamp);
-            const timeAgo = getTimeAgo(date);
-            
-            // Add row for each result
+
+        data.alerts.forEach(entry => {
+            const isActive = !entry.resolved_at;
+            const statusClass = isActive ? 'status-offline' : 'status-online';
+            const statusText = isActive ? 'ACTIVE' : 'Resolved';
+
             htmlTable += `
             <tr>
-                <td><strong>${result.id}</strong></td>
-                <td>${result.device_id}</td>
-                <td>${result.test_type}</td>
-                <td>${timeAgo}</td>
-                <td>${result.target}</td>
-                <td class="${resultClass}">${resultText}</td>
+                <td>${getTimeAgo(new Date(entry.created_at))}</td>
+                <td>${entry.device_id}</td>
+                <td>${entry.target}</td>
+                <td>${entry.test_type}</td>
+                <td>${entry.message}</td>
+                <td class="${statusClass}">${statusText}</td>
             </tr>`;
         });
-        
+
         htmlTable += "</table>";
-        
-        // Inject to correct card
-        const resultCard = document.getElementById("test-results");
-        resultCard.innerHTML = "<h2>📊 Recent Test Results</h2>" + htmlTable;
-        
+        alertCard.innerHTML = "<h2>🔔 Alerts</h2>" + htmlTable;
+
     } catch (error) {
-        console.error('Error loading test results:', error);
+        console.error('Error loading alerts:', error);
     }
 }
 
@@ -228,10 +310,10 @@ function getTimeAgo(date) {
 }
 
 
-// Load devices when page loads
+// Load everything when page loads
 function main() {
-    loadDevices()
-    loadTestResults()
+    loadSummary()
+    loadAlerts()
 }
 main()
 
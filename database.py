@@ -1,15 +1,121 @@
 import sqlite3
-from datetime import datetime
+import hashlib
+import heapq
+import itertools
+import json
+import os
+import threading
+import zlib
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+import profiling
 
-DB_FILE = "snutz.db"
+try:
+    from compression import zstd  # Python 3.14+
+except ImportError:
+    zstd = None
+
+DB_FILE = os.environ.get("SNUTZ_DB", "snutz.db")
+
+# Optional hash sharding for write scaling: test_results and commands are
+# spread over SHARDS files (snutz.shard0.db, ...) by crc32(device_id), the
+# small tables (devices, schedules, ...) stay in DB_FILE. Every shard has its
+# own write lock. Ids are global: local id * SHARDS + shard.
+# Changing SHARDS doesn't move existing rows, pick it before the first start.
+SHARDS = int(os.environ.get("SNUTZ_SHARDS", "1"))
+
+shard_pool = None
+shard_pool_lock = threading.Lock()
+
+# Raw command output (ping / traceroute stdout) is split off the result and
+# stored compressed in result_outputs, only GET /tests/results/{id} reads it
+OUTPUT_CODEC = "zstd" if zstd else "zlib"
+OUTPUT_MIN_SIZE = 64  # shorter outputs aren't worth compressing
+
+# Traceroute paths are stored once per shard in route_paths, keyed by a
+# fingerprint of the hop addresses; a traceroute result keeps the path_id
+# and its rtts per hop. A device's routes live with its results, so they're
+# written in the result's transaction. Paths never change, every process
+# caches the ROUTE_PATH_CACHE_SIZE most recently read ones.
+ROUTE_PATH_CACHE_SIZE = int(os.environ.get("SNUTZ_ROUTE_PATH_CACHE", "10000"))
+route_path_cache = OrderedDict()  # path_id -> hop addresses, least recently used first
+route_path_lock = threading.Lock()
+
+def is_busy(error: Exception):
+    """ True for the transient lock errors ("database is locked", "database table is locked") """
+    return isinstance(error, sqlite3.OperationalError) and str(error) in (
+        "database is locked", "database table is locked"
+    )
 
 def get_connection():
     """ Opens connection to DB """
     print("Connecting to db...")
-    connection = sqlite3.connect(DB_FILE)
+    connection = profiling.connect(DB_FILE)
+    connection.row_factory = sqlite3.Row
+    return connection
+
+def shard_path(shard: int):
+    """ File of a shard (DB_FILE itself when not sharded) """
+    if SHARDS == 1:
+        return DB_FILE
+    base, ext = os.path.splitext(DB_FILE)
+    return f"{base}.shard{shard}{ext or '.db'}"
+
+def shard_of(device_id: str):
+    """ Shard that holds a device's results and commands """
+    return zlib.crc32(device_id.encode()) % SHARDS
+
+def get_shard_connection(shard: int):
+    """ Opens connection to a shard """
+    print("Connecting to db...")
+    connection = profiling.connect(shard_path(shard))
     connection.row_factory = sqlite3.Row
     return connection
 
+def global_id(local_id: int, shard: int):
+    return local_id * SHARDS + shard
+
+def split_id(row_id: int):
+    """ Returns: (shard, local id) of a global id """
+    return row_id % SHARDS, row_id // SHARDS
+
+def query_shard(shard: int, query: str, params: tuple):
+    """ Runs a SELECT on one shard, ids in the rows are made global """
+    conn = get_shard_connection(shard)
+    cursor = conn.cursor()
+    cursor.execute(query, params)
+    
+    rows = []
+    for row in cursor.fetchall():
+        row = dict(row)
+        row["id"] = global_id(row["id"], shard)
+        rows.append(row)
+    
+    conn.close()
+    return rows
+
+def query_all_shards(query: str, params: tuple, key: str, limit: int):
+    """
+    Fleet-wide query: runs on every shard in parallel and merges the rows
+    
+    Params:
+    - query: SELECT ... ORDER BY <key> DESC LIMIT ? (the limit is per shard)
+    - key: column the shards sorted on
+    - limit: rows to return
+    """
+    if SHARDS == 1:
+        return query_shard(0, query, params)
+    
+    global shard_pool
+    with shard_pool_lock:
+        if shard_pool is None:
+            shard_pool = ThreadPoolExecutor(max_workers=SHARDS, thread_name_prefix="shard")
+    
+    per_shard = shard_pool.map(lambda shard: query_shard(shard, query, params), range(SHARDS))
+    merged = heapq.merge(*per_shard, key=lambda row: row[key], reverse=True)
+    return list(itertools.islice(merged, limit))
+
 def init_database():
     """ Creates the database tables if they don't exist """
     print("initializing database...")
@@ -28,6 +134,175 @@ def init_database():
         )
     """)
     
+    # The liveness sweeper and /devices/down look devices up by status and last_seen
+    cursor.execute("""
+        CREATE INDEX IF NOT EXISTS idx_devices_status_last_seen
+        ON devices (status, last_seen)
+    """)
+    
+    # DEVICE EVENTS TABLE (online / offline transitions)
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS device_events (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            device_id TEXT NOT NULL,
+            event TEXT NOT NULL,
+            timestamp TEXT NOT NULL,
+            last_seen TEXT
+        )
+    """)
+    
+    cursor.execute("""
+        CREATE INDEX IF NOT EXISTS idx_device_events_timestamp
+        ON device_events (timestamp)
+    """)
+    
+    cursor.execute("""
+        CREATE INDEX IF NOT EXISTS idx_device_events_device
+        ON device_events (device_id, timestamp)
+    """)
+    
+    if SHARDS == 1:
+        create_shard_tables(cursor)
+    else:
+        for shard in range(SHARDS):
+            shard_conn = get_shard_connection(shard)
+            create_shard_tables(shard_conn.cursor())
+            shard_conn.commit()
+            shard_conn.close()
+    
+    # COMMAND SCHEDULE TABLE
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS schedules (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            device_id TEXT NOT NULL,
+            test_type TEXT NOT NULL,
+            target TEXT,
+            interval_seconds INTEGER NOT NULL,
+            enabled INTERGER DEFAULT 1,
+            parameters TEXT,
+            last_run TEXT,
+            created_at TEXT NOT NULL,
+            FOREIGN KEY (device_id) REFERENCES devices (device_id)
+        )    
+    """)
+    
+    # MONITOR SUMMARY TABLE (one row per summary window, not per probe)
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS monitor_summaries (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            device_id TEXT NOT NULL,
+            target TEXT NOT NULL,
+            window_start TEXT NOT NULL,
+            window_end TEXT NOT NULL,
+            summary TEXT NOT NULL,
+            FOREIGN KEY (device_id) REFERENCES devices (device_id)
+        )
+    """)
+    
+    cursor.execute("""
+        CREATE INDEX IF NOT EXISTS idx_monitor_summaries_device
+        ON monitor_summaries (device_id, target, window_end)
+    """)
+    
+    # One row per window: an agent retrying after a lost response sends it again
+    cursor.execute("SELECT 1 FROM sqlite_master WHERE name = 'idx_monitor_summaries_window'")
+    if cursor.fetchone() is None:
+        cursor.execute("""
+            DELETE FROM monitor_summaries WHERE id NOT IN (
+                SELECT MIN(id) FROM monitor_summaries GROUP BY device_id, target, window_start
+            )
+        """)
+        cursor.execute("""
+            CREATE UNIQUE INDEX idx_monitor_summaries_window
+            ON monitor_summaries (device_id, target, window_start)
+        """)
+    
+    # SCHEDULE VERSIONS (agents sync "changed since version N")
+    add_column_if_missing(cursor, "schedules", "version", "INTEGER DEFAULT 0")
+    
+    cursor.execute("""
+        CREATE INDEX IF NOT EXISTS idx_schedules_device_version
+        ON schedules (device_id, version)
+    """)
+    
+    # Deleted schedules, so agents can drop them from their cache
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS schedule_tombstones (
+            schedule_id INTEGER PRIMARY KEY,
+            device_id TEXT NOT NULL,
+            version INTEGER NOT NULL
+        )
+    """)
+    
+    cursor.execute("""
+        CREATE INDEX IF NOT EXISTS idx_schedule_tombstones_device_version
+        ON schedule_tombstones (device_id, version)
+    """)
+    
+    # COUNTERS TABLE (e.g. the current schedule version)
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS counters (
+            name TEXT PRIMARY KEY,
+            value INTEGER NOT NULL
+        )
+    """)
+    
+    # TARGET STATS TABLE (checkpoints of stats.py, one row per device/target/test)
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS target_stats (
+            device_id TEXT NOT NULL,
+            target TEXT NOT NULL,
+            test_type TEXT NOT NULL,
+            data TEXT NOT NULL,
+            updated_at TEXT NOT NULL,
+            PRIMARY KEY (device_id, target, test_type)
+        )
+    """)
+    
+    # ALERTS TABLE (see alerts.py)
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS alerts (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            device_id TEXT NOT NULL,
+            target TEXT NOT NULL,
+            test_type TEXT NOT NULL,
+            kind TEXT NOT NULL,
+            metric TEXT NOT NULL,
+            value REAL,
+            baseline REAL,
+            message TEXT NOT NULL,
+            rule_id INTEGER,
+            created_at TEXT NOT NULL,
+            resolved_at TEXT
+        )
+    """)
+    
+    cursor.execute("""
+        CREATE INDEX IF NOT EXISTS idx_alerts_created
+        ON alerts (created_at)
+    """)
+    
+    # ALERT RULES TABLE (user thresholds, NULL device/target/test_type = any)
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS alert_rules (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            device_id TEXT,
+            target TEXT,
+            test_type TEXT,
+            metric TEXT NOT NULL,
+            operator TEXT NOT NULL,
+            threshold REAL NOT NULL,
+            enabled INTEGER DEFAULT 1,
+            created_at TEXT NOT NULL
+        )
+    """)
+    
+    conn.commit()
+    conn.close()
+    print("Database Initialized")
+    
+def create_shard_tables(cursor):
+    """ Creates the tables that live in every shard """
     # TEST RESULT TABLE
     cursor.execute("""
         CREATE TABLE IF NOT EXISTS test_results (
@@ -58,26 +333,93 @@ def init_database():
         )               
     """)
     
-    # COMMAND SCHEDULE TABLE
+    # RAW OUTPUTS TABLE (compressed "output" of a result, read on demand)
     cursor.execute("""
-        CREATE TABLE IF NOT EXISTS schedules (
+        CREATE TABLE IF NOT EXISTS result_outputs (
+            result_id INTEGER PRIMARY KEY,
+            codec TEXT NOT NULL,
+            size INTEGER NOT NULL,
+            data BLOB NOT NULL
+        )
+    """)
+    
+    # ROUTE PATHS TABLE (every distinct traceroute path of the shard once, hops = JSON list of addresses)
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS route_paths (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            fingerprint TEXT NOT NULL UNIQUE,
+            hops TEXT NOT NULL,
+            hop_count INTEGER NOT NULL,
+            first_seen TEXT NOT NULL
+        )
+    """)
+    
+    # ROUTE HOPS TABLE (inverted index: hop address -> paths through it)
+    # path ids here and in the tables below are global (like result ids)
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS route_hops (
+            address TEXT NOT NULL,
+            path_id INTEGER NOT NULL,
+            ttl INTEGER NOT NULL,
+            PRIMARY KEY (address, path_id, ttl)
+        ) WITHOUT ROWID
+    """)
+    
+    # DEVICE ROUTES TABLE (the current path of every device / target)
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS device_routes (
+            device_id TEXT NOT NULL,
+            target TEXT NOT NULL,
+            path_id INTEGER NOT NULL,
+            since TEXT NOT NULL,
+            last_seen TEXT NOT NULL,
+            PRIMARY KEY (device_id, target)
+        )
+    """)
+    
+    cursor.execute("""
+        CREATE INDEX IF NOT EXISTS idx_device_routes_path
+        ON device_routes (path_id)
+    """)
+    
+    # ROUTE CHANGES TABLE (old_path_id NULL = first path of a device / target)
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS route_changes (
             id INTEGER PRIMARY KEY AUTOINCREMENT,
             device_id TEXT NOT NULL,
-            test_type TEXT NOT NULL,
-            target TEXT,
-            interval_seconds INTEGER NOT NULL,
-            enabled INTERGER DEFAULT 1,
-            parameters TEXT,
-            last_run TEXT,
-            created_at TEXT NOT NULL,
-            FOREIGN KEY (device_id) REFERENCES devices (device_id)
-        )    
+            target TEXT NOT NULL,
+            timestamp TEXT NOT NULL,
+            old_path_id INTEGER,
+            new_path_id INTEGER NOT NULL
+        )
     """)
     
+    cursor.execute("""
+        CREATE INDEX IF NOT EXISTS idx_route_changes_device
+        ON route_changes (device_id, target, id)
+    """)
     
-    conn.commit()
-    conn.close()
-    print("Database Initialized")
+    cursor.execute("""
+        CREATE INDEX IF NOT EXISTS idx_route_changes_timestamp
+        ON route_changes (timestamp)
+    """)
+
+def add_column_if_missing(cursor, table: str, column: str, definition: str):
+    """ Adds a column to a table created by an older version """
+    cursor.execute(f"PRAGMA table_info({table})")
+    columns = [row["name"] for row in cursor.fetchall()]
+    
+    if column not in columns:
+        cursor.execute(f"ALTER TABLE {table} ADD COLUMN {column} {definition}")
+
+def next_schedule_version(cursor):
+    """ Bumps and returns the schedule version (inside the caller's transaction) """
+    cursor.execute("""
+        INSERT INTO counters (name, value) VALUES ('schedule_version', 1)
+        ON CONFLICT (name) DO UPDATE SET value = value + 1
+    """)
+    cursor.execute("SELECT value FROM counters WHERE name = 'schedule_version'")
+    return cursor.fetchone()["value"]
     
 def register_device(device_id: str, name: str):
     """ Add a new device to the database """
@@ -86,18 +428,24 @@ def register_device(device_id: str, name: str):
     
     now = datetime.now().isoformat()
     
+    cursor.execute("SELECT status FROM devices WHERE device_id = ?", (device_id,))
+    row = cursor.fetchone()
+    
     cursor.execute("""
         INSERT OR REPLACE INTO devices
         (device_id, name, status, last_seen, registered_at)
         VALUES (?, ?, ?, ?, ?)
     """, (device_id, name, "online", now, now))
     
+    if row is None or row["status"] != "online":
+        add_device_event(cursor, device_id, "online", now, now)
+    
     conn.commit()
     conn.close()
     
     return{
         "device_id": device_id,
-        "name": "name",
+        "name": name,
         "status": "online",
         "registered_at": now
     }
@@ -133,40 +481,209 @@ def get_device(device_id: str):
    
 def update_heartbeat(device_id: str):
     """ Updates last_seen timestamp for a device """
+    return update_heartbeats([device_id])[device_id]
+
+def update_heartbeats(device_ids: list):
+    """
+    Heartbeats of many devices in one transaction (group commit)
+    
+    Returns: {device_id: {"last_seen", "status"} or None if not found}
+    """
     conn = get_connection()
     cursor = conn.cursor()
     
     now = datetime.now().isoformat()
+    results = {}
     
-    # UPDATE timestamp and status online
+    for device_id in device_ids:
+        # UPDATE timestamp (the usual case: the device is already online)
+        cursor.execute("""
+            UPDATE devices
+            SET LAST_SEEN = ?
+            WHERE device_id = ? AND status = 'online'
+        """, (now, device_id))
+        
+        if cursor.rowcount == 0:
+            # Back from offline (or unknown): set it online and record that
+            cursor.execute("""
+                UPDATE devices
+                SET LAST_SEEN = ?, status = 'online'
+                WHERE device_id = ?
+            """, (now, device_id))
+            
+            if cursor.rowcount == 0:
+                results[device_id] = None # no device found
+                continue
+            
+            add_device_event(cursor, device_id, "online", now, now)
+        
+        results[device_id] = {"last_seen": now, "status": "online"}
+    
+    conn.commit()
+    conn.close()
+    
+    return results
+        
+def add_device_event(cursor, device_id: str, event: str, timestamp: str, last_seen: str = None):
+    """ Records an online / offline transition (inside the caller's transaction) """
     cursor.execute("""
-        UPDATE devices
-        SET LAST_SEEN = ?, status = 'online'
-        WHERE device_id = ?               
-    """, (now, device_id))
+        INSERT INTO device_events (device_id, event, timestamp, last_seen)
+        VALUES (?, ?, ?, ?)
+    """, (device_id, event, timestamp, last_seen))
+
+def sweep_offline_devices(offline_after_seconds: int):
+    """
+    Sets devices offline that haven't been seen for offline_after_seconds
     
-    if cursor.rowcount == 0:
-        conn.close()
-        return None # no device found
+    Only touches the online devices past the cutoff (indexed range on
+    status, last_seen), so a sweep costs nothing when everything is fine.
+    
+    Returns: list of {device_id, last_seen} that went offline
+    """
+    conn = get_connection()
+    cursor = conn.cursor()
+    
+    now = datetime.now()
+    cutoff = (now - timedelta(seconds=offline_after_seconds)).isoformat()
+    
+    # Write lock first, so no heartbeat lands between the SELECT and the UPDATE
+    cursor.execute("BEGIN IMMEDIATE")
+    cursor.execute("""
+        SELECT device_id, last_seen FROM devices
+        WHERE status = 'online' AND last_seen < ?
+    """, (cutoff,))
+    gone = [dict(row) for row in cursor.fetchall()]
+    
+    if gone:
+        cursor.execute("""
+            UPDATE devices SET status = 'offline'
+            WHERE status = 'online' AND last_seen < ?
+        """, (cutoff,))
+        
+        for device in gone:
+            add_device_event(cursor, device["device_id"], "offline", now.isoformat(), device["last_seen"])
     
     conn.commit()
     conn.close()
     
-    return {"last_seen": now, "status": "online"}
-        
-def save_test_result(device_id: str, test_type: str, target: str, result_data: str, triggered_by: str = "manual"):
+    return gone
+
+def get_device_status_counts():
+    """ Number of devices per status, e.g. {"online": 10, "offline": 2} """
+    conn = get_connection()
+    cursor = conn.cursor()
+    
+    cursor.execute("SELECT status, COUNT(*) AS count FROM devices GROUP BY status")
+    counts = {row["status"]: row["count"] for row in cursor.fetchall()}
+    
+    conn.close()
+    return counts
+
+def get_down_devices(limit: int = 100):
+    """ Gets the offline devices, most recently seen first """
     conn = get_connection()
     cursor = conn.cursor()
     
+    cursor.execute("""
+        SELECT * FROM devices
+        WHERE status = 'offline'
+        ORDER BY last_seen DESC
+        LIMIT ?
+    """, (limit,))
+    devices = [dict(row) for row in cursor.fetchall()]
+    
+    conn.close()
+    return devices
+
+def get_device_events(device_id: str = None, limit: int = 50):
+    """ Gets the latest online / offline transitions (optionally of one device) """
+    conn = get_connection()
+    cursor = conn.cursor()
+    
+    query = "SELECT * FROM device_events"
+    params = []
+    
+    if device_id:
+        query += " WHERE device_id = ?"
+        params.append(device_id)
+    
+    query += " ORDER BY timestamp DESC LIMIT ?"
+    params.append(limit)
+    
+    cursor.execute(query, params)
+    events = [dict(row) for row in cursor.fetchall()]
+    
+    conn.close()
+    return events
+
+def compress_output(output: str):
+    """ Returns: (codec, compressed bytes) """
+    raw = output.encode()
+    if len(raw) < OUTPUT_MIN_SIZE:
+        return "none", raw
+    if OUTPUT_CODEC == "zstd":
+        return "zstd", zstd.compress(raw)
+    return "zlib", zlib.compress(raw, 6)
+
+def decompress_output(codec: str, data: bytes):
+    if codec == "zstd":
+        return zstd.decompress(data).decode()
+    if codec == "zlib":
+        return zlib.decompress(data).decode()
+    return data.decode()
+
+def split_output(result_data: str):
+    """
+    Takes the raw "output" out of a result
+    
+    Returns: (result_data without it, output or None). The result gets
+    "has_output": true so clients know there is more to fetch.
+    """
+    if '"output"' not in result_data:
+        return result_data, None
+    
+    try:
+        data = json.loads(result_data)
+    except ValueError:
+        return result_data, None
+    
+    if not isinstance(data, dict) or not isinstance(data.get("output"), str):
+        return result_data, None
+    
+    output = data.pop("output")
+    data["has_output"] = True
+    return json.dumps(data), output
+
+def save_output(cursor, local_id: int, output: str):
+    """ Stores a result's raw output (inside the caller's transaction) """
+    codec, blob = compress_output(output)
+    cursor.execute("""
+        INSERT OR REPLACE INTO result_outputs (result_id, codec, size, data)
+        VALUES (?, ?, ?, ?)
+    """, (local_id, codec, len(output), blob))
+
+def save_test_result(device_id: str, test_type: str, target: str, result_data: str, triggered_by: str = "manual"):
+    shard = shard_of(device_id)
+    conn = get_shard_connection(shard)
+    cursor = conn.cursor()
+    
     now = datetime.now().isoformat()
+    result_data, output = split_output(result_data)
+    
+    if test_type == "traceroute":
+        result_data = store_route(cursor, shard, device_id, target, result_data, now)
     
     cursor.execute("""
         INSERT INTO test_results
         (device_id, test_type, timestamp, target, result_data, triggered_by) 
         VALUES (?, ?, ?, ?, ?, ?)               
     """, (device_id, test_type, now, target, result_data, triggered_by))
+    local_id = cursor.lastrowid
+    
+    if output is not None:
+        save_output(cursor, local_id, output)
     
-    result_id = cursor.lastrowid
+    result_id = global_id(local_id, shard)
     conn.commit()
     conn.close()
             
@@ -181,34 +698,336 @@ def save_test_result(device_id: str, test_type: str, target: str, result_data: s
     
 def get_test_results(device_id: str = None, limit: int = 50):
     """ Gets the test results from the db """
-    conn = get_connection()
-    cursor = conn.cursor()
-    
     if device_id:
-        #get results for a specific device
-        cursor.execute("""
+        #get results for a specific device (one shard)
+        return expand_routes(query_shard(shard_of(device_id), """
             SELECT * FROM test_results
             WHERE device_id =  ?
             ORDER BY timestamp DESC
             LIMIT ?               
-        """, (device_id, limit))
+        """, (device_id, limit)))
+    
+    #get results for ALL devices
+    return expand_routes(query_all_shards("""
+        SELECT * FROM test_results
+        ORDER BY timestamp DESC
+        LIMIT ?               
+    """, (limit,), "timestamp", limit))
+    
+def get_test_result(result_id: int):
+    """ Gets ONE test result, with its raw output decompressed (None if not found) """
+    shard, local_id = split_id(result_id)
+    conn = get_shard_connection(shard)
+    cursor = conn.cursor()
+    
+    cursor.execute("SELECT * FROM test_results WHERE id = ?", (local_id,))
+    row = cursor.fetchone()
+    if row is None:
+        conn.close()
+        return None
+    
+    result = dict(row)
+    result["id"] = result_id
+    
+    cursor.execute("SELECT codec, data FROM result_outputs WHERE result_id = ?", (local_id,))
+    output = cursor.fetchone()
+    result["output"] = decompress_output(output["codec"], output["data"]) if output else None
+    
+    conn.close()
+    return expand_routes([result])[0]
+
+def get_latest_results():
+    """ The latest result of every device and test type (a full scan, summary.py loads it at startup), traceroutes stay compact """
+    rows = []
+    for shard in range(SHARDS):
+        rows.extend(query_shard(shard, """
+            SELECT * FROM test_results
+            WHERE id IN (SELECT MAX(id) FROM test_results GROUP BY device_id, test_type)
+        """, ()))
+    return rows
+
+def compact_result_outputs(batch_size: int = 1000, vacuum: bool = True):
+    """
+    Moves the raw outputs of results saved before result_outputs existed
+    out of result_data (one batch per transaction), then VACUUMs
+    
+        python -c "import database; database.compact_result_outputs()"
+    
+    Returns: number of results compacted
+    """
+    compacted = 0
+    
+    for shard in range(SHARDS):
+        conn = get_shard_connection(shard)
+        cursor = conn.cursor()
+        last_id = 0
+        
+        while True:
+            cursor.execute("""
+                SELECT id, result_data FROM test_results
+                WHERE id > ? AND result_data LIKE '%"output"%'
+                ORDER BY id
+                LIMIT ?
+            """, (last_id, batch_size))
+            rows = cursor.fetchall()
+            if not rows:
+                break
+            
+            for row in rows:
+                result_data, output = split_output(row["result_data"])
+                if output is not None:
+                    cursor.execute("UPDATE test_results SET result_data = ? WHERE id = ?", (result_data, row["id"]))
+                    save_output(cursor, row["id"], output)
+                    compacted += 1
+            
+            last_id = rows[-1]["id"]
+            conn.commit()
+        
+        if vacuum:
+            conn.execute("VACUUM")
+        conn.close()
+    
+    return compacted
+
+def route_fingerprint(addresses: list):
+    """ Key of a path: hash of its hop addresses in order (silent hops are "*") """
+    return hashlib.sha1("\n".join(address or "*" for address in addresses).encode()).hexdigest()
+
+def join_route(data: dict, addresses: list):
+    """ Rebuilds the hops of a stored traceroute (like tests.build_hop) from its path and rtts """
+    data = dict(data)
+    hops = []
+    for ttl, (address, rtts) in enumerate(zip(addresses, data.pop("hop_rtts")), 1):
+        lost = sum(1 for rtt in rtts if rtt is None)
+        hops.append({
+            "ttl": ttl,
+            "address": address,
+            "rtts": rtts,
+            "loss_pct": round(lost * 100 / len(rtts), 1) if rtts else 100.0
+        })
+    data["hops"] = hops
+    return data
+
+def split_route(result_data: str):
+    """
+    Takes the path out of a traceroute result
+    
+    Returns: (result dict with "hop_rtts" instead of "hops", hop addresses),
+    or (None, None) if there is no path or join_route couldn't rebuild the
+    hops exactly (then the result is stored as it is)
+    """
+    if '"hops"' not in result_data:
+        return None, None
+    
+    try:
+        data = json.loads(result_data)
+    except ValueError:
+        return None, None
+    
+    hops = data.get("hops") if isinstance(data, dict) else None
+    if not hops or not isinstance(hops, list):
+        return None, None
+    if not all(isinstance(hop, dict) and isinstance(hop.get("rtts"), list) for hop in hops):
+        return None, None
+    
+    addresses = [hop.get("address") for hop in hops]
+    data["hop_rtts"] = [hop["rtts"] for hop in hops]
+    del data["hops"]
+    
+    if join_route(data, addresses)["hops"] != hops:
+        return None, None
+    return data, addresses
+
+def save_route(cursor, shard: int, device_id: str, target: str, addresses: list, timestamp: str):
+    """
+    Stores a traceroute path (inside the caller's transaction on the device's shard)
+    
+    Adds the path and its hops to the index if it's new, moves the device /
+    target to it and logs a route change if it's not the one it had.
+    
+    Returns: the path_id
+    """
+    fingerprint = route_fingerprint(addresses)
+    cursor.execute("""
+        INSERT INTO route_paths (fingerprint, hops, hop_count, first_seen)
+        VALUES (?, ?, ?, ?)
+        ON CONFLICT (fingerprint) DO NOTHING
+    """, (fingerprint, json.dumps(addresses), len(addresses), timestamp))
+    
+    if cursor.rowcount:
+        path_id = global_id(cursor.lastrowid, shard)
+        cursor.executemany("""
+            INSERT OR IGNORE INTO route_hops (address, path_id, ttl) VALUES (?, ?, ?)
+        """, [(address, path_id, ttl) for ttl, address in enumerate(addresses, 1) if address])
     else:
-        #get results for ALL devices
+        cursor.execute("SELECT id FROM route_paths WHERE fingerprint = ?", (fingerprint,))
+        path_id = global_id(cursor.fetchone()["id"], shard)
+    
+    cursor.execute("SELECT path_id FROM device_routes WHERE device_id = ? AND target = ?", (device_id, target))
+    current = cursor.fetchone()
+    
+    if current is not None and current["path_id"] == path_id:
         cursor.execute("""
-            SELECT * FROM test_results
-            ORDER BY timestamp DESC
-            LIMIT ?               
-        """, (limit,))
+            UPDATE device_routes SET last_seen = ? WHERE device_id = ? AND target = ?
+        """, (timestamp, device_id, target))
+        return path_id
     
-    rows = cursor.fetchall()
-    results = [dict(row) for row in rows]
+    cursor.execute("""
+        INSERT INTO route_changes (device_id, target, timestamp, old_path_id, new_path_id)
+        VALUES (?, ?, ?, ?, ?)
+    """, (device_id, target, timestamp, current["path_id"] if current else None, path_id))
+    cursor.execute("""
+        INSERT INTO device_routes (device_id, target, path_id, since, last_seen)
+        VALUES (?, ?, ?, ?, ?)
+        ON CONFLICT (device_id, target) DO UPDATE SET
+            path_id = excluded.path_id, since = excluded.since, last_seen = excluded.last_seen
+    """, (device_id, target, path_id, timestamp, timestamp))
+    return path_id
+
+def store_route(cursor, shard: int, device_id: str, target: str, result_data: str, timestamp: str):
+    """
+    Moves the path of a traceroute result to the route tables (in the caller's transaction)
     
-    conn.close()
+    Returns: the result_data to store, with a path_id instead of the hops
+    """
+    data, addresses = split_route(result_data)
+    if data is None:
+        return result_data
+    
+    data["path_id"] = save_route(cursor, shard, device_id, target, addresses, timestamp)
+    return json.dumps(data)
+
+def get_route_addresses(path_ids: set):
+    """ Returns: {path_id: hop addresses}, from route_path_cache where possible """
+    paths = {}
+    missing = {}
+    with route_path_lock:
+        for path_id in path_ids:
+            if path_id in route_path_cache:
+                route_path_cache.move_to_end(path_id)
+                paths[path_id] = route_path_cache[path_id]
+            else:
+                shard, local_id = split_id(path_id)
+                missing.setdefault(shard, []).append(local_id)
+    
+    for shard, local_ids in missing.items():
+        conn = get_shard_connection(shard)
+        cursor = conn.cursor()
+        cursor.execute(
+            f"SELECT id, hops FROM route_paths WHERE id IN ({','.join('?' * len(local_ids))})", local_ids
+        )
+        for row in cursor.fetchall():
+            paths[global_id(row["id"], shard)] = json.loads(row["hops"])
+        conn.close()
+    
+    with route_path_lock:
+        for path_id, addresses in paths.items():
+            route_path_cache[path_id] = addresses
+            route_path_cache.move_to_end(path_id)
+        while len(route_path_cache) > ROUTE_PATH_CACHE_SIZE:
+            route_path_cache.popitem(last=False)
+    
+    return paths
+
+def expand_routes(results: list):
+    """ Puts the hops back into the stored traceroutes of a list of results (in place) """
+    compact = []
+    for result in results:
+        if result["test_type"] == "traceroute" and '"hop_rtts"' in (result["result_data"] or ""):
+            data = json.loads(result["result_data"])
+            # Only ours, an agent can send hop_rtts itself
+            if isinstance(data, dict) and data.get("path_id") is not None:
+                compact.append((result, data))
+    if not compact:
+        return results
+    
+    paths = get_route_addresses({data["path_id"] for _, data in compact})
+    for result, data in compact:
+        if data["path_id"] in paths:
+            result["result_data"] = json.dumps(join_route(data, paths[data["path_id"]]))
     return results
+
+def get_route_path(path_id: int):
+    """
+    Gets a path with its hops and the devices currently on it (None if not found)
+    
+    Every shard stores its own copy of a path, the devices come from all of them.
+    """
+    shard, local_id = split_id(path_id)
+    conn = get_shard_connection(shard)
+    cursor = conn.cursor()
+    cursor.execute("SELECT * FROM route_paths WHERE id = ?", (local_id,))
+    row = cursor.fetchone()
+    conn.close()
     
+    if row is None:
+        return None
+    
+    path = dict(row)
+    path["id"] = path_id
+    path["hops"] = json.loads(path["hops"])
+    
+    path["devices"] = []
+    for shard in range(SHARDS):
+        conn = get_shard_connection(shard)
+        cursor = conn.cursor()
+        cursor.execute("""
+            SELECT r.device_id, r.target, r.since, r.last_seen
+            FROM route_paths p
+            JOIN device_routes r ON r.path_id = p.id * ? + ?
+            WHERE p.fingerprint = ?
+        """, (SHARDS, shard, path["fingerprint"]))
+        path["devices"].extend(dict(row) for row in cursor.fetchall())
+        conn.close()
+    
+    path["devices"].sort(key=lambda route: (route["device_id"], route["target"]))
+    return path
+
+def get_hop_routes(address: str, limit: int = 100):
+    """ Gets the devices / targets whose current path goes through a hop address (every shard) """
+    routes = []
+    for shard in range(SHARDS):
+        conn = get_shard_connection(shard)
+        cursor = conn.cursor()
+        cursor.execute("""
+            SELECT r.device_id, r.target, r.path_id, h.ttl, r.since, r.last_seen
+            FROM route_hops h
+            JOIN device_routes r ON r.path_id = h.path_id
+            WHERE h.address = ?
+            ORDER BY r.last_seen DESC
+            LIMIT ?
+        """, (address, limit))
+        routes.extend(dict(row) for row in cursor.fetchall())
+        conn.close()
+    
+    routes.sort(key=lambda route: route["last_seen"], reverse=True)
+    return routes[:limit] if limit >= 0 else routes
+
+def get_route_changes(device_id: str = None, target: str = None, limit: int = 50):
+    """ Gets the route changes, newest first (optionally filtered) """
+    query = "SELECT * FROM route_changes WHERE 1=1"
+    params = []
+    
+    if device_id:
+        query += " AND device_id = ?"
+        params.append(device_id)
+    
+    if target:
+        query += " AND target = ?"
+        params.append(target)
+    
+    query += " ORDER BY timestamp DESC, id DESC LIMIT ?"
+    params.append(limit)
+    
+    if device_id:
+        #one device: one shard
+        return query_shard(shard_of(device_id), query, tuple(params))
+    return query_all_shards(query, tuple(params), "timestamp", limit)
+
 def create_command(device_id: str, command_type: str, parameters: str = None):
     """ Creates a new command for a device """
-    conn = get_connection()
+    shard = shard_of(device_id)
+    conn = get_shard_connection(shard)
     cursor = conn.cursor()
     
     now = datetime.now().isoformat()
@@ -219,7 +1038,7 @@ def create_command(device_id: str, command_type: str, parameters: str = None):
         VALUES (?, ?, ?, 'pending', ?)
     """, (device_id, command_type, parameters, now))
     
-    command_id = cursor.lastrowid
+    command_id = global_id(cursor.lastrowid, shard)
     conn.commit()
     conn.close()
     
@@ -234,24 +1053,22 @@ def create_command(device_id: str, command_type: str, parameters: str = None):
 
 def get_pending_commands(device_id: str):
     """ Gets all pending commands for a device """
-    conn = get_connection()
-    cursor = conn.cursor()
-    
-    cursor.execute("""
+    return query_shard(shard_of(device_id), """
         SELECT * FROM commands
         WHERE device_id = ? AND status = 'pending'
         ORDER BY created_at ASC
     """, (device_id,))
-    
-    rows = cursor.fetchall()
-    commands = [dict(row) for row in rows]
-    
-    conn.close()
-    return commands
+
+def get_command(command_id: int):
+    """ Gets a command by id (None if there is none) """
+    shard, local_id = split_id(command_id)
+    rows = query_shard(shard, "SELECT * FROM commands WHERE id = ?", (local_id,))
+    return rows[0] if rows else None
 
 def update_command_status(command_id: int, status: str, result_id: int = None):
     """ Updates a command's status """
-    conn = get_connection()
+    shard, local_id = split_id(command_id)
+    conn = get_shard_connection(shard)
     cursor = conn.cursor()
     
     now = datetime.now().isoformat()
@@ -260,44 +1077,38 @@ def update_command_status(command_id: int, status: str, result_id: int = None):
         cursor.execute("""
             UPDATE commands
             SET status = ?, completed_at = ?, result_id = ?
-            WHERE id = ?               
-        """, (status, now, result_id, command_id))
+            WHERE id = ?
+            RETURNING device_id
+        """, (status, now, result_id, local_id))
     else:
         cursor.execute("""
             UPDATE commands
             SET status = ?
-            WHERE id = ?    
-        """, (status, command_id))
+            WHERE id = ?
+            RETURNING device_id
+        """, (status, local_id))
+    row = cursor.fetchone()
 
     conn.commit()
     conn.close()
     
-    return {"id": command_id, "status": status}
+    return {"id": command_id, "device_id": row["device_id"] if row else None, "status": status}
          
 def get_all_commands(device_id: str = None, limit: int = 50):
     """ Gets command s(optionally filtered by device)"""         
-    conn = get_connection()
-    cursor = conn.cursor()
-    
     if device_id:
-        cursor.execute("""
+        return query_shard(shard_of(device_id), """
             SELECT * FROM commands
             WHERE device_id = ?
             ORDER BY created_at DESC
             LIMIT ?
         """, (device_id, limit))
-    else:
-        cursor.execute("""
-            SELECT * FROM commands
-            ORDER BY created_at DESC
-            LIMIT ?
-        """, (limit,))
-        
-    rows = cursor.fetchall()
-    commands = [dict(row) for row in rows]
     
-    conn.close()
-    return commands
+    return query_all_shards("""
+        SELECT * FROM commands
+        ORDER BY created_at DESC
+        LIMIT ?
+    """, (limit,), "created_at", limit)
          
 def create_schedule(device_id: str, test_type: str, interval_seconds: int,
                     target: str = None, parameters: str = None):
@@ -316,12 +1127,13 @@ def create_schedule(device_id: str, test_type: str, interval_seconds: int,
     cursor = conn.cursor()
     
     now = datetime.now().isoformat()
+    version = next_schedule_version(cursor)
     
     cursor.execute("""
         INSERT INTO schedules
-        (device_id, test_type, target, interval_seconds, parameters, enabled, created_at)        
-        VALUES (?,?,?,?,?,1,?)       
-    """, (device_id, test_type, target, interval_seconds, parameters, now))
+        (device_id, test_type, target, interval_seconds, parameters, enabled, created_at, version)        
+        VALUES (?,?,?,?,?,1,?,?)       
+    """, (device_id, test_type, target, interval_seconds, parameters, now, version))
 
     schedule_id = cursor.lastrowid
     conn.commit()
@@ -407,12 +1219,60 @@ def get_schedules_due_to_run(device_id: str):
     conn.close()
     return due_schedules
 
-def update_schedule_last_run(schedule_id: int):
-    """Updates the last_run timestamp for a schedule"""
+def get_schedule_changes(device_id: str, since_version: int = 0):
+    """
+    Gets the schedules of a device that changed after a version
+    
+    Params:
+    - device_id: which device is syncing
+    - since_version: the version the agent has (0 = everything)
+    
+    Returns: dict with the current version, changed schedules (incl. disabled
+    ones) and the ids of deleted schedules. "full" is True when the agent has
+    to replace its cache instead of applying a delta.
+    """
     conn = get_connection()
     cursor = conn.cursor()
     
-    now = datetime.now().isoformat()
+    cursor.execute("SELECT value FROM counters WHERE name = 'schedule_version'")
+    row = cursor.fetchone()
+    version = row["value"] if row else 0
+    
+    # A version from the future means the server lost its data, start over
+    full = since_version <= 0 or since_version > version
+    if full:
+        since_version = -1  # schedules from before versioning have version 0
+    
+    cursor.execute("""
+        SELECT * FROM schedules
+        WHERE device_id = ? AND version > ?
+        ORDER BY version ASC
+    """, (device_id, since_version))
+    schedules = [dict(row) for row in cursor.fetchall()]
+    
+    deleted = []
+    if not full:
+        cursor.execute("""
+            SELECT schedule_id FROM schedule_tombstones
+            WHERE device_id = ? AND version > ?
+        """, (device_id, since_version))
+        deleted = [row["schedule_id"] for row in cursor.fetchall()]
+    
+    conn.close()
+    
+    return {
+        "version": version,
+        "full": full,
+        "schedules": schedules,
+        "deleted": deleted
+    }
+
+def update_schedule_last_run(schedule_id: int, ran_at: str = None):
+    """Updates the last_run timestamp for a schedule (default: now)"""
+    conn = get_connection()
+    cursor = conn.cursor()
+    
+    now = ran_at or datetime.now().isoformat()
     
     cursor.execute("""
         UPDATE schedules
@@ -430,11 +1290,13 @@ def toggle_schedule(schedule_id: int, enabled: bool):
     conn = get_connection()
     cursor = conn.cursor()
     
+    version = next_schedule_version(cursor)
+    
     cursor.execute("""
         UPDATE schedules
-        set enabled = ?
+        set enabled = ?, version = ?
         WHERE id = ?
-    """, (1 if enabled else 0, schedule_id))
+    """, (1 if enabled else 0, version, schedule_id))
     
     conn.commit()
     conn.close()
@@ -446,13 +1308,240 @@ def delete_schedule(schedule_id: int):
     conn = get_connection()
     cursor = conn.cursor()
     
-    cursor.execute("DELETE FROM schedules WHERE id = ?", (schedule_id,))
+    cursor.execute("SELECT device_id FROM schedules WHERE id = ?", (schedule_id,))
+    row = cursor.fetchone()
+    
+    if row:
+        # Leave a tombstone so agents find out on their next sync
+        version = next_schedule_version(cursor)
+        cursor.execute("""
+            INSERT OR REPLACE INTO schedule_tombstones (schedule_id, device_id, version)
+            VALUES (?, ?, ?)
+        """, (schedule_id, row["device_id"], version))
+        
+        cursor.execute("DELETE FROM schedules WHERE id = ?", (schedule_id,))
     
     conn.commit()
     conn.close()
     
     return {"schedule_id": schedule_id, "deleted": True}
 
+def save_monitor_summaries(device_id: str, target: str, summaries: list):
+    """
+    Saves a batch of monitor summaries in one transaction
+    
+    Params:
+    - device_id: which device measured them
+    - target: what was monitored
+    - summaries: list of summary dicts (see tests.monitor_test)
+    
+    Returns: dict with how many were saved and the window_start of each
+    (windows the device sent before are skipped)
+    """
+    conn = get_connection()
+    cursor = conn.cursor()
+    
+    saved = []
+    for s in summaries:
+        cursor.execute("""
+            INSERT OR IGNORE INTO monitor_summaries
+            (device_id, target, window_start, window_end, summary)
+            VALUES (?, ?, ?, ?, ?)
+        """, (device_id, target, s["window_start"], s["window_end"], json.dumps(s)))
+        if cursor.rowcount:
+            saved.append(s["window_start"])
+    
+    conn.commit()
+    conn.close()
+    
+    return {"device_id": device_id, "target": target, "saved": len(saved), "saved_windows": saved}
+
+def get_monitor_summaries(device_id: str = None, target: str = None, limit: int = 360):
+    """ Gets the latest monitor summaries (optionally filtered) """
+    conn = get_connection()
+    cursor = conn.cursor()
+    
+    query = "SELECT * FROM monitor_summaries WHERE 1=1"
+    params = []
+    
+    if device_id:
+        query += " AND device_id = ?"
+        params.append(device_id)
+    
+    if target:
+        query += " AND target = ?"
+        params.append(target)
+    
+    query += " ORDER BY window_end DESC LIMIT ?"
+    params.append(limit)
+    
+    cursor.execute(query, params)
+    rows = cursor.fetchall()
+    summaries = [dict(row) for row in rows]
+    
+    conn.close()
+    return summaries
+
+def save_target_stats(rows: list):
+    """
+    Checkpoints streaming stats in one transaction
+    
+    Params:
+    - rows: list of (device_id, target, test_type, data) from stats.take_checkpoint()
+    """
+    if not rows:
+        return {"saved": 0}
+    
+    conn = get_connection()
+    cursor = conn.cursor()
+    updated_at = datetime.now().isoformat()
+    
+    cursor.executemany("""
+        INSERT INTO target_stats (device_id, target, test_type, data, updated_at)
+        VALUES (?, ?, ?, ?, ?)
+        ON CONFLICT (device_id, target, test_type)
+        DO UPDATE SET data = excluded.data, updated_at = excluded.updated_at
+    """, [(*row, updated_at) for row in rows])
+    
+    conn.commit()
+    conn.close()
+    
+    return {"saved": len(rows)}
+
+def load_target_stats():
+    """ Gets every stats checkpoint (at startup) """
+    conn = get_connection()
+    cursor = conn.cursor()
+    
+    cursor.execute("SELECT device_id, target, test_type, data FROM target_stats")
+    rows = [dict(row) for row in cursor.fetchall()]
+    
+    conn.close()
+    return rows
+
+def save_alert(device_id: str, target: str, test_type: str, kind: str, metric: str,
+               value: float, baseline: float, message: str, rule_id: int = None, created_at: str = None):
+    """ Saves an alert that just started """
+    conn = get_connection()
+    cursor = conn.cursor()
+    
+    created_at = created_at or datetime.now().isoformat()
+    
+    cursor.execute("""
+        INSERT INTO alerts
+        (device_id, target, test_type, kind, metric, value, baseline, message, rule_id, created_at)
+        VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+    """, (device_id, target, test_type, kind, metric, value, baseline, message, rule_id, created_at))
+    
+    alert_id = cursor.lastrowid
+    conn.commit()
+    conn.close()
+    
+    return {
+        "id": alert_id,
+        "device_id": device_id,
+        "target": target,
+        "test_type": test_type,
+        "kind": kind,
+        "metric": metric,
+        "value": value,
+        "baseline": baseline,
+        "message": message,
+        "rule_id": rule_id,
+        "created_at": created_at,
+        "resolved_at": None
+    }
+
+def resolve_alert(alert_id: int, resolved_at: str = None):
+    """ Marks an alert as over """
+    conn = get_connection()
+    cursor = conn.cursor()
+    
+    resolved_at = resolved_at or datetime.now().isoformat()
+    cursor.execute("UPDATE alerts SET resolved_at = ? WHERE id = ?", (resolved_at, alert_id))
+    
+    conn.commit()
+    conn.close()
+    
+    return {"alert_id": alert_id, "resolved_at": resolved_at}
+
+def get_alerts(device_id: str = None, active_only: bool = False, limit: int = 50):
+    """ Gets the latest alerts (optionally filtered) """
+    conn = get_connection()
+    cursor = conn.cursor()
+    
+    query = "SELECT * FROM alerts WHERE 1=1"
+    params = []
+    
+    if device_id:
+        query += " AND device_id = ?"
+        params.append(device_id)
+    
+    if active_only:
+        query += " AND resolved_at IS NULL"
+    
+    query += " ORDER BY created_at DESC LIMIT ?"
+    params.append(limit)
+    
+    cursor.execute(query, params)
+    alerts = [dict(row) for row in cursor.fetchall()]
+    
+    conn.close()
+    return alerts
+
+def create_alert_rule(metric: str, operator: str, threshold: float,
+                      device_id: str = None, target: str = None, test_type: str = None):
+    """ Creates a user threshold (see alerts.py) """
+    conn = get_connection()
+    cursor = conn.cursor()
+    
+    now = datetime.now().isoformat()
+    
+    cursor.execute("""
+        INSERT INTO alert_rules
+        (device_id, target, test_type, metric, operator, threshold, created_at)
+        VALUES (?, ?, ?, ?, ?, ?, ?)
+    """, (device_id, target, test_type, metric, operator, threshold, now))
+    
+    rule_id = cursor.lastrowid
+    conn.commit()
+    conn.close()
+    
+    return {
+        "id": rule_id,
+        "device_id": device_id,
+        "target": target,
+        "test_type": test_type,
+        "metric": metric,
+        "operator": operator,
+        "threshold": threshold,
+        "enabled": 1,
+        "created_at": now
+    }
+
+def get_alert_rules():
+    """ Gets every alert rule """
+    conn = get_connection()
+    cursor = conn.cursor()
+    
+    cursor.execute("SELECT * FROM alert_rules ORDER BY id")
+    rules = [dict(row) for row in cursor.fetchall()]
+    
+    conn.close()
+    return rules
+
+def delete_alert_rule(rule_id: int):
+    """ Deletes an alert rule """
+    conn = get_connection()
+    cursor = conn.cursor()
+    
+    cursor.execute("DELETE FROM alert_rules WHERE id = ?", (rule_id,))
+    
+    conn.commit()
+    conn.close()
+    
+    return {"rule_id": rule_id, "deleted": True}
+
 # TEST CODE
 if __name__ == "__main__":
     print("Testing DB..")
@@ -0,0 +1,492 @@
+"""
+export.py - Columnar export of test results for bulk analytics
+
+Paging through GET /tests/results and parsing every result_data again is
+far too slow for millions of results. Instead, export the metrics once
+into a directory of column files, one typed little-endian array per column:
+
+    export/
+        meta.json            rows, column types, dictionaries, watermarks
+        id.bin               <i8  global result id
+        timestamp.bin        <f8  unix seconds
+        device.bin           <u4  index into meta["dictionaries"]["device"]
+        target.bin           <u4  index into meta["dictionaries"]["target"]
+        test_type.bin        <u1  index into meta["dictionaries"]["test_type"]
+        success.bin          <u1
+        rtt_ms.bin           <f8  NaN where the result has none
+        loss_pct.bin         <f8
+        throughput_mbps.bin  <f8
+
+Every file is a raw array: numpy.memmap(path, dtype) reads it as is.
+Exports are incremental, meta.json keeps the last exported id of every
+shard and the next update only appends newer results (in id order per
+shard, so the rows are not sorted by time across shards). meta.json is
+replaced after the columns are on disk; whatever a crashed update wrote
+past meta["rows"] is cut off by the next one.
+
+    python export.py update export/
+    python export.py query export/ --metric rtt_ms --group-by target --since 2026-10-01
+
+open_export() maps the files read-only (zero-copy). With numpy installed
+the columns are numpy arrays and queries are vectorized, without it they
+are memoryviews and queries loop in Python, with the same results.
+
+Exports read the SQLite files (SNUTZ_DB, SNUTZ_SHARDS): the memory engine
+lives in the server process.
+"""
+
+import argparse
+import json
+import math
+import mmap
+import os
+import sys
+from array import array
+from datetime import datetime
+
+import database
+import stats
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+EXPORT_BATCH = 10000  # results read and appended per transaction
+
+UINT32 = "I" if array("I").itemsize == 4 else "L"
+
+# name -> (numpy dtype, array typecode)
+COLUMNS = {
+    "id": ("<i8", "q"),
+    "timestamp": ("<f8", "d"),
+    "device": ("<u4", UINT32),
+    "target": ("<u4", UINT32),
+    "test_type": ("<u1", "B"),
+    "success": ("<u1", "B"),
+    "rtt_ms": ("<f8", "d"),
+    "loss_pct": ("<f8", "d"),
+    "throughput_mbps": ("<f8", "d"),
+}
+DICTIONARY_COLUMNS = ("device", "target", "test_type")
+METRICS = ("rtt_ms", "loss_pct", "throughput_mbps")
+GROUP_COLUMNS = DICTIONARY_COLUMNS + ("success", "time")
+QUANTILES = [0.5, 0.95]
+
+def column_path(path: str, name: str):
+    return os.path.join(path, f"{name}.bin")
+
+def load_meta(path: str):
+    """ Reads meta.json of an export, a new one if there is none """
+    try:
+        with open(os.path.join(path, "meta.json")) as f:
+            meta = json.load(f)
+    except FileNotFoundError:
+        return {
+            "version": 1,
+            "rows": 0,
+            "shards": database.SHARDS,
+            "columns": {name: dtype for name, (dtype, _) in COLUMNS.items()},
+            "dictionaries": {column: [] for column in DICTIONARY_COLUMNS},
+            "watermarks": {str(shard): 0 for shard in range(database.SHARDS)},
+            "updated_at": None
+        }
+
+    if meta["shards"] != database.SHARDS:
+        raise ValueError(f"Export was made with {meta['shards']} shards, SNUTZ_SHARDS is {database.SHARDS}")
+    return meta
+
+def save_meta(path: str, meta: dict):
+    tmp = os.path.join(path, "meta.json.tmp")
+    with open(tmp, "w") as f:
+        json.dump(meta, f)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp, os.path.join(path, "meta.json"))
+
+def to_columns(rows: list, meta: dict, codes: dict):
+    """ Converts result rows to one array per column (dictionaries grow as needed) """
+    columns = {name: array(typecode) for name, (_, typecode) in COLUMNS.items()}
+
+    def code(column, value):
+        found = codes[column].get(value)
+        if found is None:
+            found = codes[column][value] = len(meta["dictionaries"][column])
+            meta["dictionaries"][column].append(value)
+        return found
+
+    for row in rows:
+        metrics = stats.extract_metrics(row["test_type"], row["result_data"])
+
+        columns["id"].append(row["id"])
+        columns["timestamp"].append(datetime.fromisoformat(row["timestamp"]).timestamp())
+        columns["device"].append(code("device", row["device_id"]))
+        columns["target"].append(code("target", row["target"] or ""))
+        columns["test_type"].append(code("test_type", row["test_type"]))
+        columns["success"].append(1 if metrics["success"] else 0)
+        for metric in METRICS:
+            value = metrics.get(metric)
+            columns[metric].append(math.nan if value is None else float(value))
+
+    if sys.byteorder == "big":
+        for values in columns.values():
+            values.byteswap()
+    return columns
+
+def update_export(path: str, batch_size: int = EXPORT_BATCH):
+    """
+    Creates an export or appends the results saved since the last update
+
+    Params:
+    - path: directory of the export
+    - batch_size: results read per query
+
+    Returns: {"rows": rows in the export, "appended": rows added now}
+    """
+    os.makedirs(path, exist_ok=True)
+    meta = load_meta(path)
+    codes = {
+        column: {value: i for i, value in enumerate(meta["dictionaries"][column])}
+        for column in DICTIONARY_COLUMNS
+    }
+
+    files = {}
+    for name, (_, typecode) in COLUMNS.items():
+        f = open(column_path(path, name), "ab")
+        f.truncate(meta["rows"] * array(typecode).itemsize)
+        files[name] = f
+
+    appended = 0
+    try:
+        for shard in range(database.SHARDS):
+            conn = database.get_shard_connection(shard)
+            cursor = conn.cursor()
+
+            while True:
+                last_id = meta["watermarks"][str(shard)]
+                cursor.execute("""
+                    SELECT id, device_id, test_type, timestamp, target, result_data
+                    FROM test_results
+                    WHERE id > ?
+                    ORDER BY id
+                    LIMIT ?
+                """, (last_id, batch_size))
+                rows = [dict(row) for row in cursor.fetchall()]
+                if not rows:
+                    break
+
+                local_ids = [row["id"] for row in rows]
+                for row in rows:
+                    row["id"] = database.global_id(row["id"], shard)
+
+                for name, values in to_columns(rows, meta, codes).items():
+                    values.tofile(files[name])
+                for f in files.values():
+                    f.flush()
+                    os.fsync(f.fileno())
+
+                meta["rows"] += len(rows)
+                meta["watermarks"][str(shard)] = local_ids[-1]
+                meta["updated_at"] = datetime.now().isoformat()
+                save_meta(path, meta)
+                appended += len(rows)
+
+            conn.close()
+    finally:
+        for f in files.values():
+            f.close()
+
+    if not appended:
+        save_meta(path, meta)
+    return {"rows": meta["rows"], "appended": appended}
+
+class ColumnTable:
+    """
+    A read-only export, every column memory-mapped
+
+    columns[name] is a numpy array (or a memoryview without numpy) of
+    rows values; dictionary columns hold indexes into dictionaries[name].
+    """
+
+    def __init__(self, path: str):
+        with open(os.path.join(path, "meta.json")) as f:
+            meta = json.load(f)
+
+        self.path = path
+        self.rows = meta["rows"]
+        self.dictionaries = meta["dictionaries"]
+        self.updated_at = meta["updated_at"]
+        self.columns = {name: self.map_column(name) for name in COLUMNS}
+
+    def map_column(self, name: str):
+        dtype, typecode = COLUMNS[name]
+        size = self.rows * array(typecode).itemsize
+
+        if size == 0:
+            return numpy.empty(0, dtype) if numpy else memoryview(array(typecode))
+
+        with open(column_path(self.path, name), "rb") as f:
+            mapped = mmap.mmap(f.fileno(), size, access=mmap.ACCESS_READ)
+
+        if numpy:
+            return numpy.frombuffer(mapped, dtype=dtype, count=self.rows)
+
+        if sys.byteorder == "big":
+            # Not zero-copy: memoryviews can't read the other byte order
+            values = array(typecode, mapped)
+            values.byteswap()
+            return memoryview(values)
+        return memoryview(mapped).cast(typecode)
+
+    def filters(self, since, until, where: dict):
+        """
+        Returns: list of (column, codes, low, high) in column space, None if
+        nothing can match
+        """
+        filters = []
+        if since is not None or until is not None:
+            filters.append(("timestamp", None, to_unix(since), to_unix(until)))
+
+        for column, value in (where or {}).items():
+            if column not in COLUMNS:
+                raise ValueError(f"Unknown column: {column}")
+
+            if column in DICTIONARY_COLUMNS:
+                values = [value] if isinstance(value, str) else value
+                codes = [self.dictionaries[column].index(v) for v in values if v in self.dictionaries[column]]
+                if not codes:
+                    return None
+                filters.append((column, codes, None, None))
+            elif isinstance(value, (tuple, list)):
+                filters.append((column, None, value[0], value[1]))
+            else:
+                filters.append((column, [value], None, None))
+
+        return filters
+
+    def query(self, metric: str = "rtt_ms", group_by: list = (), since=None, until=None,
+              where: dict = None, bucket: int = 3600, quantiles: list = QUANTILES):
+        """
+        Filters the rows and aggregates one metric per group
+
+        Params:
+        - metric: rtt_ms, loss_pct or throughput_mbps
+        - group_by: any of device, target, test_type, success, time
+          (time = buckets of bucket seconds)
+        - since / until: ISO timestamp or unix seconds (until is exclusive)
+        - where: {column: value}, a list of values or a (low, high) range
+          with high exclusive and None for open ends, e.g.
+          {"test_type": "ping", "rtt_ms": (None, 100)}
+
+        Returns: list of {<group columns>, "count", "samples", "mean", "min",
+        "max", "p50", "p95"} ordered by group; count is the matching rows,
+        samples those that have the metric, the rest are over the samples
+        """
+        if metric not in METRICS:
+            raise ValueError(f"Unknown metric: {metric}")
+        for column in group_by:
+            if column not in GROUP_COLUMNS:
+                raise ValueError(f"Can't group by {column}")
+
+        filters = self.filters(since, until, where)
+        if filters is None or self.rows == 0:
+            return []
+
+        if numpy:
+            groups = self.aggregate_numpy(metric, group_by, filters, bucket, quantiles)
+        else:
+            groups = self.aggregate_python(metric, group_by, filters, bucket, quantiles)
+
+        results = []
+        for key, aggregates in groups:
+            row = {}
+            for column, value in zip(group_by, key):
+                if column == "time":
+                    row[column] = datetime.fromtimestamp(value).isoformat()
+                elif column == "success":
+                    row[column] = bool(value)
+                else:
+                    row[column] = self.dictionaries[column][int(value)]
+
+            row["count"] = aggregates.pop("count")
+            row["samples"] = aggregates.pop("samples")
+            for name, value in aggregates.items():
+                row[name] = round(float(value), 3) if value is not None else None
+            results.append(row)
+
+        return results
+
+    def aggregate_numpy(self, metric: str, group_by: list, filters: list, bucket: int, quantiles: list):
+        mask = numpy.ones(self.rows, dtype=bool)
+        for column, codes, low, high in filters:
+            data = self.columns[column]
+            if codes is not None:
+                mask &= numpy.isin(data, codes)
+            if low is not None:
+                mask &= data >= low
+            if high is not None:
+                mask &= data < high
+
+        selected = numpy.flatnonzero(mask)
+        if not len(selected):
+            return []
+
+        # One int64 key per row (mixed radix over the group columns), a 1-D
+        # unique is much faster than numpy.unique(axis=0)
+        combined = numpy.zeros(len(selected), dtype=numpy.int64)
+        radixes = []
+        for column in group_by:
+            if column == "time":
+                codes = numpy.floor(self.columns["timestamp"][selected] / bucket).astype(numpy.int64)
+                first = int(codes.min())
+                codes -= first
+                radix = int(codes.max()) + 1
+            else:
+                codes = self.columns[column][selected].astype(numpy.int64)
+                first = 0
+                radix = len(self.dictionaries[column]) if column in DICTIONARY_COLUMNS else 2
+            combined = combined * radix + codes
+            radixes.append((column, first, radix))
+
+        if math.prod(radix for _, _, radix in radixes) >= 2 ** 63:
+            raise ValueError("Too many groups, use a larger bucket or fewer group columns")
+
+        unique, inverse = numpy.unique(combined, return_inverse=True)
+        groups = len(unique)
+        values = self.columns[metric][selected]
+        valid = ~numpy.isnan(values)
+        counts = numpy.bincount(inverse, minlength=groups)
+        samples = numpy.bincount(inverse[valid], minlength=groups)
+        sums = numpy.bincount(inverse[valid], weights=values[valid], minlength=groups)
+
+        # Values sorted by group, then by value: every group is one slice
+        order = numpy.lexsort((values[valid], inverse[valid]))
+        ordered = values[valid][order] if valid.any() else numpy.zeros(1)
+        starts = numpy.concatenate(([0], numpy.cumsum(samples)[:-1]))
+        has = samples > 0
+        last = numpy.maximum(samples - 1, 0)
+
+        def pick(offsets):
+            # Groups without samples point past their slice, they are None anyway
+            return ordered[numpy.minimum(starts + offsets, len(ordered) - 1)]
+
+        columns = {
+            "mean": numpy.divide(sums, samples, out=numpy.zeros(groups), where=has),
+            "min": pick(numpy.zeros(groups, dtype=numpy.intp)),
+            "max": pick(last),
+        }
+        for q in quantiles:
+            position = q * last
+            low = numpy.floor(position).astype(numpy.intp)
+            high = numpy.ceil(position).astype(numpy.intp)
+            columns[f"p{round(q * 100)}"] = pick(low) + (pick(high) - pick(low)) * (position - low)
+
+        results = []
+        for i in range(groups):
+            key = []
+            rest = int(unique[i])
+            for column, first, radix in reversed(radixes):
+                rest, code = divmod(rest, radix)
+                key.append((code + first) * bucket if column == "time" else code)
+
+            aggregates = {"count": int(counts[i]), "samples": int(samples[i])}
+            for name, values in columns.items():
+                aggregates[name] = values[i] if has[i] else None
+            results.append((tuple(reversed(key)), aggregates))
+        return results
+
+    def aggregate_python(self, metric: str, group_by: list, filters: list, bucket: int, quantiles: list):
+        checks = [(self.columns[column], set(codes) if codes is not None else None, low, high)
+                  for column, codes, low, high in filters]
+        keys = [self.columns["timestamp" if column == "time" else column] for column in group_by]
+        values = self.columns[metric]
+
+        groups = {}
+        for i in range(self.rows):
+            matches = True
+            for data, codes, low, high in checks:
+                value = data[i]
+                if (codes is not None and value not in codes) or (low is not None and not value >= low) \
+                        or (high is not None and not value < high):
+                    matches = False
+                    break
+            if not matches:
+                continue
+
+            key = tuple(
+                math.floor(data[i] / bucket) * bucket if column == "time" else data[i]
+                for column, data in zip(group_by, keys)
+            )
+            group = groups.get(key)
+            if group is None:
+                group = groups[key] = [0, []]
+            group[0] += 1
+            if not math.isnan(values[i]):
+                group[1].append(values[i])
+
+        results = []
+        for key in sorted(groups):
+            count, samples = groups[key]
+            samples.sort()
+            aggregates = {"count": count, "samples": len(samples)}
+            aggregates["mean"] = sum(samples) / len(samples) if samples else None
+            aggregates["min"] = samples[0] if samples else None
+            aggregates["max"] = samples[-1] if samples else None
+            for q in quantiles:
+                aggregates[f"p{round(q * 100)}"] = interpolate(samples, q) if samples else None
+            results.append((key, aggregates))
+        return results
+
+def interpolate(ordered: list, q: float):
+    """ Quantile of sorted values with linear interpolation (like numpy's default) """
+    position = q * (len(ordered) - 1)
+    low = math.floor(position)
+    high = math.ceil(position)
+    return ordered[low] + (ordered[high] - ordered[low]) * (position - low)
+
+def to_unix(value):
+    """ ISO timestamp or unix seconds -> unix seconds (None stays None) """
+    if value is None or isinstance(value, (int, float)):
+        return value
+    return datetime.fromisoformat(value).timestamp()
+
+def open_export(path: str):
+    return ColumnTable(path)
+
+def main():
+    parser = argparse.ArgumentParser(description="Columnar export of test results")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    update = commands.add_parser("update", help="create the export or append new results")
+    update.add_argument("path")
+
+    query = commands.add_parser("query", help="aggregate a metric of an export")
+    query.add_argument("path")
+    query.add_argument("--metric", default="rtt_ms", choices=METRICS)
+    query.add_argument("--group-by", default="", help="comma separated: " + ", ".join(GROUP_COLUMNS))
+    query.add_argument("--bucket", type=int, default=3600, help="seconds per time bucket")
+    query.add_argument("--since", help="ISO timestamp")
+    query.add_argument("--until", help="ISO timestamp (exclusive)")
+    query.add_argument("--device")
+    query.add_argument("--target")
+    query.add_argument("--test-type")
+    args = parser.parse_args()
+
+    if args.command == "update":
+        result = update_export(args.path)
+        print(f"Appended {result['appended']} results, {result['rows']} in the export")
+        return
+
+    where = {}
+    for column in DICTIONARY_COLUMNS:
+        value = getattr(args, column)
+        if value:
+            where[column] = value
+
+    table = open_export(args.path)
+    group_by = [column for column in args.group_by.split(",") if column]
+    for row in table.query(args.metric, group_by, args.since, args.until, where, args.bucket):
+        print(json.dumps(row))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,252 @@
+"""
+profiling.py - Slow-query log and opt-in request profiling
+
+Both are off unless switched on with environment variables.
+
+Slow-query log (SNUTZ_SLOW_QUERY_MS=50):
+database.py connections time every statement, from execute() until its rows
+are fetched. Statements slower than the threshold are logged with their
+bound values, the number of SQLite VM instructions they took and their
+EXPLAIN QUERY PLAN. Slow sqlite3.connect() calls are logged too.
+
+Request profiling (header "X-Snutz-Profile: 1" or SNUTZ_PROFILE_SAMPLE=0.01):
+the request runs under cProfile, which (Python 3.12+) sees every thread, so
+the profile covers routing, the endpoint in the threadpool, the database
+calls, dict(row) and JSON encoding. Profiles of requests slower than
+SNUTZ_PROFILE_MIN_MS are written to SNUTZ_PROFILE_DIR as .prof files, open
+them with snakeviz / flameprof (flame graph) or "python -m pstats".
+Only one request is profiled at a time (one profiler per process).
+"""
+
+import cProfile
+import io
+import os
+import pstats
+import random
+import re
+import sqlite3
+import threading
+import time
+from datetime import datetime
+
+SLOW_QUERY_MS = float(os.environ.get("SNUTZ_SLOW_QUERY_MS", "0"))  # 0 = off
+PROGRESS_STEPS = 1000  # VM instructions between progress callbacks
+
+PROFILE_HEADER = "x-snutz-profile"
+PROFILE_SAMPLE_RATE = float(os.environ.get("SNUTZ_PROFILE_SAMPLE", "0"))  # 0..1 of all requests
+PROFILE_MIN_MS = float(os.environ.get("SNUTZ_PROFILE_MIN_MS", "0"))  # keep profiles of slower requests only
+PROFILE_DIR = os.environ.get("SNUTZ_PROFILE_DIR", "profiles")
+
+profile_lock = threading.Lock()
+
+def connect(path: str):
+    """
+    Opens a SQLite connection, timed when the slow-query log is on
+
+    Returns: a plain sqlite3 connection when it's off (no overhead)
+    """
+    if not SLOW_QUERY_MS:
+        return sqlite3.connect(path)
+
+    started = time.perf_counter()
+    connection = sqlite3.connect(path, factory=ProfiledConnection)
+    elapsed = (time.perf_counter() - started) * 1000
+
+    if elapsed >= SLOW_QUERY_MS:
+        print(f"[slow query] sqlite3.connect({path}) took {elapsed:.1f} ms")
+
+    return connection
+
+class ProfiledConnection(sqlite3.Connection):
+    """ Connection whose cursors time their statements """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.vm_steps = 0
+        self.last_statement = None
+
+        # Counts VM instructions (in thousands) of the running statement
+        self.set_progress_handler(self.count_steps, PROGRESS_STEPS)
+        # Gives us the statement with its bound values filled in
+        self.set_trace_callback(self.trace)
+
+    def count_steps(self):
+        self.vm_steps += 1
+        return 0  # 0 = keep going
+
+    def trace(self, statement: str):
+        self.last_statement = statement
+
+    def cursor(self, factory=None):
+        return super().cursor(factory or ProfiledCursor)
+
+    def execute(self, sql, parameters=()):
+        return self.cursor().execute(sql, parameters)
+
+    def executemany(self, sql, parameters):
+        return self.cursor().executemany(sql, parameters)
+
+    def query_plan(self, sql: str, parameters=()):
+        """ EXPLAIN QUERY PLAN of a statement, one line per step """
+        try:
+            cursor = sqlite3.Cursor(self)
+            cursor.execute("EXPLAIN QUERY PLAN " + sql, parameters)
+            return [row[3] for row in cursor.fetchall()]
+        except sqlite3.Error as e:
+            return [f"(no plan: {e})"]
+
+class ProfiledCursor(sqlite3.Cursor):
+    """
+    Times a statement from execute() until its rows are fetched
+
+    SQLite does most of the work of a SELECT while stepping through the
+    rows, so the fetch time belongs to the statement.
+    """
+
+    def execute(self, sql, parameters=()):
+        self.start_statement(sql, parameters)
+        started = time.perf_counter()
+        try:
+            return super().execute(sql, parameters)
+        finally:
+            self.add_time(started)
+            if not self.description:
+                # No rows to fetch (INSERT / UPDATE / DDL), it's done
+                self.finish_statement()
+
+    def executemany(self, sql, parameters):
+        parameters = list(parameters)
+        self.start_statement(sql, parameters[0] if parameters else ())
+        started = time.perf_counter()
+        try:
+            return super().executemany(sql, parameters)
+        finally:
+            self.add_time(started)
+            self.finish_statement(f" x {len(parameters)} rows")
+
+    def fetchone(self):
+        started = time.perf_counter()
+        try:
+            return super().fetchone()
+        finally:
+            self.add_time(started)
+            self.finish_statement()
+
+    def fetchall(self):
+        started = time.perf_counter()
+        try:
+            return super().fetchall()
+        finally:
+            self.add_time(started)
+            self.finish_statement()
+
+    def fetchmany(self, size=None):
+        started = time.perf_counter()
+        try:
+            return super().fetchmany(size or self.arraysize)
+        finally:
+            self.add_time(started)
+
+    def close(self):
+        self.finish_statement()
+        super().close()
+
+    def start_statement(self, sql, parameters):
+        self.finish_statement()
+        self.sql = sql
+        self.parameters = parameters
+        self.elapsed = 0.0
+        self.connection.vm_steps = 0
+
+    def add_time(self, started: float):
+        self.elapsed = getattr(self, "elapsed", 0.0) + time.perf_counter() - started
+
+    def finish_statement(self, suffix: str = ""):
+        """ Logs the statement if it was slow (once) """
+        sql = getattr(self, "sql", None)
+        if sql is None:
+            return
+        self.sql = None
+
+        elapsed = self.elapsed * 1000
+        if elapsed < SLOW_QUERY_MS:
+            return
+
+        statement = self.connection.last_statement or sql
+        steps = self.connection.vm_steps * PROGRESS_STEPS
+
+        # Only queries have a plan, DDL (CREATE / ALTER) doesn't
+        plan = []
+        if sql.lstrip().split(None, 1)[0].upper() in ("SELECT", "INSERT", "UPDATE", "DELETE", "REPLACE", "WITH"):
+            plan = self.connection.query_plan(sql, self.parameters)
+
+        print(f"[slow query] {elapsed:.1f} ms, ~{steps} VM steps{suffix}: {compact_sql(statement)}")
+        for line in plan:
+            print(f"[slow query]    plan: {line}")
+
+def compact_sql(sql: str):
+    """ Puts a statement on one line """
+    return re.sub(r"\s+", " ", sql).strip()
+
+def should_profile(headers):
+    """ Profile this request? (asked for with the header, or sampled) """
+    if headers.get(PROFILE_HEADER, "") not in ("", "0"):
+        return True
+    return PROFILE_SAMPLE_RATE > 0 and random.random() < PROFILE_SAMPLE_RATE
+
+async def profile_request(request, call_next):
+    """
+    HTTP middleware: runs a request under cProfile and saves the profile
+
+    The response gets an X-Snutz-Profile header with the file name
+    ("busy" when another request is being profiled).
+    """
+    if not should_profile(request.headers):
+        return await call_next(request)
+
+    # One profiler per process, others just run normally
+    if not profile_lock.acquire(blocking=False):
+        response = await call_next(request)
+        response.headers["X-Snutz-Profile"] = "busy"
+        return response
+
+    try:
+        profiler = cProfile.Profile()
+        started = time.perf_counter()
+        profiler.enable()
+        try:
+            response = await call_next(request)
+        finally:
+            profiler.disable()
+        elapsed = (time.perf_counter() - started) * 1000
+    finally:
+        profile_lock.release()
+
+    if elapsed >= PROFILE_MIN_MS:
+        path = save_profile(profiler, request.method, request.url.path, elapsed)
+        response.headers["X-Snutz-Profile"] = os.path.basename(path)
+
+    return response
+
+def save_profile(profiler, method: str, path: str, elapsed: float):
+    """
+    Writes <dir>/<time>_<method>_<path>.prof (+ a .txt with the top calls)
+
+    Returns: the .prof path
+    """
+    os.makedirs(PROFILE_DIR, exist_ok=True)
+
+    name = re.sub(r"[^A-Za-z0-9]+", "_", path).strip("_") or "root"
+    stamp = datetime.now().strftime("%Y%m%d-%H%M%S-%f")
+    base = os.path.join(PROFILE_DIR, f"{stamp}_{method}_{name}")
+
+    profiler.dump_stats(base + ".prof")
+
+    text = io.StringIO()
+    text.write(f"{method} {path} took {elapsed:.1f} ms\n\n")
+    pstats.Stats(profiler, stream=text).sort_stats("cumulative").print_stats(40)
+    with open(base + ".txt", "w") as f:
+        f.write(text.getvalue())
+
+    print(f"[profile] {method} {path} {elapsed:.1f} ms -> {base}.prof")
+    return base + ".prof"
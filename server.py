@@ -1,19 +1,128 @@
-from fastapi import FastAPI
-from fastapi.responses import FileResponse
+from fastapi import FastAPI, Body
+from fastapi.responses import FileResponse, JSONResponse, Response
 from fastapi.middleware.cors import CORSMiddleware
 from contextlib import asynccontextmanager
+from datetime import datetime
+import asyncio
+import os
+import sqlite3
+import admission
+import alerts
+import cluster
 import database
+import profiling
+import stats
+import storage
+import summary
+import throughput_server
+
+# SNUTZ_STORAGE picks the engine (sqlite / memory), see storage.py
+db = storage.db
+
+# Port agents run the "throughput" test against (0 = any free port)
+THROUGHPUT_PORT = int(os.environ.get("SNUTZ_THROUGHPUT_PORT", throughput_server.THROUGHPUT_PORT))
+
+# A device is offline after missing 3 heartbeats (agent.HEARTBEAT_INTERVAL = 30)
+OFFLINE_AFTER_SECONDS = int(os.environ.get("SNUTZ_OFFLINE_AFTER", "90"))
+SWEEP_INTERVAL = 15
+
+def write_heartbeats(device_ids: list):
+    """ One transaction for the heartbeats that arrived together (in the hub in cluster mode) """
+    results = db.update_heartbeats(device_ids)
+    for device_id, result in results.items():
+        if result is not None:
+            summary.device_seen(device_id, result["last_seen"])
+    return results
+
+# Heartbeats that arrive together are written in one transaction
+heartbeats = cluster.GroupCommit(write_heartbeats)
+
+@cluster.in_hub
+def heartbeats_arrived(items: list):
+    """ A worker's batch of heartbeats (device ids), joins the hub's next group commit """
+    heartbeats.submit_many(items)
+
+# Workers answer heartbeats themselves and send them to the hub in batches
+heartbeat_batcher = cluster.Batcher(heartbeats_arrived)
+known_devices = set()  # ids a worker has found registered (devices are never deleted)
+
+def worker_heartbeat(device_id: str):
+    """ Queues a heartbeat for the hub. Returns: like update_heartbeat, None for an unknown device """
+    if device_id not in known_devices:
+        if db.get_device(device_id) is None:
+            return None
+        known_devices.add(device_id)
+
+    heartbeat_batcher.add(device_id)
+    return {"last_seen": datetime.now().isoformat(), "status": "online"}
+
+async def run_periodically(interval: float, function):
+    """ Runs a blocking function every interval seconds (in a thread, off the event loop) """
+    while True:
+        await asyncio.sleep(interval)
+        try:
+            await asyncio.to_thread(function)
+        except Exception as e:
+            print(f"Periodic task {function.__name__} failed: {e}")
+
+def ingest_metrics(device_id: str, target: str, test_type: str, result_data, timestamp: str, result_id: int = None):
+    """ Alerting, streaming stats and the dashboard summary for a new result (alerts compare with the stats before it) """
+    metrics = stats.extract_metrics(test_type, result_data)
+    new_alerts = alerts.check_result(device_id, target, test_type, metrics, timestamp)
+    stats.record_result(device_id, target, test_type, metrics, timestamp)
+    summary.record_result(device_id, target, test_type, metrics, timestamp, result_id)
+    return new_alerts
+
+def sweep_devices():
+    """ Sets the devices that stopped sending heartbeats offline """
+    for device in db.sweep_offline_devices(OFFLINE_AFTER_SECONDS):
+        print(f"Device {device['device_id']} is offline (last seen {device['last_seen']})")
+        summary.device_offline(device["device_id"], device["last_seen"])
+
+def checkpoint_stats():
+    """ Saves the stats that changed since the last checkpoint """
+    rows = stats.take_checkpoint()
+    try:
+        db.save_target_stats(rows)
+    except Exception:
+        # e.g. SQLITE_BUSY: keep them for the next checkpoint
+        stats.checkpoint_failed(rows)
+        raise
 
 @asynccontextmanager
 async def lifespan(app: FastAPI):
+    # HTTP worker of "python cluster.py": the hub owns the database and the background tasks
+    if cluster.WORKER:
+        cluster.connect()
+        yield
+        heartbeat_batcher.flush()
+        cluster.client.close()
+        return
+
     # Startup
     print("Starting sNutz server...")
-    database.init_database()
+    db.init_database()
+    stats.load_checkpoint(db.load_target_stats())
+    alerts.load_rules(db.get_alert_rules())
+    alerts.load_active(db.get_alerts(active_only=True, limit=100000))
+    summary.load(db.get_all_devices(), db.get_latest_results())
+    throughput = throughput_server.start_throughput_server(port=THROUGHPUT_PORT)
+    tasks = [
+        asyncio.create_task(run_periodically(stats.STATS_CHECKPOINT_INTERVAL, checkpoint_stats)),
+        asyncio.create_task(run_periodically(SWEEP_INTERVAL, sweep_devices)),
+        asyncio.create_task(run_periodically(storage.SNAPSHOT_INTERVAL, db.snapshot))
+    ]
     print("Server Ready!")
     yield
     
     # Shutdown
     print("sNutz server shutting down...")
+    for task in tasks:
+        task.cancel()
+    checkpoint_stats()
+    db.snapshot()
+    throughput.shutdown()
+    throughput.server_close()
 
 app = FastAPI(lifespan=lifespan)
 
@@ -25,24 +134,93 @@ app.add_middleware(
     allow_headers=["*"]
 )
 
+# Opt-in per-request profiling (X-Snutz-Profile header or SNUTZ_PROFILE_SAMPLE)
+app.middleware("http")(profiling.profile_request)
+
+# Bulk uploads get 429 + Retry-After when they'd starve heartbeats and polls
+app.middleware("http")(admission.admit_request)
+
+@app.exception_handler(sqlite3.OperationalError)
+async def database_error(request, exc):
+    """ "database is locked": tell the client to try again (anything else is a real 500) """
+    if not database.is_busy(exc):
+        raise exc
+    return JSONResponse(
+        status_code=503,
+        content={"error": f"Database error: {exc}"},
+        headers={"Retry-After": "1"}
+    )
+
+@app.exception_handler(cluster.HubTimeout)
+async def hub_timeout(request, exc):
+    """ Cluster mode: the hub is overloaded, the call may still be applied """
+    return JSONResponse(
+        status_code=504,
+        content={"error": f"{exc}, the request may still be applied"},
+        headers={"Retry-After": "5"}
+    )
+
 @app.get("/")
 def home():
     return {"message": "Hello from SNUTZ!"}
 
+@app.get("/dashboard/summary")
+@cluster.funnel
+def get_dashboard_summary():
+    """ Devices, latest results and fleet success rates in one call, from memory (see summary.py) """
+    return Response(content=summary.get_summary(), media_type="application/json")
+
+@app.get("/admission")
+def get_admission():
+    """ State of the ingest admission control (queue, rejections) """
+    return admission.status()
+
 @app.get("/devices")
 def get_devices():
-    devices = database.get_all_devices()
+    devices = db.get_all_devices()
     return {"devices": devices}
 
+@app.get("/devices/status/counts")
+def get_device_status_counts():
+    """ Number of devices per status (online / offline) """
+    counts = db.get_device_status_counts()
+    return {
+        "total": sum(counts.values()),
+        "counts": counts
+    }
+
+@app.get("/devices/down")
+def get_down_devices(limit: int = 100):
+    """ Devices that are offline, most recently seen first """
+    devices = db.get_down_devices(limit)
+    return {
+        "count": len(devices),
+        "devices": devices
+    }
+
+@app.get("/devices/events")
+def get_device_events(device_id: str = None, limit: int = 50):
+    """ Online / offline transitions (optionally of one device) """
+    events = db.get_device_events(device_id, limit)
+    return {
+        "count": len(events),
+        "events": events
+    }
+
 @app.post("/devices/register")
+@cluster.funnel
 def register_device(device_id: str, name: str):
-    device = database.register_device(device_id, name)
+    device = db.register_device(device_id, name)
+    summary.set_device(device)
     return {"message": "Device Registered!", "Device": device}
 
 @app.post("/devices/{device_id}/heartbeat")
 def hearbeat(device_id: str):
-    """ Agent check if still online """
-    result = database.update_heartbeat(device_id)
+    """ Agent check if still online (batched to the hub in cluster mode, see cluster.py) """
+    if cluster.WORKER:
+        result = worker_heartbeat(device_id)
+    else:
+        result = heartbeats.submit(device_id)
     
     if result is None:
         return {"error": "Device not found"}, 404
@@ -54,39 +232,83 @@ def hearbeat(device_id: str):
     }
     
 @app.post("/tests/results")
+@cluster.funnel
 def submit_test_result(device_id: str, test_type: str, target: str, result_data: str, triggered_by: str = "manual"):
     """ Receives test result from agent """
-    result = database.save_test_result(
+    result = db.save_test_result(
         device_id,
         test_type,
         target,
         result_data,
         triggered_by
     )
+    new_alerts = ingest_metrics(device_id, target, test_type, result_data, result["timestamp"], result["id"])
     return{
         "message": "Test result saved",
-        "result": result
+        "result": result,
+        "alerts": new_alerts
     }
     
 @app.get("/tests/results")
 def get_test_resulst(device_id: str = None, limit: int = 50):
     """Gets test results (optional filter by deviceId) """
-    results = database.get_test_results(device_id, limit)
+    results = db.get_test_results(device_id, limit)
     return {
         "count": len(results),
         "results": results
     }
     
+@app.get("/tests/results/{result_id}")
+def get_test_result(result_id: int):
+    """ Gets one test result with its raw output (the list leaves the output out) """
+    result = db.get_test_result(result_id)
+    
+    if result is None:
+        return JSONResponse(status_code=404, content={"error": "Result not found"})
+    
+    return {"result": result}
+
+@app.get("/routes/paths/{path_id}")
+def get_route_path(path_id: int):
+    """ Gets a traceroute path (the path_id of a result) and the devices on it """
+    path = db.get_route_path(path_id)
+
+    if path is None:
+        return JSONResponse(status_code=404, content={"error": "Path not found"})
+
+    return {"path": path}
+
+@app.get("/routes/hops/{address}")
+def get_hop_routes(address: str, limit: int = 100):
+    """ Gets the devices / targets whose current path goes through a hop """
+    routes = db.get_hop_routes(address, limit)
+    return {
+        "address": address,
+        "count": len(routes),
+        "routes": routes
+    }
+
+@app.get("/routes/changes")
+def get_route_changes(device_id: str = None, target: str = None, limit: int = 50):
+    """ Gets the traceroute path changes, newest first (optionally filtered) """
+    changes = db.get_route_changes(device_id, target, limit)
+    return {
+        "count": len(changes),
+        "changes": changes
+    }
+
 @app.post("/commands/create")
+@cluster.funnel
 def create_command(device_id: str, command_type: str, parameters: str = None):
     """ Creates a command for a device to execute """
     
     # Check if device exists
-    device = database.get_device(device_id)
+    device = db.get_device(device_id)
     if not device:
         return {"error": "Device not found"}, 404
     
-    command = database.create_command(device_id, command_type, parameters)
+    command = db.create_command(device_id, command_type, parameters)
+    cluster.invalidate(f"commands:{device_id}")
     
     return {
         "message": "Command created",
@@ -94,18 +316,33 @@ def create_command(device_id: str, command_type: str, parameters: str = None):
     }
 
 @app.post("/commands/{command_id}/complete")
+@cluster.funnel
 def complete_command(command_id: int, result_id: int = None, status: str = "completed"):
     """Marks a command as completed"""
-    result = database.update_command_status(command_id, status, result_id)
+    result = db.update_command_status(command_id, status, result_id)
+    if result["device_id"]:
+        cluster.invalidate(f"commands:{result['device_id']}")
     return {
         "message": "Command updated",
         "result": result
     }
     
 @app.get("/commands/pending/{device_id}")
-def get_pending_commands(device_id: str):
-    """ Agents checks for pending commands """
-    commands = database.get_pending_commands(device_id)
+async def get_pending_commands(device_id: str, wait: float = 0):
+    """
+    Agents checks for pending commands
+    
+    wait > 0: long poll, if there are none the request waits up to wait
+    seconds for a new one
+    """
+    key = f"commands:{device_id}"
+    since = cluster.generation(key)
+    commands = await asyncio.to_thread(cluster.cached, key, db.get_pending_commands, device_id)
+    
+    if not commands and wait > 0:
+        await cluster.wait_for(key, wait, since)
+        commands = await asyncio.to_thread(cluster.cached, key, db.get_pending_commands, device_id)
+    
     return {
         "count": len(commands),
         "commands": commands
@@ -114,13 +351,14 @@ def get_pending_commands(device_id: str):
 @app.get("/commands")
 def get_all_commands(device_id: str = None, limit: int = 50):
     """ Views all commands """
-    commands = database.get_all_commands(device_id, limit)
+    commands = db.get_all_commands(device_id, limit)
     return{
         "count": len(commands),
         "commands": commands
     }
     
 @app.post("/schedules/create")
+@cluster.funnel
 def create_schedule(
     device_id: str,
     test_type: str,
@@ -130,11 +368,11 @@ def create_schedule(
 ):
     """Creates a new test schedule"""
     #validate that device exists
-    device = database.get_device(device_id)
+    device = db.get_device(device_id)
     if not device:
         return {"error": "device not found"}, 404
     
-    schedule = database.create_schedule(
+    schedule = db.create_schedule(
         device_id, test_type, interval_seconds, target, parameters
     )
     
@@ -146,7 +384,7 @@ def create_schedule(
 @app.get("/schedules")
 def get_schedules(device_id: str = None, enabled_only: bool = False):
     """ Gets all schedules (optionally filtered) """
-    schedules = database.get_schedules(device_id, enabled_only)
+    schedules = db.get_schedules(device_id, enabled_only)
     return {
         "count": len(schedules),
         "schedules": schedules
@@ -155,25 +393,32 @@ def get_schedules(device_id: str = None, enabled_only: bool = False):
 @app.get("/schedules/due/{device_id}")
 def get_due_schedules(device_id: str):
     """Gets schedules that are due to run for this device"""
-    schedules = database.get_schedules_due_to_run(device_id)
+    schedules = db.get_schedules_due_to_run(device_id)
     return {
         "count": len(schedules),
         "schedules": schedules
     }
     
+@app.get("/schedules/sync/{device_id}")
+def sync_schedules(device_id: str, since: int = 0):
+    """ Agents fetch the schedules that changed since the version they have """
+    return db.get_schedule_changes(device_id, since)
+    
 @app.post("/schedules/{schedule_id}/toggle")
+@cluster.funnel
 def toggle_schedule(schedule_id: int, enabled: bool):
     """Enabled/Disable a schedule"""
-    result = database.toggle_schedule(schedule_id, enabled)
+    result = db.toggle_schedule(schedule_id, enabled)
     return {
         "message": "Schedule updated",
         "result": result
     }
     
 @app.post("/schedules/{schedule_id}/ran")
-def mark_schedule_ran(schedule_id: int):
-    """Marks that a schedule just ran"""
-    result = database.update_schedule_last_run(schedule_id)
+@cluster.funnel
+def mark_schedule_ran(schedule_id: int, ran_at: str = None):
+    """Marks that a schedule ran (now, or at ran_at for results uploaded late)"""
+    result = db.update_schedule_last_run(schedule_id, ran_at)
     return {
         "message": "Schedule updated",
         "result": result
@@ -181,12 +426,111 @@ def mark_schedule_ran(schedule_id: int):
     }
 
 @app.delete("/schedules/{schedule_id}")
+@cluster.funnel
 def delete_schedule(schedule_id: int):
     """Deletes a schedule"""
-    result = database.delete_schedule(schedule_id)
+    result = db.delete_schedule(schedule_id)
     return {
         "message": "Schedule deleted",
         "result": result
     }
     
-    
\ No newline at end of file
+    
+
+@app.post("/monitor/summaries")
+@cluster.funnel
+def submit_monitor_summaries(device_id: str, target: str, summaries: list[dict] = Body(...)):
+    """ Receives a batch of monitor summaries from an agent """
+    malformed = [
+        i for i, window in enumerate(summaries)
+        if not isinstance(window.get("window_start"), str) or not isinstance(window.get("window_end"), str)
+    ]
+    if malformed:
+        return JSONResponse(status_code=400, content={"error": f"summaries {malformed} need window_start and window_end"})
+
+    result = db.save_monitor_summaries(device_id, target, summaries)
+    saved = set(result["saved_windows"])
+    for window in summaries:
+        # Windows sent before (a retried batch) are already in the stats
+        if window["window_start"] in saved:
+            saved.discard(window["window_start"])
+            ingest_metrics(device_id, target, "monitor", window, window["window_end"])
+    return {
+        "message": "Monitor summaries saved",
+        "result": result
+    }
+
+@app.get("/monitor/summaries")
+def get_monitor_summaries(device_id: str = None, target: str = None, limit: int = 360):
+    """ Gets monitor summaries (optionally filtered) """
+    summaries = db.get_monitor_summaries(device_id, target, limit)
+    return {
+        "count": len(summaries),
+        "summaries": summaries
+    }
+
+@app.get("/stats")
+@cluster.funnel
+def get_fleet_stats(target: str, test_type: str):
+    """ Stats of a target over every device that tests it (merged) """
+    return stats.get_fleet_stats(target, test_type)
+
+@app.get("/stats/{device_id}")
+@cluster.funnel
+def get_device_stats(device_id: str, target: str = None, test_type: str = None):
+    """ Streaming stats of a device (optionally one target / test type) """
+    results = stats.get_stats(device_id, target, test_type)
+    return {
+        "count": len(results),
+        "stats": results
+    }
+
+@app.get("/alerts")
+def get_alerts(device_id: str = None, active_only: bool = False, limit: int = 50):
+    """ Gets the latest alerts (optionally only the unresolved ones) """
+    results = db.get_alerts(device_id, active_only, limit)
+    return {
+        "count": len(results),
+        "alerts": results
+    }
+
+@app.post("/alerts/rules/create")
+@cluster.funnel
+def create_alert_rule(
+    metric: str,
+    operator: str,
+    threshold: float,
+    device_id: str = None,
+    target: str = None,
+    test_type: str = None
+):
+    """ Creates a threshold alert, e.g. metric=rtt_ms operator=> threshold=100 """
+    if operator not in alerts.OPERATORS:
+        return JSONResponse(status_code=400, content={"error": f"operator must be one of {', '.join(alerts.OPERATORS)}"})
+    
+    rule = db.create_alert_rule(metric, operator, threshold, device_id, target, test_type)
+    alerts.load_rules(db.get_alert_rules())
+    return {
+        "message": "Alert rule created",
+        "rule": rule
+    }
+
+@app.get("/alerts/rules")
+def get_alert_rules():
+    """ Gets all alert rules """
+    rules = db.get_alert_rules()
+    return {
+        "count": len(rules),
+        "rules": rules
+    }
+
+@app.delete("/alerts/rules/{rule_id}")
+@cluster.funnel
+def delete_alert_rule(rule_id: int):
+    """ Deletes an alert rule """
+    result = db.delete_alert_rule(rule_id)
+    alerts.load_rules(db.get_alert_rules())
+    return {
+        "message": "Alert rule deleted",
+        "result": result
+    }
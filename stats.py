@@ -0,0 +1,462 @@
+"""
+stats.py - Streaming per-target statistics
+
+Every ingested result updates the statistics of its (device, target,
+test_type) in memory: an EWMA (with its variance), a DDSketch for quantiles,
+min / max / last per metric and result / failure counters. Updating and
+reading is O(1), nothing is re-parsed from the stored results.
+
+The sketches are mergeable, so fleet-wide views (one target measured by
+many devices) are exact merges of the per-device sketches.
+
+server.py loads the checkpoint at startup and saves the changed entries to
+SQLite every STATS_CHECKPOINT_INTERVAL seconds.
+"""
+
+import json
+import math
+import re
+import threading
+from datetime import datetime
+
+EWMA_ALPHA = 0.1           # weight of a new value in the EWMA
+SKETCH_ACCURACY = 0.01     # relative accuracy of the quantiles (1%)
+SKETCH_MAX_BINS = 2048     # memory cap per sketch, lowest bins are merged beyond it
+SKETCH_MIN_VALUE = 1e-9    # values below this count as zero
+STATS_CHECKPOINT_INTERVAL = 60
+QUANTILES = [0.5, 0.9, 0.95, 0.99]
+
+class Ewma:
+    """ Exponentially weighted moving average and variance """
+
+    def __init__(self, alpha: float = EWMA_ALPHA, mean: float = None, variance: float = 0.0):
+        self.alpha = alpha
+        self.mean = mean
+        self.variance = variance
+
+    def add(self, value: float):
+        if self.mean is None:
+            self.mean = value
+            return
+
+        diff = value - self.mean
+        increment = self.alpha * diff
+        self.mean += increment
+        self.variance = (1 - self.alpha) * (self.variance + diff * increment)
+
+    @property
+    def std(self):
+        return math.sqrt(self.variance)
+
+    def to_dict(self):
+        return {"mean": self.mean, "variance": self.variance}
+
+    @classmethod
+    def from_dict(cls, data: dict):
+        return cls(mean=data["mean"], variance=data["variance"])
+
+class DDSketch:
+    """
+    Quantile sketch with relative accuracy (DDSketch)
+
+    Values go into logarithmic buckets, every quantile is within
+    SKETCH_ACCURACY of the real value. Two sketches merge by adding
+    their bucket counts.
+    """
+
+    def __init__(self, accuracy: float = SKETCH_ACCURACY):
+        self.accuracy = accuracy
+        self.gamma = (1 + accuracy) / (1 - accuracy)
+        self.log_gamma = math.log(self.gamma)
+        self.bins = {}
+        self.zero_count = 0
+        self.count = 0
+
+    def add(self, value: float):
+        self.count += 1
+
+        if value < SKETCH_MIN_VALUE:
+            self.zero_count += 1
+            return
+
+        index = math.ceil(math.log(value) / self.log_gamma)
+        self.bins[index] = self.bins.get(index, 0) + 1
+
+        if len(self.bins) > SKETCH_MAX_BINS:
+            self.collapse()
+
+    def collapse(self):
+        """ Merges the lowest buckets so memory stays bounded (high quantiles stay exact) """
+        keys = sorted(self.bins)
+        extra = keys[:len(keys) - SKETCH_MAX_BINS + 1]
+        target = keys[len(extra)]
+        for key in extra:
+            self.bins[target] += self.bins.pop(key)
+
+    def quantile(self, q: float):
+        if self.count == 0:
+            return None
+
+        rank = q * (self.count - 1)
+        if rank < self.zero_count:
+            return 0.0
+
+        seen = self.zero_count
+        for index in sorted(self.bins):
+            seen += self.bins[index]
+            if seen > rank:
+                # Middle of the bucket, within the accuracy of every value in it
+                return 2 * self.gamma ** index / (self.gamma + 1)
+
+        return 2 * self.gamma ** max(self.bins) / (self.gamma + 1)
+
+    def merge(self, other: "DDSketch"):
+        for index, count in other.bins.items():
+            self.bins[index] = self.bins.get(index, 0) + count
+        self.zero_count += other.zero_count
+        self.count += other.count
+
+        if len(self.bins) > SKETCH_MAX_BINS:
+            self.collapse()
+
+    def to_dict(self):
+        return {"bins": self.bins, "zero_count": self.zero_count, "count": self.count}
+
+    @classmethod
+    def from_dict(cls, data: dict):
+        sketch = cls()
+        sketch.bins = {int(index): count for index, count in data["bins"].items()}
+        sketch.zero_count = data["zero_count"]
+        sketch.count = data["count"]
+        return sketch
+
+class MetricStats:
+    """ Online statistics of one metric (e.g. rtt_ms) """
+
+    def __init__(self):
+        self.count = 0
+        self.ewma = Ewma()
+        self.sketch = DDSketch()
+        self.min = None
+        self.max = None
+        self.last = None
+        self.last_at = None  # timestamp of last, so merges keep the newest one
+
+    def add(self, value: float, timestamp: str = None):
+        self.count += 1
+        self.ewma.add(value)
+        self.sketch.add(value)
+        self.min = value if self.min is None else min(self.min, value)
+        self.max = value if self.max is None else max(self.max, value)
+        self.last = value
+        self.last_at = timestamp
+
+    def merge(self, other: "MetricStats"):
+        """
+        Merges another device's stats
+
+        The EWMA becomes a count weighted mean, the variance the pooled one
+        (within each device plus between the device means).
+        """
+        total = self.count + other.count
+        if total and other.ewma.mean is not None:
+            mine = self.ewma.mean if self.ewma.mean is not None else 0.0
+            mean = (mine * self.count + other.ewma.mean * other.count) / total
+            self.ewma.variance = (
+                self.count * (self.ewma.variance + (mine - mean) ** 2)
+                + other.count * (other.ewma.variance + (other.ewma.mean - mean) ** 2)
+            ) / total
+            self.ewma.mean = mean
+
+        self.count = total
+        self.sketch.merge(other.sketch)
+        self.min = other.min if self.min is None else min(self.min, other.min if other.min is not None else self.min)
+        self.max = other.max if self.max is None else max(self.max, other.max if other.max is not None else self.max)
+        if other.last is not None and (self.last is None or (other.last_at or "") > (self.last_at or "")):
+            self.last = other.last
+            self.last_at = other.last_at
+
+    def summary(self):
+        def rounded(value):
+            return round(value, 3) if value is not None else None
+
+        result = {
+            "count": self.count,
+            "ewma": rounded(self.ewma.mean),
+            "ewm_std": rounded(self.ewma.std),
+            "min": rounded(self.min),
+            "max": rounded(self.max),
+            "last": rounded(self.last)
+        }
+        for q in QUANTILES:
+            result[f"p{round(q * 100)}"] = rounded(self.sketch.quantile(q))
+        return result
+
+    def to_dict(self):
+        return {
+            "count": self.count,
+            "ewma": self.ewma.to_dict(),
+            "sketch": self.sketch.to_dict(),
+            "min": self.min,
+            "max": self.max,
+            "last": self.last,
+            "last_at": self.last_at
+        }
+
+    @classmethod
+    def from_dict(cls, data: dict):
+        metric = cls()
+        metric.count = data["count"]
+        metric.ewma = Ewma.from_dict(data["ewma"])
+        metric.sketch = DDSketch.from_dict(data["sketch"])
+        metric.min = data["min"]
+        metric.max = data["max"]
+        metric.last = data["last"]
+        metric.last_at = data.get("last_at")  # not in older checkpoints
+        return metric
+
+class TargetStats:
+    """ Everything we know about one (device, target, test_type) """
+
+    def __init__(self):
+        self.results = 0
+        self.failures = 0
+        self.last_seen = None
+        self.metrics = {}
+
+    def add(self, metrics: dict, timestamp: str = None):
+        self.results += 1
+        if not metrics.get("success"):
+            self.failures += 1
+        self.last_seen = timestamp or datetime.now().isoformat()
+
+        for name, value in metrics.items():
+            if name == "success" or value is None:
+                continue
+            if name not in self.metrics:
+                self.metrics[name] = MetricStats()
+            self.metrics[name].add(value, self.last_seen)
+
+    def merge(self, other: "TargetStats"):
+        self.results += other.results
+        self.failures += other.failures
+        if other.last_seen and (self.last_seen is None or other.last_seen > self.last_seen):
+            self.last_seen = other.last_seen
+
+        for name, metric in other.metrics.items():
+            if name not in self.metrics:
+                self.metrics[name] = MetricStats()
+            self.metrics[name].merge(metric)
+
+    def summary(self):
+        return {
+            "results": self.results,
+            "failures": self.failures,
+            "success_rate": round((self.results - self.failures) / self.results, 4) if self.results else None,
+            "last_seen": self.last_seen,
+            "metrics": {name: metric.summary() for name, metric in self.metrics.items()}
+        }
+
+    def to_dict(self):
+        return {
+            "results": self.results,
+            "failures": self.failures,
+            "last_seen": self.last_seen,
+            "metrics": {name: metric.to_dict() for name, metric in self.metrics.items()}
+        }
+
+    @classmethod
+    def from_dict(cls, data: dict):
+        stats = cls()
+        stats.results = data["results"]
+        stats.failures = data["failures"]
+        stats.last_seen = data["last_seen"]
+        stats.metrics = {name: MetricStats.from_dict(metric) for name, metric in data["metrics"].items()}
+        return stats
+
+# (device_id, target, test_type) -> TargetStats
+target_stats = {}
+by_device = {}   # device_id -> set of keys
+by_target = {}   # (target, test_type) -> set of device_ids
+dirty = set()    # keys changed since the last checkpoint
+stats_lock = threading.Lock()
+
+def extract_metrics(test_type: str, result_data):
+    """
+    Pulls the numbers we keep statistics on out of a result
+
+    Params:
+    - test_type: "ping", "traceroute", "speedtest", "throughput", "monitor"
+    - result_data: the result (JSON string or dict)
+
+    Returns: dict with success and whatever of rtt_ms, loss_pct,
+    hop_count, throughput_mbps the result has
+    """
+    if isinstance(result_data, str):
+        try:
+            result_data = json.loads(result_data)
+        except ValueError:
+            return {"success": False}
+
+    if not isinstance(result_data, dict):
+        return {"success": False}
+
+    success = bool(result_data.get("success"))
+    metrics = {"success": success}
+
+    if test_type == "ping":
+        metrics["rtt_ms"], metrics["loss_pct"] = parse_ping(result_data)
+        if not success and metrics["loss_pct"] is None:
+            metrics["loss_pct"] = 100.0
+
+    elif test_type == "traceroute":
+        hops = [hop for hop in result_data.get("hops", []) if isinstance(hop, dict)]
+        # As stored (database.split_route): the rtts per hop, the path is in route_paths
+        if "hop_rtts" in result_data:
+            hops = [{"rtts": rtts} for rtts in result_data["hop_rtts"]]
+            if hops:
+                last = hops[-1]["rtts"]
+                lost = sum(1 for rtt in last if rtt is None)
+                hops[-1]["loss_pct"] = round(lost * 100 / len(last), 1) if last else 100.0
+        if success and hops:
+            metrics["hop_count"] = len(hops)
+            rtts = [rtt for rtt in hops[-1].get("rtts", []) if rtt is not None]
+            metrics["rtt_ms"] = min(rtts) if rtts else None
+            metrics["loss_pct"] = hops[-1].get("loss_pct")
+
+    elif test_type == "speedtest":
+        metrics["throughput_mbps"] = result_data.get("download_mbps")
+        metrics["rtt_ms"] = result_data.get("ping_ms")
+
+    elif test_type == "throughput":
+        metrics["throughput_mbps"] = result_data.get("download_mbps") or result_data.get("upload_mbps")
+
+    elif test_type == "monitor":
+        # Window summaries have no "success", a window with replies counts as one
+        success = bool(result_data.get("success", result_data.get("received", 0) > 0))
+        metrics["success"] = success
+        metrics["rtt_ms"] = result_data.get("rtt_avg_ms")
+        metrics["loss_pct"] = result_data.get("loss_pct")
+        if not success and metrics["loss_pct"] is None:
+            metrics["loss_pct"] = 100.0
+
+    return metrics
+
+def parse_ping(result_data: dict):
+    """
+    Average RTT and packet loss of a ping result
+
+    Uses the structured fields if the agent sent them, otherwise parses
+    the ping summary (linux / mac / windows)
+
+    Returns: (rtt_ms, loss_pct), None where unknown
+    """
+    rtt = result_data.get("rtt_avg_ms")
+    loss = result_data.get("packet_loss_pct")
+    if rtt is not None or loss is not None:
+        return rtt, loss
+
+    text = "\n".join(result_data.get("summary") or []) or result_data.get("output") or ""
+
+    # "0% packet loss" (linux / mac), "(0% loss)" (windows)
+    match = re.search(r"([\d.]+)% (?:packet )?loss", text)
+    if match:
+        loss = float(match.group(1))
+
+    # "rtt min/avg/max/mdev = 9.1/10.2/12.3/1.1 ms", windows: "Average = 10ms"
+    match = re.search(r"= [\d.]+/([\d.]+)/", text) or re.search(r"Average = ([\d.]+)ms", text)
+    if match:
+        rtt = float(match.group(1))
+
+    return rtt, loss
+
+def record_result(device_id: str, target: str, test_type: str, metrics: dict, timestamp: str = None):
+    """ Updates the statistics with one result (O(1)) """
+    key = (device_id, target or "", test_type)
+
+    with stats_lock:
+        stats = target_stats.get(key)
+        if stats is None:
+            stats = target_stats[key] = TargetStats()
+            by_device.setdefault(device_id, set()).add(key)
+            by_target.setdefault((key[1], test_type), set()).add(device_id)
+
+        stats.add(metrics, timestamp)
+        dirty.add(key)
+
+def get_baseline(device_id: str, target: str, test_type: str):
+    """
+    What a new result is compared against (call before record_result)
+
+    Returns: {"results": n, "metrics": {name: {"count", "mean", "std", "last"}}}
+    or None if we haven't seen this target yet
+    """
+    with stats_lock:
+        stats = target_stats.get((device_id, target or "", test_type))
+        if stats is None:
+            return None
+
+        return {
+            "results": stats.results,
+            "metrics": {
+                name: {"count": m.count, "mean": m.ewma.mean, "std": m.ewma.std, "last": m.last}
+                for name, m in stats.metrics.items()
+            }
+        }
+
+def get_stats(device_id: str, target: str = None, test_type: str = None):
+    """
+    Statistics of one device
+
+    Returns: list of {target, test_type, ...summary} (one entry when
+    target and test_type are both given)
+    """
+    with stats_lock:
+        if target is not None and test_type is not None:
+            keys = [(device_id, target, test_type)]
+        else:
+            keys = [
+                key for key in by_device.get(device_id, ())
+                if (target is None or key[1] == target) and (test_type is None or key[2] == test_type)
+            ]
+
+        return [
+            {"device_id": key[0], "target": key[1], "test_type": key[2], **target_stats[key].summary()}
+            for key in sorted(keys) if key in target_stats
+        ]
+
+def get_fleet_stats(target: str, test_type: str):
+    """ Statistics of one target over every device that measures it (merged sketches) """
+    merged = TargetStats()
+
+    with stats_lock:
+        device_ids = sorted(by_target.get((target, test_type), ()))
+        for device_id in device_ids:
+            merged.merge(target_stats[(device_id, target, test_type)])
+
+    return {"target": target, "test_type": test_type, "devices": len(device_ids), **merged.summary()}
+
+def load_checkpoint(rows: list):
+    """ Restores the statistics from database.load_target_stats() rows """
+    with stats_lock:
+        for row in rows:
+            key = (row["device_id"], row["target"], row["test_type"])
+            target_stats[key] = TargetStats.from_dict(json.loads(row["data"]))
+            by_device.setdefault(key[0], set()).add(key)
+            by_target.setdefault((key[1], key[2]), set()).add(key[0])
+
+def take_checkpoint():
+    """
+    Serializes the entries that changed since the last checkpoint
+
+    Returns: list of (device_id, target, test_type, data) for database.save_target_stats
+    """
+    with stats_lock:
+        rows = [(*key, json.dumps(target_stats[key].to_dict())) for key in dirty]
+        dirty.clear()
+    return rows
+
+def checkpoint_failed(rows: list):
+    """ Marks the rows of a checkpoint that could not be saved as changed again """
+    with stats_lock:
+        dirty.update(row[:3] for row in rows)
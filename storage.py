@@ -0,0 +1,942 @@
+"""
+storage.py - Pluggable storage engines for the server
+
+server.py (and alerts.py) talk to storage.db, which is picked with the
+SNUTZ_STORAGE environment variable:
+
+- "sqlite" (default): database.py, one file or SNUTZ_SHARDS shard files
+- "memory": everything in dicts and lists in this process. Much faster
+  ingest, meant for big fleets on one box, tests and benchmarks. With
+  SNUTZ_SNAPSHOT=path the data is written to that JSON file every
+  SNUTZ_SNAPSHOT_INTERVAL seconds (and at shutdown) and loaded at startup,
+  without it everything is gone when the server stops.
+
+Every engine has the methods of Storage, with the signatures and return
+values of the database.py functions of the same name. Storage is abstract:
+an engine that misses one can't be created.
+storage_conformance.py checks that the engines behave the same.
+"""
+
+import base64
+import json
+import os
+import threading
+from abc import ABC, abstractmethod
+from datetime import datetime, timedelta
+
+import database
+
+STORAGE = os.environ.get("SNUTZ_STORAGE", "sqlite")
+SNAPSHOT_FILE = os.environ.get("SNUTZ_SNAPSHOT", "")
+SNAPSHOT_INTERVAL = int(os.environ.get("SNUTZ_SNAPSHOT_INTERVAL", "60"))
+
+class Storage(ABC):
+    """ What the server needs from a storage engine (see database.py for the details) """
+
+    @abstractmethod
+    def init_database(self):
+        raise NotImplementedError
+
+    def snapshot(self):
+        """ Persists the data if the engine keeps it in memory (no-op otherwise) """
+
+    # Devices
+    @abstractmethod
+    def register_device(self, device_id: str, name: str):
+        raise NotImplementedError
+
+    @abstractmethod
+    def get_all_devices(self):
+        raise NotImplementedError
+
+    @abstractmethod
+    def get_device(self, device_id: str):
+        raise NotImplementedError
+
+    @abstractmethod
+    def update_heartbeat(self, device_id: str):
+        raise NotImplementedError
+
+    def update_heartbeats(self, device_ids: list):
+        return {device_id: self.update_heartbeat(device_id) for device_id in device_ids}
+
+    @abstractmethod
+    def sweep_offline_devices(self, offline_after_seconds: int):
+        raise NotImplementedError
+
+    @abstractmethod
+    def get_device_status_counts(self):
+        raise NotImplementedError
+
+    @abstractmethod
+    def get_down_devices(self, limit: int = 100):
+        raise NotImplementedError
+
+    @abstractmethod
+    def get_device_events(self, device_id: str = None, limit: int = 50):
+        raise NotImplementedError
+
+    # Results and commands
+    @abstractmethod
+    def save_test_result(self, device_id: str, test_type: str, target: str, result_data: str,
+                         triggered_by: str = "manual"):
+        raise NotImplementedError
+
+    @abstractmethod
+    def get_test_results(self, device_id: str = None, limit: int = 50):
+        raise NotImplementedError
+
+    @abstractmethod
+    def get_test_result(self, result_id: int):
+        raise NotImplementedError
+
+    @abstractmethod
+    def get_latest_results(self):
+        raise NotImplementedError
+
+    # Routes (traceroute paths)
+    @abstractmethod
+    def get_route_path(self, path_id: int):
+        raise NotImplementedError
+
+    @abstractmethod
+    def get_hop_routes(self, address: str, limit: int = 100):
+        raise NotImplementedError
+
+    @abstractmethod
+    def get_route_changes(self, device_id: str = None, target: str = None, limit: int = 50):
+        raise NotImplementedError
+
+    @abstractmethod
+    def create_command(self, device_id: str, command_type: str, parameters: str = None):
+        raise NotImplementedError
+
+    @abstractmethod
+    def get_pending_commands(self, device_id: str):
+        raise NotImplementedError
+
+    @abstractmethod
+    def get_command(self, command_id: int):
+        raise NotImplementedError
+
+    @abstractmethod
+    def update_command_status(self, command_id: int, status: str, result_id: int = None):
+        raise NotImplementedError
+
+    @abstractmethod
+    def get_all_commands(self, device_id: str = None, limit: int = 50):
+        raise NotImplementedError
+
+    # Schedules
+    @abstractmethod
+    def create_schedule(self, device_id: str, test_type: str, interval_seconds: int,
+                        target: str = None, parameters: str = None):
+        raise NotImplementedError
+
+    @abstractmethod
+    def get_schedules(self, device_id: str = None, enabled_only: bool = False):
+        raise NotImplementedError
+
+    @abstractmethod
+    def get_schedules_due_to_run(self, device_id: str):
+        raise NotImplementedError
+
+    @abstractmethod
+    def get_schedule_changes(self, device_id: str, since_version: int = 0):
+        raise NotImplementedError
+
+    @abstractmethod
+    def update_schedule_last_run(self, schedule_id: int, ran_at: str = None):
+        raise NotImplementedError
+
+    @abstractmethod
+    def toggle_schedule(self, schedule_id: int, enabled: bool):
+        raise NotImplementedError
+
+    @abstractmethod
+    def delete_schedule(self, schedule_id: int):
+        raise NotImplementedError
+
+    # Monitor summaries and stats checkpoints
+    @abstractmethod
+    def save_monitor_summaries(self, device_id: str, target: str, summaries: list):
+        raise NotImplementedError
+
+    @abstractmethod
+    def get_monitor_summaries(self, device_id: str = None, target: str = None, limit: int = 360):
+        raise NotImplementedError
+
+    @abstractmethod
+    def save_target_stats(self, rows: list):
+        raise NotImplementedError
+
+    @abstractmethod
+    def load_target_stats(self):
+        raise NotImplementedError
+
+    # Alerts
+    @abstractmethod
+    def save_alert(self, device_id: str, target: str, test_type: str, kind: str, metric: str,
+                   value: float, baseline: float, message: str, rule_id: int = None, created_at: str = None):
+        raise NotImplementedError
+
+    @abstractmethod
+    def resolve_alert(self, alert_id: int, resolved_at: str = None):
+        raise NotImplementedError
+
+    @abstractmethod
+    def get_alerts(self, device_id: str = None, active_only: bool = False, limit: int = 50):
+        raise NotImplementedError
+
+    @abstractmethod
+    def create_alert_rule(self, metric: str, operator: str, threshold: float,
+                          device_id: str = None, target: str = None, test_type: str = None):
+        raise NotImplementedError
+
+    @abstractmethod
+    def get_alert_rules(self):
+        raise NotImplementedError
+
+    @abstractmethod
+    def delete_alert_rule(self, rule_id: int):
+        raise NotImplementedError
+
+class SQLiteStorage(Storage):
+    """ database.py (SNUTZ_DB, SNUTZ_SHARDS) """
+
+    init_database = staticmethod(database.init_database)
+
+    register_device = staticmethod(database.register_device)
+    get_all_devices = staticmethod(database.get_all_devices)
+    get_device = staticmethod(database.get_device)
+    update_heartbeat = staticmethod(database.update_heartbeat)
+    update_heartbeats = staticmethod(database.update_heartbeats)
+    sweep_offline_devices = staticmethod(database.sweep_offline_devices)
+    get_device_status_counts = staticmethod(database.get_device_status_counts)
+    get_down_devices = staticmethod(database.get_down_devices)
+    get_device_events = staticmethod(database.get_device_events)
+
+    save_test_result = staticmethod(database.save_test_result)
+    get_test_results = staticmethod(database.get_test_results)
+    get_test_result = staticmethod(database.get_test_result)
+    get_latest_results = staticmethod(database.get_latest_results)
+    get_route_path = staticmethod(database.get_route_path)
+    get_hop_routes = staticmethod(database.get_hop_routes)
+    get_route_changes = staticmethod(database.get_route_changes)
+    create_command = staticmethod(database.create_command)
+    get_pending_commands = staticmethod(database.get_pending_commands)
+    get_command = staticmethod(database.get_command)
+    update_command_status = staticmethod(database.update_command_status)
+    get_all_commands = staticmethod(database.get_all_commands)
+
+    create_schedule = staticmethod(database.create_schedule)
+    get_schedules = staticmethod(database.get_schedules)
+    get_schedules_due_to_run = staticmethod(database.get_schedules_due_to_run)
+    get_schedule_changes = staticmethod(database.get_schedule_changes)
+    update_schedule_last_run = staticmethod(database.update_schedule_last_run)
+    toggle_schedule = staticmethod(database.toggle_schedule)
+    delete_schedule = staticmethod(database.delete_schedule)
+
+    save_monitor_summaries = staticmethod(database.save_monitor_summaries)
+    get_monitor_summaries = staticmethod(database.get_monitor_summaries)
+    save_target_stats = staticmethod(database.save_target_stats)
+    load_target_stats = staticmethod(database.load_target_stats)
+
+    save_alert = staticmethod(database.save_alert)
+    resolve_alert = staticmethod(database.resolve_alert)
+    get_alerts = staticmethod(database.get_alerts)
+    create_alert_rule = staticmethod(database.create_alert_rule)
+    get_alert_rules = staticmethod(database.get_alert_rules)
+    delete_alert_rule = staticmethod(database.delete_alert_rule)
+
+class MemoryStorage(Storage):
+    """
+    Everything in memory, indexed the way the server reads it
+
+    Rows are dicts with the columns of the SQLite tables, results and
+    commands are append-only lists (id = position + 1) with per-device
+    lists next to them. Callers always get copies. One lock guards it all,
+    every operation is a few dict / list steps.
+    """
+
+    def __init__(self, snapshot_file: str = ""):
+        self.snapshot_file = snapshot_file
+        self.lock = threading.RLock()
+        self.clear()
+
+    def clear(self):
+        self.devices = {}
+        self.device_events = []
+        self.results = []
+        self.results_by_device = {}
+        self.outputs = {}  # result id -> (codec, compressed raw output)
+        self.route_paths = {}
+        self.paths_by_fingerprint = {}
+        self.route_hops = {}  # hop address -> {(path_id, ttl)}
+        self.device_routes = {}  # (device_id, target) -> current path
+        self.routes_by_path = {}  # path_id -> {(device_id, target)}
+        self.route_changes = []
+        self.commands = []
+        self.commands_by_device = {}
+        self.pending_by_device = {}  # device_id -> {command id: command}, oldest first
+        self.schedules = {}
+        self.schedules_by_device = {}
+        self.tombstones = {}
+        self.next_schedule_id = 1
+        self.schedule_version = 0
+        self.monitor_summaries = []
+        self.summary_windows = set()  # (device_id, target, window_start)
+        self.target_stats = {}
+        self.alerts = []
+        self.alert_rules = {}
+        self.next_rule_id = 1
+
+    # Snapshots
+
+    def init_database(self):
+        """ Loads the snapshot, if there is one """
+        with self.lock:
+            self.clear()
+            if not self.snapshot_file or not os.path.exists(self.snapshot_file):
+                return
+
+            with open(self.snapshot_file) as f:
+                data = json.load(f)
+
+            for device in data["devices"]:
+                self.devices[device["device_id"]] = device
+            self.device_events = data["device_events"]
+            for result in data["results"]:
+                self.add_result(result)
+            self.outputs = {
+                int(result_id): (codec, base64.b64decode(blob))
+                for result_id, (codec, blob) in data["outputs"].items()
+            }
+            for path in data.get("route_paths", []):
+                self.add_route_path(path)
+            for route in data.get("device_routes", []):
+                self.set_device_route(route)
+            self.route_changes = data.get("route_changes", [])
+            for command in data["commands"]:
+                self.add_command(command)
+            for schedule in data["schedules"]:
+                self.add_schedule(schedule)
+            self.tombstones = {t["schedule_id"]: t for t in data["tombstones"]}
+            self.next_schedule_id = data["next_schedule_id"]
+            self.schedule_version = data["schedule_version"]
+            self.monitor_summaries = data["monitor_summaries"]
+            self.summary_windows = {(s["device_id"], s["target"], s["window_start"]) for s in self.monitor_summaries}
+            self.target_stats = {(s["device_id"], s["target"], s["test_type"]): s for s in data["target_stats"]}
+            self.alerts = data["alerts"]
+            self.alert_rules = {rule["id"]: rule for rule in data["alert_rules"]}
+            self.next_rule_id = data["next_rule_id"]
+
+        print(f"Loaded snapshot {self.snapshot_file} ({len(self.results)} results)")
+
+    def snapshot(self):
+        """ Writes everything to the snapshot file (atomically) """
+        if not self.snapshot_file:
+            return
+
+        # Only shallow copies under the lock; encoding and writing happen outside it so
+        # ingest and reads don't wait for the whole dataset to serialize. Results, events,
+        # route paths/changes and summaries are never updated in place, so copying the
+        # lists is enough; the other rows are updated in place and get copied one by one
+        with self.lock:
+            state = {
+                "devices": [dict(device) for device in self.devices.values()],
+                "device_events": list(self.device_events),
+                "results": list(self.results),
+                "outputs": dict(self.outputs),
+                "route_paths": list(self.route_paths.values()),
+                "device_routes": [dict(route) for route in self.device_routes.values()],
+                "route_changes": list(self.route_changes),
+                "commands": [dict(command) for command in self.commands],
+                "schedules": [dict(schedule) for schedule in self.schedules.values()],
+                "tombstones": [dict(tombstone) for tombstone in self.tombstones.values()],
+                "next_schedule_id": self.next_schedule_id,
+                "schedule_version": self.schedule_version,
+                "monitor_summaries": list(self.monitor_summaries),
+                "target_stats": [dict(stats) for stats in self.target_stats.values()],
+                "alerts": [dict(alert) for alert in self.alerts],
+                "alert_rules": [dict(rule) for rule in self.alert_rules.values()],
+                "next_rule_id": self.next_rule_id
+            }
+
+        state["outputs"] = {
+            result_id: (codec, base64.b64encode(blob).decode())
+            for result_id, (codec, blob) in state["outputs"].items()
+        }
+        data = json.dumps(state)
+
+        temp_file = self.snapshot_file + ".tmp"
+        with open(temp_file, "w") as f:
+            f.write(data)
+        os.replace(temp_file, self.snapshot_file)
+
+    def add_result(self, result: dict):
+        self.results.append(result)
+        self.results_by_device.setdefault(result["device_id"], []).append(result)
+
+    def add_route_path(self, path: dict):
+        self.route_paths[path["id"]] = path
+        self.paths_by_fingerprint[path["fingerprint"]] = path["id"]
+        for ttl, address in enumerate(path["hops"], 1):
+            if address:
+                self.route_hops.setdefault(address, set()).add((path["id"], ttl))
+
+    def set_device_route(self, route: dict):
+        key = (route["device_id"], route["target"])
+        previous = self.device_routes.get(key)
+        if previous is not None:
+            self.routes_by_path[previous["path_id"]].discard(key)
+        self.device_routes[key] = route
+        self.routes_by_path.setdefault(route["path_id"], set()).add(key)
+
+    def add_command(self, command: dict):
+        self.commands.append(command)
+        self.commands_by_device.setdefault(command["device_id"], []).append(command)
+        if command["status"] == "pending":
+            self.pending_by_device.setdefault(command["device_id"], {})[command["id"]] = command
+
+    def add_schedule(self, schedule: dict):
+        self.schedules[schedule["id"]] = schedule
+        self.schedules_by_device.setdefault(schedule["device_id"], {})[schedule["id"]] = schedule
+
+    # Devices
+
+    def add_device_event(self, device_id: str, event: str, timestamp: str, last_seen: str = None):
+        self.device_events.append({
+            "id": len(self.device_events) + 1,
+            "device_id": device_id,
+            "event": event,
+            "timestamp": timestamp,
+            "last_seen": last_seen
+        })
+
+    def register_device(self, device_id: str, name: str):
+        now = datetime.now().isoformat()
+
+        with self.lock:
+            previous = self.devices.get(device_id)
+            self.devices[device_id] = {
+                "device_id": device_id,
+                "name": name,
+                "status": "online",
+                "last_seen": now,
+                "registered_at": now
+            }
+            if previous is None or previous["status"] != "online":
+                self.add_device_event(device_id, "online", now, now)
+
+        return {"device_id": device_id, "name": name, "status": "online", "registered_at": now}
+
+    def get_all_devices(self):
+        with self.lock:
+            return [dict(device) for device in self.devices.values()]
+
+    def get_device(self, device_id: str):
+        with self.lock:
+            device = self.devices.get(device_id)
+            return dict(device) if device else None
+
+    def update_heartbeat(self, device_id: str):
+        now = datetime.now().isoformat()
+
+        with self.lock:
+            device = self.devices.get(device_id)
+            if device is None:
+                return None
+
+            device["last_seen"] = now
+            if device["status"] != "online":
+                device["status"] = "online"
+                self.add_device_event(device_id, "online", now, now)
+
+        return {"last_seen": now, "status": "online"}
+
+    def sweep_offline_devices(self, offline_after_seconds: int):
+        now = datetime.now()
+        cutoff = (now - timedelta(seconds=offline_after_seconds)).isoformat()
+
+        gone = []
+        with self.lock:
+            for device in self.devices.values():
+                if device["status"] == "online" and device["last_seen"] < cutoff:
+                    device["status"] = "offline"
+                    self.add_device_event(device["device_id"], "offline", now.isoformat(), device["last_seen"])
+                    gone.append({"device_id": device["device_id"], "last_seen": device["last_seen"]})
+
+        return gone
+
+    def get_device_status_counts(self):
+        counts = {}
+        with self.lock:
+            for device in self.devices.values():
+                counts[device["status"]] = counts.get(device["status"], 0) + 1
+        return counts
+
+    def get_down_devices(self, limit: int = 100):
+        with self.lock:
+            down = [dict(device) for device in self.devices.values() if device["status"] == "offline"]
+        down.sort(key=lambda device: device["last_seen"] or "", reverse=True)
+        return down[:limit]
+
+    def get_device_events(self, device_id: str = None, limit: int = 50):
+        with self.lock:
+            events = [
+                dict(event) for event in reversed(self.device_events)
+                if device_id is None or event["device_id"] == device_id
+            ][:limit]
+        return events
+
+    # Results and commands
+
+    def save_test_result(self, device_id: str, test_type: str, target: str, result_data: str,
+                         triggered_by: str = "manual"):
+        now = datetime.now().isoformat()
+        result_data, output = database.split_output(result_data)
+        compressed = database.compress_output(output) if output is not None else None
+        route, addresses = database.split_route(result_data) if test_type == "traceroute" else (None, None)
+
+        with self.lock:
+            if route is not None:
+                route["path_id"] = self.save_route(device_id, target, addresses, now)
+                result_data = json.dumps(route)
+            result = {
+                "id": len(self.results) + 1,
+                "device_id": device_id,
+                "test_type": test_type,
+                "timestamp": now,
+                "target": target,
+                "result_data": result_data,
+                "triggered_by": triggered_by
+            }
+            self.add_result(result)
+            if compressed:
+                self.outputs[result["id"]] = compressed
+
+        return {key: result[key] for key in ("id", "device_id", "test_type", "timestamp", "target", "result_data")}
+
+    def get_test_results(self, device_id: str = None, limit: int = 50):
+        # Appended in time order, the newest are at the end
+        with self.lock:
+            results = self.results_by_device.get(device_id, []) if device_id else self.results
+            return self.expand_routes([dict(result) for result in reversed(newest(results, limit))])
+
+    def get_test_result(self, result_id: int):
+        with self.lock:
+            if not 0 < result_id <= len(self.results):
+                return None
+            result = self.expand_routes([dict(self.results[result_id - 1])])[0]
+            output = self.outputs.get(result_id)
+
+        result["output"] = database.decompress_output(*output) if output else None
+        return result
+
+    def get_latest_results(self):
+        rows = []
+        with self.lock:
+            for results in self.results_by_device.values():
+                latest = {}
+                for result in results:
+                    latest[result["test_type"]] = result
+                rows.extend(dict(result) for result in latest.values())
+        return rows
+
+    # Routes (call save_route / expand_routes with the lock held)
+
+    def save_route(self, device_id: str, target: str, addresses: list, timestamp: str):
+        fingerprint = database.route_fingerprint(addresses)
+        path_id = self.paths_by_fingerprint.get(fingerprint)
+        if path_id is None:
+            path_id = len(self.route_paths) + 1
+            self.add_route_path({
+                "id": path_id,
+                "fingerprint": fingerprint,
+                "hops": addresses,
+                "hop_count": len(addresses),
+                "first_seen": timestamp
+            })
+
+        current = self.device_routes.get((device_id, target))
+        if current is not None and current["path_id"] == path_id:
+            current["last_seen"] = timestamp
+            return path_id
+
+        self.route_changes.append({
+            "id": len(self.route_changes) + 1,
+            "device_id": device_id,
+            "target": target,
+            "timestamp": timestamp,
+            "old_path_id": current["path_id"] if current else None,
+            "new_path_id": path_id
+        })
+        self.set_device_route({
+            "device_id": device_id,
+            "target": target,
+            "path_id": path_id,
+            "since": timestamp,
+            "last_seen": timestamp
+        })
+        return path_id
+
+    def expand_routes(self, results: list):
+        for result in results:
+            if result["test_type"] == "traceroute" and '"hop_rtts"' in (result["result_data"] or ""):
+                data = json.loads(result["result_data"])
+                path = self.route_paths.get(data.get("path_id")) if isinstance(data, dict) else None
+                if path is not None:
+                    result["result_data"] = json.dumps(database.join_route(data, path["hops"]))
+        return results
+
+    def get_route_path(self, path_id: int):
+        with self.lock:
+            path = self.route_paths.get(path_id)
+            if path is None:
+                return None
+
+            path = dict(path, hops=list(path["hops"]))
+            path["devices"] = [
+                {key: self.device_routes[route][key] for key in ("device_id", "target", "since", "last_seen")}
+                for route in sorted(self.routes_by_path.get(path_id, ()))
+            ]
+        return path
+
+    def get_hop_routes(self, address: str, limit: int = 100):
+        routes = []
+        with self.lock:
+            for path_id, ttl in self.route_hops.get(address, ()):
+                for key in self.routes_by_path.get(path_id, ()):
+                    route = self.device_routes[key]
+                    routes.append({
+                        "device_id": route["device_id"],
+                        "target": route["target"],
+                        "path_id": path_id,
+                        "ttl": ttl,
+                        "since": route["since"],
+                        "last_seen": route["last_seen"]
+                    })
+
+        routes.sort(key=lambda route: route["last_seen"], reverse=True)
+        return routes[:limit] if limit >= 0 else routes
+
+    def get_route_changes(self, device_id: str = None, target: str = None, limit: int = 50):
+        with self.lock:
+            changes = [
+                dict(change) for change in reversed(self.route_changes)
+                if (not device_id or change["device_id"] == device_id) and (not target or change["target"] == target)
+            ]
+        return changes[:limit] if limit >= 0 else changes
+
+    def create_command(self, device_id: str, command_type: str, parameters: str = None):
+        now = datetime.now().isoformat()
+
+        with self.lock:
+            command = {
+                "id": len(self.commands) + 1,
+                "device_id": device_id,
+                "command_type": command_type,
+                "parameters": parameters,
+                "status": "pending",
+                "created_at": now,
+                "completed_at": None,
+                "result_id": None
+            }
+            self.add_command(command)
+
+        return {key: command[key] for key in ("id", "device_id", "command_type", "parameters", "status", "created_at")}
+
+    def get_pending_commands(self, device_id: str):
+        with self.lock:
+            return [dict(command) for command in self.pending_by_device.get(device_id, {}).values()]
+
+    def get_command(self, command_id: int):
+        with self.lock:
+            if not 0 < command_id <= len(self.commands):
+                return None
+            return dict(self.commands[command_id - 1])
+
+    def update_command_status(self, command_id: int, status: str, result_id: int = None):
+        now = datetime.now().isoformat()
+
+        device_id = None
+        with self.lock:
+            if 0 < command_id <= len(self.commands):
+                command = self.commands[command_id - 1]
+                device_id = command["device_id"]
+                command["status"] = status
+                if status == "completed":
+                    command["completed_at"] = now
+                    command["result_id"] = result_id
+
+                pending = self.pending_by_device.get(command["device_id"], {})
+                if status == "pending":
+                    pending[command_id] = command
+                else:
+                    pending.pop(command_id, None)
+
+        return {"id": command_id, "device_id": device_id, "status": status}
+
+    def get_all_commands(self, device_id: str = None, limit: int = 50):
+        with self.lock:
+            commands = self.commands_by_device.get(device_id, []) if device_id else self.commands
+            return [dict(command) for command in reversed(newest(commands, limit))]
+
+    # Schedules
+
+    def create_schedule(self, device_id: str, test_type: str, interval_seconds: int,
+                        target: str = None, parameters: str = None):
+        now = datetime.now().isoformat()
+
+        with self.lock:
+            self.schedule_version += 1
+            schedule = {
+                "id": self.next_schedule_id,
+                "device_id": device_id,
+                "test_type": test_type,
+                "target": target,
+                "interval_seconds": interval_seconds,
+                "enabled": 1,
+                "parameters": parameters,
+                "last_run": None,
+                "created_at": now,
+                "version": self.schedule_version
+            }
+            self.next_schedule_id += 1
+            self.add_schedule(schedule)
+
+        return {
+            "id": schedule["id"],
+            "device_id": device_id,
+            "test_type": test_type,
+            "interval_seconds": interval_seconds,
+            "enabled": True
+        }
+
+    def get_schedules(self, device_id: str = None, enabled_only: bool = False):
+        with self.lock:
+            schedules = self.schedules_by_device.get(device_id, {}) if device_id else self.schedules
+            schedules = [dict(s) for s in schedules.values() if s["enabled"] or not enabled_only]
+        schedules.sort(key=lambda s: s["created_at"], reverse=True)
+        return schedules
+
+    def get_schedules_due_to_run(self, device_id: str):
+        now = datetime.now()
+        due = []
+
+        with self.lock:
+            for schedule in self.schedules_by_device.get(device_id, {}).values():
+                if not schedule["enabled"]:
+                    continue
+                if not schedule["last_run"]:
+                    due.append(dict(schedule))
+                    continue
+                if (now - datetime.fromisoformat(schedule["last_run"])).total_seconds() >= schedule["interval_seconds"]:
+                    due.append(dict(schedule))
+
+        return due
+
+    def get_schedule_changes(self, device_id: str, since_version: int = 0):
+        with self.lock:
+            version = self.schedule_version
+
+            full = since_version <= 0 or since_version > version
+            if full:
+                since_version = -1
+
+            schedules = [
+                dict(s) for s in self.schedules_by_device.get(device_id, {}).values()
+                if s["version"] > since_version
+            ]
+            schedules.sort(key=lambda s: s["version"])
+
+            deleted = []
+            if not full:
+                deleted = [
+                    t["schedule_id"] for t in self.tombstones.values()
+                    if t["device_id"] == device_id and t["version"] > since_version
+                ]
+
+        return {"version": version, "full": full, "schedules": schedules, "deleted": deleted}
+
+    def update_schedule_last_run(self, schedule_id: int, ran_at: str = None):
+        now = ran_at or datetime.now().isoformat()
+
+        with self.lock:
+            schedule = self.schedules.get(schedule_id)
+            if schedule:
+                schedule["last_run"] = now
+
+        return {"schedule_id": schedule_id, "last_run": now}
+
+    def toggle_schedule(self, schedule_id: int, enabled: bool):
+        with self.lock:
+            self.schedule_version += 1
+            schedule = self.schedules.get(schedule_id)
+            if schedule:
+                schedule["enabled"] = 1 if enabled else 0
+                schedule["version"] = self.schedule_version
+
+        return {"schedule_id": schedule_id, "enabled": enabled}
+
+    def delete_schedule(self, schedule_id: int):
+        with self.lock:
+            schedule = self.schedules.pop(schedule_id, None)
+            if schedule:
+                self.schedule_version += 1
+                self.tombstones[schedule_id] = {
+                    "schedule_id": schedule_id,
+                    "device_id": schedule["device_id"],
+                    "version": self.schedule_version
+                }
+                del self.schedules_by_device[schedule["device_id"]][schedule_id]
+
+        return {"schedule_id": schedule_id, "deleted": True}
+
+    # Monitor summaries and stats checkpoints
+
+    def save_monitor_summaries(self, device_id: str, target: str, summaries: list):
+        saved = []
+        with self.lock:
+            for s in summaries:
+                key = (device_id, target, s["window_start"])
+                if key in self.summary_windows:
+                    continue
+                self.summary_windows.add(key)
+                self.monitor_summaries.append({
+                    "id": len(self.monitor_summaries) + 1,
+                    "device_id": device_id,
+                    "target": target,
+                    "window_start": s["window_start"],
+                    "window_end": s["window_end"],
+                    "summary": json.dumps(s)
+                })
+                saved.append(s["window_start"])
+
+        return {"device_id": device_id, "target": target, "saved": len(saved), "saved_windows": saved}
+
+    def get_monitor_summaries(self, device_id: str = None, target: str = None, limit: int = 360):
+        with self.lock:
+            summaries = [
+                dict(s) for s in self.monitor_summaries
+                if (not device_id or s["device_id"] == device_id) and (not target or s["target"] == target)
+            ]
+        summaries.sort(key=lambda s: s["window_end"], reverse=True)
+        return summaries[:limit]
+
+    def save_target_stats(self, rows: list):
+        if not rows:
+            return {"saved": 0}
+
+        updated_at = datetime.now().isoformat()
+        with self.lock:
+            for device_id, target, test_type, data in rows:
+                self.target_stats[(device_id, target, test_type)] = {
+                    "device_id": device_id,
+                    "target": target,
+                    "test_type": test_type,
+                    "data": data,
+                    "updated_at": updated_at
+                }
+
+        return {"saved": len(rows)}
+
+    def load_target_stats(self):
+        with self.lock:
+            return [
+                {key: row[key] for key in ("device_id", "target", "test_type", "data")}
+                for row in self.target_stats.values()
+            ]
+
+    # Alerts
+
+    def save_alert(self, device_id: str, target: str, test_type: str, kind: str, metric: str,
+                   value: float, baseline: float, message: str, rule_id: int = None, created_at: str = None):
+        created_at = created_at or datetime.now().isoformat()
+
+        with self.lock:
+            alert = {
+                "id": len(self.alerts) + 1,
+                "device_id": device_id,
+                "target": target,
+                "test_type": test_type,
+                "kind": kind,
+                "metric": metric,
+                "value": value,
+                "baseline": baseline,
+                "message": message,
+                "rule_id": rule_id,
+                "created_at": created_at,
+                "resolved_at": None
+            }
+            self.alerts.append(alert)
+
+        return dict(alert)
+
+    def resolve_alert(self, alert_id: int, resolved_at: str = None):
+        resolved_at = resolved_at or datetime.now().isoformat()
+
+        with self.lock:
+            if 0 < alert_id <= len(self.alerts):
+                self.alerts[alert_id - 1]["resolved_at"] = resolved_at
+
+        return {"alert_id": alert_id, "resolved_at": resolved_at}
+
+    def get_alerts(self, device_id: str = None, active_only: bool = False, limit: int = 50):
+        with self.lock:
+            alerts = [
+                dict(alert) for alert in self.alerts
+                if (not device_id or alert["device_id"] == device_id)
+                and (not active_only or alert["resolved_at"] is None)
+            ]
+        alerts.sort(key=lambda alert: alert["created_at"], reverse=True)
+        return alerts[:limit]
+
+    def create_alert_rule(self, metric: str, operator: str, threshold: float,
+                          device_id: str = None, target: str = None, test_type: str = None):
+        with self.lock:
+            rule = {
+                "id": self.next_rule_id,
+                "device_id": device_id,
+                "target": target,
+                "test_type": test_type,
+                "metric": metric,
+                "operator": operator,
+                "threshold": threshold,
+                "enabled": 1,
+                "created_at": datetime.now().isoformat()
+            }
+            self.alert_rules[rule["id"]] = rule
+            self.next_rule_id += 1
+
+        return dict(rule)
+
+    def get_alert_rules(self):
+        with self.lock:
+            return [dict(rule) for rule in self.alert_rules.values()]
+
+    def delete_alert_rule(self, rule_id: int):
+        with self.lock:
+            self.alert_rules.pop(rule_id, None)
+
+        return {"rule_id": rule_id, "deleted": True}
+
+def newest(rows: list, limit: int):
+    """ The last limit rows of a list (negative = all, like SQLite's LIMIT) """
+    if limit < 0:
+        return rows
+    return rows[-limit:] if limit else []
+
+ENGINES = {
+    "sqlite": SQLiteStorage,
+    "memory": lambda: MemoryStorage(SNAPSHOT_FILE),
+}
+
+def open_storage(kind: str = STORAGE):
+    """ Creates the storage engine of the given kind ("sqlite" / "memory") """
+    if kind not in ENGINES:
+        raise ValueError(f"Unknown storage {kind!r}, use one of {', '.join(ENGINES)}")
+    return ENGINES[kind]()
+
+db = open_storage()
@@ -0,0 +1,370 @@
+"""
+storage_conformance.py - Checks that every storage engine behaves the same
+
+Runs one set of checks against each engine of storage.py on a fresh
+database and exits with 1 if any of them fails:
+
+- sqlite: database.py, one file
+- sqlite-shards: database.py with 3 shard files
+- memory: MemoryStorage, plus a snapshot / reload round trip
+
+    python storage_conformance.py
+    python storage_conformance.py --storage memory
+"""
+
+import argparse
+import contextlib
+import json
+import os
+import sys
+import tempfile
+import time
+
+import database
+import stats
+import storage
+
+class Checker:
+    """ Collects failed expectations instead of stopping at the first one """
+
+    def __init__(self, engine: str):
+        self.engine = engine
+        self.checks = 0
+        self.failures = []
+
+    def expect(self, condition: bool, message: str):
+        self.checks += 1
+        if not condition:
+            self.failures.append(message)
+
+    def equal(self, actual, expected, message: str):
+        self.expect(actual == expected, f"{message}: got {actual!r}, expected {expected!r}")
+
+def check_devices(db, c: Checker):
+    db.register_device("dev-1", "First")
+    db.register_device("dev-2", "Second")
+
+    c.equal(db.get_device("dev-1")["name"], "First", "get_device name")
+    c.equal(db.get_device("nope"), None, "get_device unknown")
+    c.equal(sorted(d["device_id"] for d in db.get_all_devices()), ["dev-1", "dev-2"], "get_all_devices")
+    c.equal(db.register_device("dev-3", "Third")["name"], "Third", "register_device return")
+    c.equal(
+        set(db.get_all_devices()[0]),
+        {"device_id", "name", "status", "last_seen", "registered_at"},
+        "device columns"
+    )
+
+    c.equal(db.update_heartbeat("nope"), None, "update_heartbeat unknown")
+    c.equal(db.update_heartbeat("dev-1")["status"], "online", "update_heartbeat status")
+    c.equal(db.get_device_status_counts(), {"online": 3}, "status counts")
+
+    # Nobody is late with a long timeout, everyone with a negative one
+    c.equal(db.sweep_offline_devices(3600), [], "sweep nothing due")
+    gone = db.sweep_offline_devices(-5)
+    c.equal(sorted(d["device_id"] for d in gone), ["dev-1", "dev-2", "dev-3"], "sweep devices")
+    c.equal(db.sweep_offline_devices(-5), [], "sweep twice")
+    c.equal(db.get_device_status_counts(), {"offline": 3}, "status counts after sweep")
+    c.equal(len(db.get_down_devices(2)), 2, "get_down_devices limit")
+
+    db.update_heartbeat("dev-2")
+    c.equal(db.get_device("dev-2")["status"], "online", "back online on heartbeat")
+    c.equal([d["device_id"] for d in db.get_down_devices()].count("dev-2"), 0, "not down after heartbeat")
+
+    batch = db.update_heartbeats(["dev-3", "nope", "dev-3"])
+    c.equal((batch["dev-3"]["status"], batch["nope"]), ("online", None), "update_heartbeats")
+    c.equal(db.get_device_status_counts(), {"online": 2, "offline": 1}, "status counts after update_heartbeats")
+
+    events = db.get_device_events("dev-2")
+    c.equal([e["event"] for e in events], ["online", "offline", "online"], "device events, newest first")
+    c.equal(len(db.get_device_events(limit=4)), 4, "device events limit")
+    c.equal(
+        set(events[0]), {"id", "device_id", "event", "timestamp", "last_seen"}, "device event columns"
+    )
+
+def check_results(db, c: Checker):
+    saved = []
+    for i in range(6):
+        saved.append(db.save_test_result(f"dev-{i % 2 + 1}", "ping", "8.8.8.8", json.dumps({"n": i}), "schedule"))
+        time.sleep(0.001)  # distinct timestamps, so the order is defined
+
+    c.equal(len({r["id"] for r in saved}), 6, "result ids unique")
+    c.equal(
+        set(saved[0]), {"id", "device_id", "test_type", "timestamp", "target", "result_data"},
+        "save_test_result return"
+    )
+
+    latest = db.get_test_results(None, 3)
+    c.equal([json.loads(r["result_data"])["n"] for r in latest], [5, 4, 3], "get_test_results newest first")
+    c.equal([r["id"] for r in latest], [r["id"] for r in saved[5:2:-1]], "get_test_results ids")
+    c.equal(latest[0]["triggered_by"], "schedule", "triggered_by")
+
+    device = db.get_test_results("dev-1", 50)
+    c.equal([json.loads(r["result_data"])["n"] for r in device], [4, 2, 0], "get_test_results per device")
+    c.equal(db.get_test_results("nope", 50), [], "get_test_results unknown device")
+
+    # The raw output is kept apart and only comes back for one result
+    output = "PING 8.8.8.8\n" + "64 bytes from 8.8.8.8: icmp_seq=1 ttl=117 time=9.1 ms\n" * 20
+    saved = db.save_test_result("dev-2", "ping", "8.8.8.8", json.dumps({"success": True, "output": output}))
+    listed = db.get_test_results("dev-2", 1)[0]
+    c.equal(json.loads(listed["result_data"]), {"success": True, "has_output": True}, "output left out of the list")
+    c.equal(db.get_test_result(saved["id"])["output"], output, "get_test_result output")
+    c.equal(db.get_test_result(latest[0]["id"])["output"], None, "get_test_result without output")
+    c.equal(db.get_test_result(10 ** 9), None, "get_test_result unknown")
+
+    db.save_test_result("dev-1", "traceroute", "8.8.8.8", json.dumps({"n": 6}))
+    newest = {(r["device_id"], r["test_type"]): r["id"] for r in db.get_latest_results()}
+    c.equal(
+        newest,
+        {("dev-1", "ping"): latest[1]["id"], ("dev-2", "ping"): saved["id"],
+         ("dev-1", "traceroute"): db.get_test_results("dev-1", 1)[0]["id"]},
+        "get_latest_results"
+    )
+
+def traceroute(addresses: list, rtt: float = 9.0):
+    """ A traceroute result like tests.traceroute_test's """
+    hops = [
+        {"ttl": ttl, "address": address, "rtts": [rtt, rtt, None] if address else [None, None, None],
+         "loss_pct": 33.3 if address else 100.0}
+        for ttl, address in enumerate(addresses, 1)
+    ]
+    return {"success": True, "target": "8.8.8.8", "hops": hops, "hop_count": len(hops)}
+
+def check_routes(db, c: Checker):
+    path = ["10.0.0.1", None, "8.8.8.8"]
+    first = db.save_test_result("dev-1", "traceroute", "8.8.8.8", json.dumps(traceroute(path)))
+    second = db.save_test_result("dev-2", "traceroute", "8.8.8.8", json.dumps(traceroute(path, 11.0)))
+
+    stored = json.loads(first["result_data"])
+    c.equal(("hops" in stored, len(stored["hop_rtts"])), (False, 3), "traceroute stored without its hops")
+    # (sharded, each shard keeps its own copy of a path)
+    c.equal(db.get_route_path(json.loads(second["result_data"])["path_id"])["fingerprint"],
+            db.get_route_path(stored["path_id"])["fingerprint"], "same path, same fingerprint")
+    c.equal(json.loads(db.get_test_result(second["id"])["result_data"])["hops"], traceroute(path, 11.0)["hops"],
+            "get_test_result hops")
+    c.equal(json.loads(db.get_test_results("dev-1", 1)[0]["result_data"])["hops"], traceroute(path)["hops"],
+            "get_test_results hops")
+    c.equal(stats.extract_metrics("traceroute", first["result_data"]),
+            stats.extract_metrics("traceroute", traceroute(path)), "metrics of a stored traceroute")
+
+    path_id = stored["path_id"]
+    found = db.get_route_path(path_id)
+    c.equal((found["hops"], found["hop_count"]), (path, 3), "get_route_path hops")
+    c.equal([d["device_id"] for d in found["devices"]], ["dev-1", "dev-2"], "get_route_path devices")
+    c.equal(db.get_route_path(10 ** 9), None, "get_route_path unknown")
+
+    # dev-1 moves to another first hop
+    other = ["10.0.0.2", None, "8.8.8.8"]
+    moved = json.loads(db.save_test_result("dev-1", "traceroute", "8.8.8.8", json.dumps(traceroute(other)))["result_data"])
+    c.expect(moved["path_id"] != path_id, "new path, new path_id")
+    db.save_test_result("dev-1", "traceroute", "8.8.8.8", json.dumps(traceroute(other)))
+
+    c.equal([(r["device_id"], r["ttl"]) for r in db.get_hop_routes("10.0.0.1")], [("dev-2", 1)], "get_hop_routes")
+    c.equal(sorted((r["device_id"], r["ttl"]) for r in db.get_hop_routes("8.8.8.8")), [("dev-1", 3), ("dev-2", 3)],
+            "get_hop_routes last hop")
+    c.equal(len(db.get_hop_routes("8.8.8.8", 1)), 1, "get_hop_routes limit")
+    c.equal(db.get_hop_routes("192.0.2.1"), [], "get_hop_routes unknown")
+
+    changes = db.get_route_changes("dev-1")
+    c.equal([(ch["old_path_id"], ch["new_path_id"]) for ch in changes], [(path_id, moved["path_id"]), (None, path_id)],
+            "route changes, newest first")
+    c.equal(len(db.get_route_changes()), 3, "route changes of every device")
+    c.equal(len(db.get_route_changes(limit=1)), 1, "route changes limit")
+    c.equal(db.get_route_changes(target="1.1.1.1"), [], "route changes per target")
+
+    # Hops that can't be rebuilt exactly are kept as they are
+    named = traceroute(path)
+    named["hops"][0]["hostname"] = "gateway"
+    kept = db.save_test_result("dev-3", "traceroute", "8.8.8.8", json.dumps(named))
+    c.equal(json.loads(kept["result_data"]), named, "traceroute with extra hop fields kept")
+
+    # Compact-looking results that aren't ours come back as they were uploaded
+    lookalike = {"success": True, "hop_rtts": [[1.0]]}
+    db.save_test_result("dev-3", "traceroute", "8.8.8.8", json.dumps(lookalike))
+    c.equal(json.loads(db.get_test_results("dev-3", 1)[0]["result_data"]), lookalike, "hop_rtts without a path_id")
+
+def check_commands(db, c: Checker):
+    first = db.create_command("dev-1", "ping", "{}")
+    time.sleep(0.001)
+    second = db.create_command("dev-1", "traceroute", None)
+    time.sleep(0.001)
+    other = db.create_command("dev-2", "ping", "{}")
+
+    c.equal(first["status"], "pending", "create_command status")
+    c.equal([cmd["id"] for cmd in db.get_pending_commands("dev-1")], [first["id"], second["id"]],
+            "pending commands oldest first")
+
+    updated = db.update_command_status(first["id"], "running")
+    c.equal(updated["device_id"], "dev-1", "update_command_status returns the device")
+    c.equal((db.get_command(first["id"])["device_id"], db.get_command(first["id"])["status"]),
+            ("dev-1", "running"), "get_command")
+    c.equal(db.get_command(other["id"] + 1000), None, "get_command of an unknown id")
+    c.equal([cmd["id"] for cmd in db.get_pending_commands("dev-1")], [second["id"]], "running is not pending")
+
+    db.update_command_status(first["id"], "completed", 42)
+    done = [cmd for cmd in db.get_all_commands("dev-1") if cmd["id"] == first["id"]][0]
+    c.equal((done["status"], done["result_id"]), ("completed", 42), "completed command")
+    c.expect(done["completed_at"] is not None, "completed_at set")
+
+    c.equal([cmd["id"] for cmd in db.get_all_commands(None, 2)], [other["id"], second["id"]],
+            "get_all_commands newest first")
+    c.equal(len(db.get_all_commands("dev-2")), 1, "get_all_commands per device")
+
+def check_schedules(db, c: Checker):
+    start = db.get_schedule_changes("dev-1", 0)["version"]
+
+    ping = db.create_schedule("dev-1", "ping", 60, "8.8.8.8", "{}")
+    time.sleep(0.001)
+    trace = db.create_schedule("dev-1", "traceroute", 3600, "1.1.1.1")
+    db.create_schedule("dev-2", "ping", 60)
+
+    c.equal(ping["enabled"], True, "create_schedule enabled")
+    c.equal([s["id"] for s in db.get_schedules("dev-1")], [trace["id"], ping["id"]], "get_schedules newest first")
+    c.equal(len(db.get_schedules()), 3, "get_schedules all")
+
+    changes = db.get_schedule_changes("dev-1", 0)
+    c.equal(changes["full"], True, "full sync")
+    c.equal([s["id"] for s in changes["schedules"]], [ping["id"], trace["id"]], "full sync schedules")
+    c.equal(changes["version"], start + 3, "version bumped per change")
+
+    c.equal(sorted(s["id"] for s in db.get_schedules_due_to_run("dev-1")), sorted([ping["id"], trace["id"]]),
+            "never run is due")
+    db.update_schedule_last_run(ping["id"])
+    c.equal([s["id"] for s in db.get_schedules_due_to_run("dev-1")], [trace["id"]], "just ran is not due")
+    db.update_schedule_last_run(ping["id"], "2000-01-01T00:00:00")
+    c.equal(len(db.get_schedules_due_to_run("dev-1")), 2, "ran long ago is due")
+
+    version = changes["version"]
+    db.toggle_schedule(ping["id"], False)
+    c.equal([s["id"] for s in db.get_schedules("dev-1", enabled_only=True)], [trace["id"]], "enabled_only")
+    c.equal([s["id"] for s in db.get_schedules_due_to_run("dev-1")], [trace["id"]], "disabled is not due")
+
+    db.delete_schedule(trace["id"])
+    delta = db.get_schedule_changes("dev-1", version)
+    c.equal(delta["full"], False, "delta sync")
+    c.equal([(s["id"], s["enabled"]) for s in delta["schedules"]], [(ping["id"], 0)], "delta has the toggle")
+    c.equal(delta["deleted"], [trace["id"]], "delta has the deletion")
+    c.equal(db.get_schedule_changes("dev-1", delta["version"])["schedules"], [], "nothing new")
+    c.equal(db.get_schedule_changes("dev-1", delta["version"] + 100)["full"], True, "future version is full")
+    c.equal(db.delete_schedule(9999)["deleted"], True, "delete unknown schedule")
+    c.equal(db.get_schedule_changes("dev-1", 0)["version"], delta["version"], "unknown delete keeps the version")
+
+def check_monitor_and_stats(db, c: Checker):
+    windows = [
+        {"window_start": f"2024-01-01T00:00:{i}0", "window_end": f"2024-01-01T00:00:{i + 1}0", "sent": 50}
+        for i in range(3)
+    ]
+    c.equal(db.save_monitor_summaries("dev-1", "8.8.8.8", windows)["saved"], 3, "save_monitor_summaries")
+    db.save_monitor_summaries("dev-2", "1.1.1.1", windows[:1])
+    again = db.save_monitor_summaries("dev-1", "8.8.8.8", windows[1:] + [dict(windows[0], window_start="2024-01-01T00:01:00")])
+    c.equal((again["saved"], again["saved_windows"]), (1, ["2024-01-01T00:01:00"]),
+            "monitor summaries sent again are skipped")
+
+    summaries = db.get_monitor_summaries("dev-1", "8.8.8.8", 2)
+    c.equal([s["window_end"] for s in summaries], ["2024-01-01T00:00:30", "2024-01-01T00:00:20"],
+            "monitor summaries newest first")
+    c.equal(json.loads(summaries[0]["summary"])["sent"], 50, "summary is JSON")
+    c.equal(len(db.get_monitor_summaries()), 5, "all monitor summaries")
+    c.equal(len(db.get_monitor_summaries(target="1.1.1.1")), 1, "monitor summaries per target")
+
+    c.equal(db.save_target_stats([]), {"saved": 0}, "save no stats")
+    db.save_target_stats([("dev-1", "8.8.8.8", "ping", '{"v": 1}'), ("dev-2", "", "speedtest", '{"v": 2}')])
+    db.save_target_stats([("dev-1", "8.8.8.8", "ping", '{"v": 3}')])
+    rows = sorted(db.load_target_stats(), key=lambda row: row["device_id"])
+    c.equal(rows, [
+        {"device_id": "dev-1", "target": "8.8.8.8", "test_type": "ping", "data": '{"v": 3}'},
+        {"device_id": "dev-2", "target": "", "test_type": "speedtest", "data": '{"v": 2}'},
+    ], "target stats upsert")
+
+def check_alerts(db, c: Checker):
+    first = db.save_alert("dev-1", "8.8.8.8", "ping", "latency_high", "rtt_ms", 80.0, 10.0, "slow",
+                          None, "2024-01-01T00:00:01")
+    second = db.save_alert("dev-2", "8.8.8.8", "ping", "loss_spike", "loss_pct", 50.0, 0.0, "lossy",
+                           None, "2024-01-01T00:00:02")
+
+    c.equal(first["resolved_at"], None, "new alert is active")
+    c.equal([a["id"] for a in db.get_alerts()], [second["id"], first["id"]], "alerts newest first")
+
+    db.resolve_alert(first["id"], "2024-01-01T00:00:03")
+    c.equal([a["id"] for a in db.get_alerts(active_only=True)], [second["id"]], "active alerts")
+    c.equal(db.get_alerts("dev-1")[0]["resolved_at"], "2024-01-01T00:00:03", "resolved_at")
+
+    rule = db.create_alert_rule("rtt_ms", ">", 100.0, target="8.8.8.8")
+    c.equal((rule["metric"], rule["operator"], rule["threshold"], rule["enabled"]), ("rtt_ms", ">", 100.0, 1),
+            "create_alert_rule")
+    c.equal([r["id"] for r in db.get_alert_rules()], [rule["id"]], "get_alert_rules")
+    db.delete_alert_rule(rule["id"])
+    c.equal(db.get_alert_rules(), [], "delete_alert_rule")
+
+CHECKS = [check_devices, check_results, check_routes, check_commands, check_schedules, check_monitor_and_stats, check_alerts]
+
+def run_checks(db, c: Checker):
+    for check in CHECKS:
+        try:
+            check(db, c)
+        except Exception as e:
+            c.failures.append(f"{check.__name__} crashed: {e!r}")
+
+def check_engine(engine: str, workdir: str):
+    """ Runs every check against a fresh engine """
+    c = Checker(engine)
+
+    if engine == "memory":
+        snapshot_file = os.path.join(workdir, "snapshot.json")
+        db = storage.MemoryStorage(snapshot_file)
+        db.init_database()
+        run_checks(db, c)
+
+        # Everything has to come back from the snapshot
+        db.snapshot()
+        reloaded = storage.MemoryStorage(snapshot_file)
+        reloaded.init_database()
+        for name, call in [
+            ("devices", lambda d: d.get_all_devices()),
+            ("results", lambda d: d.get_test_results(None, 100)),
+            ("raw output", lambda d: d.get_test_result(7)),
+            ("route path", lambda d: d.get_route_path(1)),
+            ("hop routes", lambda d: d.get_hop_routes("8.8.8.8")),
+            ("route changes", lambda d: d.get_route_changes()),
+            ("pending commands", lambda d: d.get_pending_commands("dev-1")),
+            ("schedule changes", lambda d: d.get_schedule_changes("dev-1", 0)),
+            ("alerts", lambda d: d.get_alerts()),
+            ("target stats", lambda d: d.load_target_stats()),
+        ]:
+            c.equal(call(reloaded), call(db), f"snapshot round trip: {name}")
+
+        # New ids continue after the reloaded ones
+        c.expect(reloaded.create_command("dev-1", "ping")["id"] > max(cmd["id"] for cmd in db.get_all_commands()),
+                 "ids continue after a reload")
+        return c
+
+    database.DB_FILE = os.path.join(workdir, "conformance.db")
+    database.SHARDS = 3 if engine == "sqlite-shards" else 1
+    database.route_path_cache.clear()
+    db = storage.SQLiteStorage()
+    db.init_database()
+    run_checks(db, c)
+    return c
+
+def main():
+    engines = ["sqlite", "sqlite-shards", "memory"]
+
+    parser = argparse.ArgumentParser(description="Run the storage conformance checks")
+    parser.add_argument("--storage", default=",".join(engines), help=f"comma separated ({', '.join(engines)})")
+    args = parser.parse_args()
+
+    failed = False
+    for engine in args.storage.split(","):
+        with tempfile.TemporaryDirectory() as workdir:
+            # database.py prints on every connection
+            with contextlib.redirect_stdout(open(os.devnull, "w")):
+                c = check_engine(engine, workdir)
+
+        print(f"{engine}: {c.checks - len(c.failures)}/{c.checks} checks passed")
+        for failure in c.failures:
+            print(f"   FAIL {failure}")
+        failed = failed or bool(c.failures)
+
+    sys.exit(1 if failed else 0)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,167 @@
+"""
+summary.py - Materialized dashboard summary
+
+Everything dashboard.html shows, kept in memory and updated by the write
+paths of server.py instead of being recomputed from SQLite per viewer:
+
+- every device with its status and last_seen (register, heartbeats, sweeper)
+- the latest result per device and test type, with the metrics
+  stats.extract_metrics got out of it (ingest)
+- fleet success rates per test type: how many devices pass their latest
+  test, and results / failures over the last hour (minute buckets)
+
+GET /dashboard/summary serves the JSON of the view, encoded once per
+change: it's rebuilt when something changed and the cached copy is older
+than SUMMARY_MAX_AGE seconds, so any number of viewers costs one build a
+second at most and no SQLite reads. At startup the view is loaded with one
+query (the latest result of every device / test type, monitor windows
+come back with the next upload); the last-hour counters start empty.
+"""
+
+import json
+import threading
+import time
+from datetime import datetime
+
+import stats
+
+SUMMARY_MAX_AGE = 1.0   # seconds a cached summary is served although something changed
+WINDOW_MINUTES = 60     # fleet success rates over this many minutes
+METRICS = ("rtt_ms", "loss_pct", "hop_count", "throughput_mbps")
+
+devices = {}    # device_id -> {"device_id", "name", "status", "last_seen"}
+latest = {}     # device_id -> {test_type: latest result}
+window = {}     # test_type -> {minute: [results, failures]}
+version = 0     # bumped by every change
+
+cached = None   # (version, built at (monotonic), JSON bytes)
+summary_lock = threading.Lock()
+
+def latest_entry(result_id: int, target: str, timestamp: str, metrics: dict):
+    entry = {"id": result_id, "timestamp": timestamp, "target": target, "success": metrics["success"]}
+    for name in METRICS:
+        if metrics.get(name) is not None:
+            entry[name] = metrics[name]
+    return entry
+
+def load(all_devices: list, latest_results: list):
+    """ Fills the view at startup (db.get_all_devices(), db.get_latest_results()) """
+    global version
+    with summary_lock:
+        for device in all_devices:
+            devices[device["device_id"]] = {
+                key: device.get(key) for key in ("device_id", "name", "status", "last_seen")
+            }
+
+        for result in latest_results:
+            metrics = stats.extract_metrics(result["test_type"], result["result_data"])
+            latest.setdefault(result["device_id"], {})[result["test_type"]] = latest_entry(
+                result["id"], result["target"], result["timestamp"], metrics
+            )
+
+        version += 1
+
+def set_device(device: dict):
+    """ A device registered (again) """
+    global version
+    with summary_lock:
+        devices[device["device_id"]] = {
+            "device_id": device["device_id"],
+            "name": device["name"],
+            "status": device["status"],
+            "last_seen": device.get("last_seen") or device.get("registered_at")
+        }
+        version += 1
+
+def device_seen(device_id: str, last_seen: str):
+    """ Heartbeat: the device is online """
+    global version
+    with summary_lock:
+        device = devices.get(device_id)
+        if device is not None:
+            device["status"] = "online"
+            device["last_seen"] = last_seen
+            version += 1
+
+def device_offline(device_id: str, last_seen: str):
+    """ The sweeper set a device offline """
+    global version
+    with summary_lock:
+        device = devices.get(device_id)
+        if device is not None:
+            device["status"] = "offline"
+            device["last_seen"] = last_seen
+            version += 1
+
+def record_result(device_id: str, target: str, test_type: str, metrics: dict, timestamp: str, result_id: int = None):
+    """ A new result (O(1)); monitor summaries have no result_id """
+    global version
+    minute = int(time.time() // 60)
+
+    with summary_lock:
+        latest.setdefault(device_id, {})[test_type] = latest_entry(result_id, target, timestamp, metrics)
+
+        buckets = window.setdefault(test_type, {})
+        counts = buckets.setdefault(minute, [0, 0])
+        counts[0] += 1
+        if not metrics["success"]:
+            counts[1] += 1
+        version += 1
+
+def build():
+    """ The summary as a dict (call with summary_lock held) """
+    oldest = int(time.time() // 60) - WINDOW_MINUTES + 1
+
+    device_list = []
+    status_counts = {}
+    rates = {}
+
+    for device_id in sorted(devices):
+        device = dict(devices[device_id])
+        device["latest"] = latest.get(device_id, {})
+        device_list.append(device)
+        status_counts[device["status"]] = status_counts.get(device["status"], 0) + 1
+
+        for test_type, result in device["latest"].items():
+            rate = rates.setdefault(test_type, {"devices": 0, "passing": 0})
+            rate["devices"] += 1
+            rate["passing"] += 1 if result["success"] else 0
+
+    for test_type, buckets in window.items():
+        for minute in [minute for minute in buckets if minute < oldest]:
+            del buckets[minute]
+
+    for test_type in set(rates) | set(window):
+        rate = rates.setdefault(test_type, {"devices": 0, "passing": 0})
+        rate["passing_rate"] = round(rate["passing"] / rate["devices"], 4) if rate["devices"] else None
+
+        buckets = window.get(test_type, {})
+        results = sum(counts[0] for counts in buckets.values())
+        failures = sum(counts[1] for counts in buckets.values())
+        rate["last_hour"] = {
+            "results": results,
+            "failures": failures,
+            "success_rate": round((results - failures) / results, 4) if results else None
+        }
+
+    return {
+        "generated_at": datetime.now().isoformat(),
+        "device_counts": {"total": len(device_list), **status_counts},
+        "devices": device_list,
+        "success_rates": rates
+    }
+
+def get_summary():
+    """ Returns: the summary as JSON bytes, rebuilt at most every SUMMARY_MAX_AGE seconds """
+    global cached
+    with summary_lock:
+        now = time.monotonic()
+        if cached is not None:
+            cached_version, built_at, data = cached
+            # The last-hour window moves even without writes
+            if now - built_at < SUMMARY_MAX_AGE or (cached_version == version and now - built_at < 60):
+                return data
+
+        data = json.dumps(build()).encode()
+        cached = (version, now, data)
+        return data
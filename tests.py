@@ -6,6 +6,27 @@ This file contains all the different network tests
 
 import subprocess
 import platform
+import socket
+import select
+import struct
+import time
+import ipaddress
+import os
+import threading
+from collections import deque
+from datetime import datetime
+
+from throughput_server import THROUGHPUT_PORT
+
+# Destination port of the first traceroute probe (same as classic traceroute)
+TRACEROUTE_BASE_PORT = 33434
+
+# How many RTT samples a monitor keeps per window (fixed memory)
+MONITOR_WINDOW_SAMPLES = 1024
+
+# Throughput test: buffer size and sample interval
+THROUGHPUT_BUFFER = 256 * 1024
+THROUGHPUT_SAMPLE_INTERVAL = 0.1
 
 def ping_test(target:str, count: int=4):
     """
@@ -117,32 +138,330 @@ def speedtest_test():
             "error": str(e)
         }
         
-def traceroute_test(target: str, max_hops: int = 30):
+def throughput_test(host: str, port: int = THROUGHPUT_PORT, streams: int = 4,
+                    duration: float = 10, direction: str = "both"):
     """
-    Runs a traceroute to show the netowrk path to a target
+    Measures TCP throughput against a snutz throughput server
+    
+    Runs N parallel TCP streams (like iperf -P), receive and send buffers are
+    reused memoryviews so the client doesn't copy data around.
+    
+    Params:
+    - host: where throughput_server.py runs (normally the snutz server)
+    - port: its port (default THROUGHPUT_PORT)
+    - streams: number of parallel TCP streams (default 4)
+    - duration: seconds per direction (default 10)
+    - direction: "download", "upload" or "both" (default)
+    
+    Returns: Dict w/ per-stream and aggregate Mbps plus jitter per direction
+    """
+    print(f"Running throughput test against {host}:{port} ({streams} streams, {duration}s)")
+    
+    result = {
+        "success": True,
+        "target": f"{host}:{port}",
+        "streams": streams,
+        "duration_s": duration
+    }
+    
+    directions = ["download", "upload"] if direction == "both" else [direction]
+    
+    try:
+        for name in directions:
+            measurement = run_throughput_streams(host, port, streams, duration, name)
+            result[name] = measurement
+            result[f"{name}_mbps"] = measurement["mbps"]
+    except OSError as e:
+        return {
+            "success": False,
+            "target": f"{host}:{port}",
+            "error": str(e)
+        }
+    
+    return result
+
+def run_throughput_streams(host: str, port: int, streams: int, duration: float, direction: str):
+    """
+    Runs all streams for one direction at the same time
+    
+    Every stream counts its bytes per THROUGHPUT_SAMPLE_INTERVAL, the
+    aggregate of those samples gives the jitter (how much the rate moves)
+    """
+    slots = int(duration / THROUGHPUT_SAMPLE_INTERVAL) + 1
+    samples = [[0] * slots for _ in range(streams)]
+    totals = [0] * streams
+    elapsed = [0.0] * streams
+    errors = []
+    
+    start = threading.Barrier(streams)
+    
+    def run_stream(index):
+        try:
+            with socket.create_connection((host, port), timeout=duration + 10) as sock:
+                start.wait()
+                if direction == "download":
+                    totals[index], elapsed[index] = download_stream(sock, duration, samples[index])
+                else:
+                    totals[index], elapsed[index] = upload_stream(sock, duration, samples[index])
+        except (OSError, threading.BrokenBarrierError, ValueError) as e:
+            errors.append(e)
+            start.abort()
+    
+    threads = [threading.Thread(target=run_stream, args=(i,)) for i in range(streams)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    
+    if errors:
+        raise OSError(f"{direction} stream failed: {errors[0]}")
+    
+    def mbps(byte_count, seconds):
+        return round(byte_count * 8 / seconds / 1_000_000, 2) if seconds else 0.0
+    
+    per_stream = [
+        {"stream": i, "bytes": totals[i], "mbps": mbps(totals[i], elapsed[i])}
+        for i in range(streams)
+    ]
+    
+    #Aggregate rate per sample interval, the last one is usually partial
+    aggregate = [
+        mbps(sum(stream[slot] for stream in samples), THROUGHPUT_SAMPLE_INTERVAL)
+        for slot in range(slots - 1)
+    ]
+    aggregate = [rate for rate in aggregate if rate > 0]
+    
+    # Jitter = mean change between consecutive intervals
+    if len(aggregate) > 1:
+        changes = [abs(b - a) for a, b in zip(aggregate, aggregate[1:])]
+        jitter = round(sum(changes) / len(changes), 2)
+    else:
+        jitter = None
+    
+    return {
+        "mbps": round(sum(stream["mbps"] for stream in per_stream), 2),
+        "jitter_mbps": jitter,
+        "min_interval_mbps": min(aggregate) if aggregate else None,
+        "max_interval_mbps": max(aggregate) if aggregate else None,
+        "per_stream": per_stream
+    }
+
+def download_stream(sock, duration: float, samples: list):
+    """ Reads a DOWN stream into one reused buffer """
+    sock.sendall(f"DOWN {duration}\n".encode())
+    
+    buffer = memoryview(bytearray(THROUGHPUT_BUFFER))
+    total = 0
+    started = time.perf_counter()
+    
+    while True:
+        count = sock.recv_into(buffer)
+        if count == 0:
+            break
+        total += count
+        slot = int((time.perf_counter() - started) / THROUGHPUT_SAMPLE_INTERVAL)
+        samples[min(slot, len(samples) - 1)] += count
+    
+    return total, time.perf_counter() - started
+
+def upload_stream(sock, duration: float, samples: list):
+    """
+    Sends an UP stream from one buffer, the total comes from the server
+    (what we handed to the kernel isn't what arrived)
+    """
+    sock.sendall(b"UP\n")
+    
+    payload = memoryview(os.urandom(THROUGHPUT_BUFFER))
+    started = time.perf_counter()
+    deadline = started + duration
+    
+    while True:
+        now = time.perf_counter()
+        if now >= deadline:
+            break
+        count = sock.send(payload)
+        slot = int((now - started) / THROUGHPUT_SAMPLE_INTERVAL)
+        samples[min(slot, len(samples) - 1)] += count
+    
+    sock.shutdown(socket.SHUT_WR)
+    
+    received, elapsed = read_throughput_report(sock)
+    return received, elapsed
+
+def read_throughput_report(sock):
+    """ Reads the "<bytes> <seconds>" answer of an UP stream """
+    data = b""
+    while not data.endswith(b"\n"):
+        chunk = sock.recv(64)
+        if not chunk:
+            break
+        data += chunk
+    
+    received, elapsed = data.decode().split()
+    return int(received), float(elapsed)
+
+def traceroute_test(target: str, max_hops: int = 30, probes: int = 3, timeout: float = 2.0):
+    """
+    Runs a traceroute to show the network path to a target
+    
+    Probes for every TTL are sent at once (like mtr / paris-traceroute) and
+    the ICMP replies are gathered as they come in, so a full trace takes
+    about one round trip plus the timeout.
+    This needs a raw ICMP socket (root or CAP_NET_RAW), without it we fall
+    back to the system traceroute command.
     
     Params:
     - target: What to trace (e.g., "google.com", "8.8.8.8")
-    - max_hops: maximum number of hops to trace (defualt 30)
+    - max_hops: maximum number of hops to trace (default 30)
+    - probes: how many probes to send per hop (default 3)
+    - timeout: seconds to wait for replies after the last probe (default 2)
+    
+    Returns: Dict w/ results, every hop is a dict with
+    ttl, address, rtts (ms, None = lost) and loss_pct
+    """
+    try:
+        address = socket.gethostbyname(target)
+    except OSError as e:
+        return {
+            "success": False,
+            "target": target,
+            "error": f"Could not resolve {target}: {e}"
+        }
     
-    Returns: Dict w/ results
+    try:
+        icmp_socket = socket.socket(socket.AF_INET, socket.SOCK_RAW, socket.IPPROTO_ICMP)
+    except PermissionError:
+        print("No raw socket access, using the traceroute command")
+        return traceroute_command(target, max_hops, probes, timeout)
+    
+    print(f"Tracing {target} ({address}), {max_hops} hops x {probes} probes in parallel")
+    
+    udp_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    started = time.perf_counter()
+    
+    try:
+        udp_socket.bind(("", 0))
+        source_port = udp_socket.getsockname()[1]
+        
+        #Send every probe up front, the destination port tells us which probe a reply belongs to
+        sent = {}
+        for ttl in range(1, max_hops + 1):
+            udp_socket.setsockopt(socket.IPPROTO_IP, socket.IP_TTL, ttl)
+            for probe in range(probes):
+                port = TRACEROUTE_BASE_PORT + (ttl - 1) * probes + probe
+                sent[port] = (ttl, time.perf_counter())
+                udp_socket.sendto(b"snutz", (address, port))
+        
+        #Gather replies until everything is answered or we time out
+        replies = {}
+        reached_ttl = None
+        reached = False
+        deadline = time.perf_counter() + timeout
+        
+        while len(replies) < len(sent):
+            remaining = deadline - time.perf_counter()
+            if remaining <= 0:
+                break
+            
+            readable, _, _ = select.select([icmp_socket], [], [], remaining)
+            if not readable:
+                break
+            
+            packet, (hop_address, _) = icmp_socket.recvfrom(1024)
+            received = time.perf_counter()
+            
+            port = parse_icmp_probe_reply(packet, address, source_port)
+            if port not in sent or port in replies:
+                continue
+            
+            ttl, sent_at = sent[port]
+            replies[port] = (hop_address, round((received - sent_at) * 1000, 3))
+            
+            # ICMP "destination unreachable" ends the path, from the target itself
+            # it means we got there (port unreachable), from a router it's a dead end
+            if packet[(packet[0] & 0x0F) * 4] == 3:
+                reached_ttl = ttl if reached_ttl is None else min(reached_ttl, ttl)
+                reached = reached or hop_address == address
+            
+            #Everything up to the target answered, no point in waiting longer
+            if reached_ttl and all(
+                port in replies for port, (ttl, _) in sent.items() if ttl <= reached_ttl
+            ):
+                break
+    except OSError as e:
+        return {
+            "success": False,
+            "target": target,
+            "error": str(e)
+        }
+    finally:
+        udp_socket.close()
+        icmp_socket.close()
+    
+    #Build one entry per ttl
+    hops = []
+    for ttl in range(1, (reached_ttl or max_hops) + 1):
+        rtts = []
+        addresses = []
+        for probe in range(probes):
+            reply = replies.get(TRACEROUTE_BASE_PORT + (ttl - 1) * probes + probe)
+            if reply:
+                addresses.append(reply[0])
+                rtts.append(reply[1])
+            else:
+                rtts.append(None)
+        hops.append(build_hop(ttl, addresses, rtts))
+    
+    return traceroute_result(target, address, max_hops, hops, reached, started)
+
+def parse_icmp_probe_reply(packet: bytes, address: str, source_port: int):
+    """
+    Finds out which of our UDP probes an ICMP packet is a reply to
+    
+    Returns: the destination port of the probe, or None if it isn't ours
     """
-    # Different OS use different traceroute commands
-    # Linux: traceroute
-    # windows: tracert
-    # mac: traceroute
+    try:
+        header_length = (packet[0] & 0x0F) * 4
+        icmp_type = packet[header_length]
+        
+        # 11 = time exceeded (a router on the way), 3 = destination unreachable
+        if icmp_type not in (3, 11):
+            return None
+        
+        # The ICMP payload holds the IP + UDP header of the probe we sent
+        inner = header_length + 8
+        inner_length = (packet[inner] & 0x0F) * 4
+        if packet[inner + 9] != socket.IPPROTO_UDP:
+            return None
+        if socket.inet_ntoa(packet[inner + 16:inner + 20]) != address:
+            return None
+        
+        udp = inner + inner_length
+        probe_source, probe_destination = struct.unpack("!HH", packet[udp:udp + 4])
+    except (IndexError, struct.error):
+        return None
     
-    import platform
-    import subprocess
+    if probe_source != source_port:
+        return None
     
+    return probe_destination
+
+def traceroute_command(target: str, max_hops: int = 30, probes: int = 3, timeout: float = 2.0):
+    """
+    Runs the system traceroute / tracert command and parses its output
+    into the same structure as traceroute_test
+    """
     system = platform.system().lower()
     
+    # Linux / mac: traceroute, windows: tracert
+    # -n / -d so we get plain addresses back
     if system == "windows":
-        command = ["tracert", "-h", str(max_hops), target]
+        command = ["tracert", "-d", "-h", str(max_hops), "-w", str(int(timeout * 1000)), target]
     else:
-        command = ["traceroute", "-m", str(max_hops), target]
+        command = ["traceroute", "-n", "-q", str(probes), "-w", str(timeout), "-m", str(max_hops), target]
         
     print(f"Running: {' '.join(command)}")
+    started = time.perf_counter()
     
     try:
         #Run the traceroute command
@@ -152,40 +471,11 @@ def traceroute_test(target: str, max_hops: int = 30):
             text=True,
             timeout=60 #traceroute can take a while
         )
-        
-        output = result.stdout
-        
-        #Check if successful
-        success = result.returncode == 0
-        
-        #Parse the output into hops
-        hops = []
-        lines = output.split('\n')
-        
-        for line in lines:
-            line = line.strip()
-            if not line or line.startswith('traceroute') or line.startswith("Tracing"):
-                continue
-            
-            #This is basic parser - captures the lines
-            #Will parse moe thoroughly later
-            ## TODO ##
-            if line:
-                hops.append(line)
-        return {
-            "success": success,
-            "target": target,
-            "max_hops": max_hops,
-            "hops": hops,
-            "hop_count": len(hops),
-            "output": output
-        }
-        
     except subprocess.TimeoutExpired:
-        return{
-            success: False,
+        return {
+            "success": False,
             "target": target,
-            "error": "Traceroute times out (60s)"
+            "error": "Traceroute timed out (60s)"
         }
     except FileNotFoundError:
         return {
@@ -195,7 +485,337 @@ def traceroute_test(target: str, max_hops: int = 30):
         }
     except Exception as e:
         return {
-            "succes": False,
+            "success": False,
+            "target": target,
+            "error": str(e)
+        }
+    
+    output = result.stdout
+    hops = parse_traceroute_output(output, probes)
+    
+    try:
+        address = socket.gethostbyname(target)
+    except OSError:
+        address = None
+    
+    reached = result.returncode == 0 and bool(hops) and hops[-1]["address"] == address
+    
+    response = traceroute_result(target, address, max_hops, hops, reached, started)
+    response["output"] = output
+    return response
+
+def parse_traceroute_output(output: str, probes: int = 3):
+    """
+    Parses traceroute / tracert output into hop dicts
+    
+    Handles lines like:
+    " 1  192.168.1.1  1.123 ms  0.987 ms  1.001 ms"  (traceroute -n)
+    "  2    <1 ms    <1 ms    <1 ms  10.0.0.1"         (tracert -d)
+    " 3  * * *"
+    """
+    hops = []
+    
+    for line in output.split('\n'):
+        parts = line.split()
+        
+        #Hop lines start with the ttl, everything else is a header
+        if not parts or not parts[0].isdigit():
+            continue
+        
+        rtts = []
+        addresses = []
+        
+        i = 1
+        while i < len(parts):
+            part = parts[i]
+            
+            if part == "*":
+                rtts.append(None)
+            elif part.endswith("ms") and is_number(part[:-2].lstrip("<")):
+                # "1ms" / "<1ms"
+                rtts.append(float(part[:-2].lstrip("<")))
+            elif i + 1 < len(parts) and parts[i + 1] == "ms" and is_number(part.lstrip("<")):
+                # "1.123 ms"
+                rtts.append(float(part.lstrip("<")))
+                i += 1
+            elif is_ip_address(part.strip("[]()")):
+                addresses.append(part.strip("[]()"))
+            
+            i += 1
+        
+        #Pad lines where the tool printed less values than we asked for
+        rtts += [None] * (probes - len(rtts))
+        
+        hops.append(build_hop(int(parts[0]), addresses, rtts))
+    
+    return hops
+
+def build_hop(ttl: int, addresses: list, rtts: list):
+    """ Builds the dict for one hop """
+    lost = sum(1 for rtt in rtts if rtt is None)
+    
+    return {
+        "ttl": ttl,
+        "address": addresses[0] if addresses else None,
+        "rtts": rtts,
+        "loss_pct": round(lost * 100 / len(rtts), 1) if rtts else 100.0
+    }
+
+def traceroute_result(target: str, address: str, max_hops: int, hops: list, reached: bool, started: float):
+    """ Builds the result dict shared by both traceroute engines """
+    
+    #Drop the silent hops at the end if we never got to the target
+    if not reached:
+        while hops and hops[-1]["address"] is None:
+            hops.pop()
+    
+    return {
+        "success": reached,
+        "target": target,
+        "address": address,
+        "max_hops": max_hops,
+        "hops": hops,
+        "hop_count": len(hops),
+        "duration_ms": round((time.perf_counter() - started) * 1000, 1)
+    }
+
+def is_number(text: str):
+    """ True if text is a (decimal) number """
+    try:
+        float(text)
+        return True
+    except ValueError:
+        return False
+
+def is_ip_address(text: str):
+    """ True if text is an IPv4 / IPv6 address """
+    try:
+        ipaddress.ip_address(text)
+        return True
+    except ValueError:
+        return False
+
+def monitor_test(target: str, duration: float = 300, interval: float = 0.2,
+                 report_every: float = 10, probe_timeout: float = 1.0,
+                 on_summary=None, stop_event: threading.Event = None):
+    """
+    Probes a target continuously (mtr style) with ICMP echo requests
+    
+    Instead of one result per probe, rolling statistics are kept in fixed
+    memory and a compact summary is handed to on_summary every report_every
+    seconds.
+    
+    Params:
+    - target: What to monitor (e.g. "google.com", "8.8.8.8")
+    - duration: how long to run in seconds (default 300)
+    - interval: seconds between probes, can be sub-second (default 0.2)
+    - report_every: seconds per summary window (default 10)
+    - probe_timeout: after how long a probe counts as lost (default 1)
+    - on_summary: OPTIONAL function called with every window summary
+    - stop_event: OPTIONAL threading.Event to stop early
+    
+    Returns: Dict w/ the summary over the whole run
+    """
+    try:
+        address = socket.gethostbyname(target)
+        icmp_socket, raw = icmp_echo_socket()
+    except OSError as e:
+        return {
+            "success": False,
+            "target": target,
+            "error": str(e)
+        }
+    
+    print(f"Monitoring {target} ({address}) every {interval}s for {duration}s")
+    
+    identifier = os.getpid() & 0xFFFF
+    window = RollingStats()
+    total = RollingStats()
+    outstanding = {}
+    sequence = 0
+    
+    started = time.monotonic()
+    next_probe = started
+    next_report = started + report_every
+    
+    try:
+        while time.monotonic() - started < duration:
+            if stop_event and stop_event.is_set():
+                break
+            
+            now = time.monotonic()
+            
+            #Time for the next probe
+            if now >= next_probe:
+                sequence = (sequence + 1) & 0xFFFF
+                outstanding[sequence] = time.perf_counter()
+                icmp_socket.sendto(icmp_echo_request(identifier, sequence), (address, 0))
+                next_probe += interval
+            
+            #Probes that didn't come back in time are lost
+            expired = time.perf_counter() - probe_timeout
+            for seq in [seq for seq, sent_at in outstanding.items() if sent_at < expired]:
+                del outstanding[seq]
+                window.add_lost()
+                total.add_lost()
+            
+            #Close the window and report it
+            if now >= next_report:
+                if on_summary:
+                    on_summary(window.summary(target))
+                window.reset()
+                next_report += report_every
+            
+            #Wait for replies until the next probe is due
+            wait = max(0, min(next_probe, next_report) - time.monotonic())
+            readable, _, _ = select.select([icmp_socket], [], [], wait)
+            if not readable:
+                continue
+            
+            packet = icmp_socket.recv(1024)
+            received = time.perf_counter()
+            
+            seq = parse_icmp_echo_reply(packet, identifier, raw)
+            if seq in outstanding:
+                rtt = (received - outstanding.pop(seq)) * 1000
+                window.add_rtt(rtt)
+                total.add_rtt(rtt)
+    except OSError as e:
+        return {
+            "success": False,
             "target": target,
             "error": str(e)
-        }
\ No newline at end of file
+        }
+    finally:
+        icmp_socket.close()
+    
+    #Report the last (partial) window
+    if on_summary and window.sent:
+        on_summary(window.summary(target))
+    
+    summary = total.summary(target)
+    summary["success"] = total.received > 0
+    summary["interval"] = interval
+    summary["duration_s"] = round(time.monotonic() - started, 1)
+    return summary
+
+class RollingStats:
+    """
+    Counters for a monitor window
+    
+    Min / max / mean are running values, percentiles and jitter use a
+    fixed size ring of the latest RTTs, so memory doesn't grow with the
+    number of probes.
+    A probe is counted once it's answered or lost, probes still in flight
+    belong to the next window.
+    """
+    
+    def __init__(self):
+        self.samples = deque(maxlen=MONITOR_WINDOW_SAMPLES)
+        self.reset()
+    
+    def reset(self):
+        """ Starts a new window """
+        self.started = datetime.now().isoformat()
+        self.sent = 0
+        self.received = 0
+        self.rtt_sum = 0.0
+        self.rtt_min = None
+        self.rtt_max = None
+        self.jitter_sum = 0.0
+        self.last_rtt = None
+        self.samples.clear()
+    
+    def add_lost(self):
+        self.sent += 1
+    
+    def add_rtt(self, rtt: float):
+        self.sent += 1
+        self.received += 1
+        self.rtt_sum += rtt
+        self.rtt_min = rtt if self.rtt_min is None else min(self.rtt_min, rtt)
+        self.rtt_max = rtt if self.rtt_max is None else max(self.rtt_max, rtt)
+        
+        # Jitter = mean difference between consecutive RTTs
+        if self.last_rtt is not None:
+            self.jitter_sum += abs(rtt - self.last_rtt)
+        self.last_rtt = rtt
+        self.samples.append(rtt)
+    
+    def percentile(self, pct: float):
+        if not self.samples:
+            return None
+        ordered = sorted(self.samples)
+        return ordered[min(len(ordered) - 1, int(len(ordered) * pct / 100))]
+    
+    def summary(self, target: str):
+        """ Compact dict for this window """
+        lost = self.sent - self.received
+        
+        def ms(value):
+            return round(value, 3) if value is not None else None
+        
+        return {
+            "target": target,
+            "window_start": self.started,
+            "window_end": datetime.now().isoformat(),
+            "sent": self.sent,
+            "received": self.received,
+            "loss_pct": round(lost * 100 / self.sent, 1) if self.sent else 0.0,
+            "rtt_min_ms": ms(self.rtt_min),
+            "rtt_avg_ms": ms(self.rtt_sum / self.received) if self.received else None,
+            "rtt_max_ms": ms(self.rtt_max),
+            "rtt_p50_ms": ms(self.percentile(50)),
+            "rtt_p95_ms": ms(self.percentile(95)),
+            "jitter_ms": ms(self.jitter_sum / (self.received - 1)) if self.received > 1 else None
+        }
+
+def icmp_echo_socket():
+    """
+    Opens a socket to send ICMP echo requests on
+    
+    Tries an unprivileged ping socket first (linux, net.ipv4.ping_group_range),
+    then a raw socket (root / CAP_NET_RAW)
+    
+    Returns: (socket, True if it's a raw socket)
+    """
+    try:
+        return socket.socket(socket.AF_INET, socket.SOCK_DGRAM, socket.IPPROTO_ICMP), False
+    except OSError:
+        return socket.socket(socket.AF_INET, socket.SOCK_RAW, socket.IPPROTO_ICMP), True
+
+def icmp_echo_request(identifier: int, sequence: int):
+    """ Builds an ICMP echo request packet """
+    payload = b"snutz-monitor"
+    header = struct.pack("!BBHHH", 8, 0, 0, identifier, sequence)
+    checksum = icmp_checksum(header + payload)
+    return struct.pack("!BBHHH", 8, 0, checksum, identifier, sequence) + payload
+
+def parse_icmp_echo_reply(packet: bytes, identifier: int, raw: bool):
+    """
+    Returns: the sequence number of an echo reply to us, or None
+    """
+    try:
+        # Raw sockets hand us the IP header too
+        offset = (packet[0] & 0x0F) * 4 if raw else 0
+        icmp_type, _, _, reply_id, sequence = struct.unpack("!BBHHH", packet[offset:offset + 8])
+    except (IndexError, struct.error):
+        return None
+    
+    if icmp_type != 0:
+        return None
+    
+    # Ping sockets rewrite the id themselves and only give us our own replies
+    if raw and reply_id != identifier:
+        return None
+    
+    return sequence
+
+def icmp_checksum(data: bytes):
+    """ Internet checksum (RFC 1071) """
+    if len(data) % 2:
+        data += b"\0"
+    total = sum(struct.unpack(f"!{len(data) // 2}H", data))
+    total = (total >> 16) + (total & 0xFFFF)
+    total += total >> 16
+    return ~total & 0xFFFF
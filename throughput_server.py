@@ -0,0 +1,128 @@
+"""
+throughput_server.py - TCP throughput test server
+
+Agents run the "throughput" test (tests.throughput_test) against this
+server to measure the path between a probe and our own infrastructure.
+server.py starts it in the background, it can also run on its own:
+
+    python throughput_server.py [port]
+
+Protocol, one request line per TCP connection (every stream is one connection):
+- "DOWN <seconds>": the server sends data for <seconds>, then closes
+- "UP": the client sends data until it shuts down its side,
+        the server answers "<bytes> <seconds>" with what it received
+"""
+
+import os
+import socketserver
+import sys
+import tempfile
+import threading
+import time
+
+THROUGHPUT_PORT = 8001
+SEND_CHUNK = 256 * 1024          # bytes per sendfile() call
+PAYLOAD_SIZE = 8 * 1024 * 1024   # size of the file we send from
+MAX_DURATION = 60                # seconds, longest test we allow
+
+class ThroughputHandler(socketserver.BaseRequestHandler):
+    """ Handles one stream """
+
+    def handle(self):
+        sock = self.request
+        sock.settimeout(MAX_DURATION + 10)
+
+        try:
+            request = read_line(sock).split()
+        except OSError:
+            return
+
+        if not request:
+            return
+
+        try:
+            if request[0] == "DOWN":
+                duration = min(float(request[1]), MAX_DURATION)
+                self.send_data(sock, duration)
+            elif request[0] == "UP":
+                self.receive_data(sock)
+        except (OSError, ValueError, IndexError):
+            # Client went away or sent garbage, nothing to report
+            return
+
+    def send_data(self, sock, duration: float):
+        """ Sends the payload file with sendfile() (zero-copy) until time is up """
+        payload = self.server.payload
+        deadline = time.monotonic() + duration
+        offset = 0
+
+        while time.monotonic() < deadline:
+            sent = sock.sendfile(payload, offset=offset, count=SEND_CHUNK)
+            if sent == 0:
+                break
+            offset = (offset + sent) % PAYLOAD_SIZE
+
+    def receive_data(self, sock):
+        """ Reads everything into one reused buffer and reports the count """
+        buffer = memoryview(bytearray(SEND_CHUNK))
+        received = 0
+        started = None
+
+        while True:
+            count = sock.recv_into(buffer)
+            if count == 0:
+                break
+            if started is None:
+                started = time.perf_counter()
+            received += count
+
+        elapsed = time.perf_counter() - started if started else 0.0
+        sock.sendall(f"{received} {elapsed:.6f}\n".encode())
+
+class ThroughputServer(socketserver.ThreadingTCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, address):
+        super().__init__(address, ThroughputHandler)
+
+        # Random data so compression on the path can't fake the numbers
+        self.payload = tempfile.TemporaryFile()
+        self.payload.write(os.urandom(PAYLOAD_SIZE))
+        self.payload.flush()
+
+    def server_close(self):
+        super().server_close()
+        self.payload.close()
+
+def read_line(sock):
+    """ Reads the request line byte by byte (it's tiny) """
+    line = b""
+    while not line.endswith(b"\n") and len(line) < 64:
+        char = sock.recv(1)
+        if not char:
+            break
+        line += char
+    return line.decode(errors="replace").strip()
+
+def start_throughput_server(host: str = "0.0.0.0", port: int = THROUGHPUT_PORT):
+    """
+    Starts the throughput server in a background thread
+
+    Returns: the server, call shutdown() + server_close() to stop it
+    """
+    server = ThroughputServer((host, port))
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    print(f"Throughput server listening on {host}:{server.server_address[1]}")
+    return server
+
+if __name__ == "__main__":
+    port = int(sys.argv[1]) if len(sys.argv) > 1 else THROUGHPUT_PORT
+
+    with ThroughputServer(("0.0.0.0", port)) as server:
+        print(f"Throughput server listening on port {server.server_address[1]}")
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            print("\nThroughput server stopped")